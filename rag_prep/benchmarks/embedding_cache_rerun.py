@@ -0,0 +1,111 @@
+"""Embedding requests and time across ingestion runs with the embedding cache.
+
+Splits synthetic documents into pages of `--page-words` words, as PDF
+pages are chunks in ingestion, and embeds them with FakeEmbeddings
+through CachedEmbeddings, in batches the size index() hands to the vector
+store. Runs, in order:
+- cold
+- an identical re-run
+- the same pages with reflowed whitespace, in a different order, so
+  chunks move between batches
+- a re-split after text is inserted near the start of a share of the
+  documents, which shifts every later page boundary in those documents
+- a re-split of every document at a different page size
+- a run where a share of the pages is new text
+
+    poetry run python benchmarks/embedding_cache_rerun.py --chunks 5000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from embedding_cache import CachedEmbeddings  # noqa: E402
+from firestore_record_manager import _chunks  # noqa: E402
+from fake_embeddings import FakeEmbeddings  # noqa: E402
+
+
+def corpus(chunks, seed, page_words=120):
+    rng = random.Random(seed)
+    words = [f"word{i}" for i in range(5000)]
+    return [" ".join(rng.choice(words) for _ in range(page_words)) for _ in range(chunks)]
+
+
+def documents(chunks, pages_per_document, page_words, seed):
+    """Word lists of synthetic documents holding `chunks` pages in total."""
+    rng = random.Random(seed)
+    vocabulary = [f"word{i}" for i in range(5000)]
+    sizes = [pages_per_document] * (chunks // pages_per_document)
+    if chunks % pages_per_document:
+        sizes.append(chunks % pages_per_document)
+    return [[rng.choice(vocabulary) for _ in range(size * page_words)] for size in sizes]
+
+
+def split(docs, page_words):
+    return [
+        " ".join(doc[start:start + page_words])
+        for doc in docs
+        for start in range(0, len(doc), page_words)
+    ]
+
+
+def run(label, folder, embedder, texts, batch_documents):
+    cache = CachedEmbeddings(embedder, folder)
+    calls = embedder.calls
+    started = time.perf_counter()
+    vectors = []
+    for batch in _chunks(texts, batch_documents):
+        vectors.extend(cache.embed_documents(batch))
+    elapsed = time.perf_counter() - started
+    stats = cache.stats()
+    cache.close()
+    print(f"{label:<26} hit rate {stats['hitRate']:>6.1%}  {embedder.calls - calls:>4} embed requests"
+          f"  {stats['embedRequestsSaved']:>4} saved  {elapsed:>6.2f}s")
+    return vectors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chunks", type=int, default=5000)
+    parser.add_argument("--batch-documents", type=int, default=200, help="texts per embed_documents call")
+    parser.add_argument("--page-words", type=int, default=120)
+    parser.add_argument("--pages-per-document", type=int, default=10)
+    parser.add_argument("--edit-share", type=float, default=0.1, help="share of documents edited before re-splitting")
+    parser.add_argument("--new-share", type=float, default=0.1, help="share of new chunks in the last run")
+    parser.add_argument("--latency", type=float, default=0.2, help="fake embedding request in seconds")
+    parser.add_argument("--dimension", type=int, default=768)
+    args = parser.parse_args()
+
+    embedder = FakeEmbeddings(dimension=args.dimension, latency=args.latency)
+    docs = documents(args.chunks, args.pages_per_document, args.page_words, seed=1)
+    texts = split(docs, args.page_words)
+    reflowed = [text.replace(" ", "\n", 3) + "  " for text in texts]
+    random.Random(2).shuffle(reflowed)
+    edited = max(1, int(len(docs) * args.edit_share))
+    inserted = corpus(edited, seed=4, page_words=args.page_words // 3)
+    edits = [doc[:5] + insert.split() + doc[5:] for doc, insert in zip(docs[:edited], inserted)] + docs[edited:]
+    new = int(args.chunks * args.new_share)
+    changed = texts[new:] + corpus(new, seed=3, page_words=args.page_words)
+
+    with tempfile.TemporaryDirectory() as folder:
+        run("cold", folder, embedder, texts, args.batch_documents)
+        cached = run("unchanged re-run", folder, embedder, texts, args.batch_documents)
+        # Vectors come back from the float32 file, so equal up to rounding
+        error = max(abs(a - b) for text, vector in zip(texts, cached) for a, b in zip(embedder._vector(text), vector))
+        if error > 1e-6:
+            raise AssertionError(f"cached vectors differ from the embedder's by up to {error}")
+        run("reflowed and reordered", folder, embedder, reflowed, args.batch_documents)
+        run(f"re-split, {edited} docs edited", folder, embedder, split(edits, args.page_words), args.batch_documents)
+        resized = split(docs, args.page_words * 3 // 4)
+        run(f"re-split at {args.page_words * 3 // 4} words", folder, embedder, resized, args.batch_documents)
+        run(f"{args.new_share:.0%} new chunks", folder, embedder, changed, args.batch_documents)
+        size = sum(os.path.getsize(os.path.join(folder, name)) for name in os.listdir(folder))
+        print(f"cache size {size / 2**20:.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+"""Offline stand-in for VertexAIEmbeddings.
+
+Vectors are derived from a hash of the text, so the same text always gets
+the same vector, and every embed_documents call sleeps for `latency`
+seconds and is counted, as a request to Vertex AI would be.
+"""
+import time
+import random
+import hashlib
+
+
+class FakeEmbeddings:
+    def __init__(self, model_name="fake-embedding", dimension=768, latency=0.2):
+        self.model_name = model_name
+        self.dimension = dimension
+        self.latency = latency
+        self.calls = 0
+        self.texts = 0
+
+    def _vector(self, text):
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "big")
+        rng = random.Random(seed)
+        return [rng.uniform(-1, 1) for _ in range(self.dimension)]
+
+    def embed_documents(self, texts):
+        self.calls += 1
+        self.texts += len(texts)
+        time.sleep(self.latency)
+        return [self._vector(text) for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
@@ -0,0 +1,280 @@
+"""In-memory stand-in for the parts of firestore.Client the record manager uses.
+
+Every RPC sleeps for `latency` seconds, as a round trip to Firestore would,
+so batching and concurrency show up in benchmarks the way they would
+against the real service. Batches over 500 writes and "in" filters over
+30 values fail as they do in Firestore. FakeAsyncFirestore serves the
+same documents through the AsyncClient interface.
+"""
+import time
+import bisect
+import asyncio
+import operator
+import itertools
+import threading
+
+OPERATORS = {
+    "==": operator.eq,
+    "<": operator.lt,
+    ">": operator.gt,
+    "in": lambda value, values: value in values,
+}
+
+
+class FakeSnapshot:
+    def __init__(self, doc_id, data):
+        self.id = doc_id
+        self._data = data
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def get(self, field):
+        return self._data[field]
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+
+class FakeDocument:
+    def __init__(self, client, collection, doc_id):
+        self.client = client
+        self.collection = collection
+        self.id = doc_id
+
+    def get(self):
+        self.client.rpc()
+        return FakeSnapshot(self.id, self.client.docs(self.collection).get(self.id))
+
+
+class FakeQuery:
+    def __init__(self, client, collection, filters=(), fields=None, count=None, cursor=None):
+        self.client = client
+        self.collection = collection
+        self.filters = tuple(filters)
+        self.fields = fields
+        self.count = count
+        self.cursor = cursor
+
+    def _copy(self, **changes):
+        state = {"filters": self.filters, "fields": self.fields, "count": self.count, "cursor": self.cursor}
+        query_class = getattr(self, "query_class", type(self))
+        return query_class(self.client, self.collection, **{**state, **changes})
+
+    def where(self, filter):
+        if filter.op_string == "in" and len(filter.value) > 30:
+            raise ValueError("'in' filters support a maximum of 30 elements")
+        return self._copy(filters=self.filters + ((filter.field_path, filter.op_string, filter.value),))
+
+    def select(self, field_paths):
+        return self._copy(fields=list(field_paths))
+
+    def limit(self, count):
+        return self._copy(count=count)
+
+    def start_after(self, snapshot):
+        # As in Firestore, the cursor holds the snapshot's values for the
+        # fields the query is ordered by: inequality fields, then the id
+        return self._copy(cursor=self._order_key(snapshot.id, snapshot._data))
+
+    def _order_fields(self):
+        return sorted({field for field, op, value in self.filters if op in ("<", ">")})
+
+    def _order_key(self, doc_id, data):
+        return tuple(data[field] for field in self._order_fields()) + (doc_id,)
+
+    def _matches(self, data):
+        return all(field in data and OPERATORS[op](data[field], value) for field, op, value in self.filters)
+
+    def _results(self):
+        results = []
+        with self.client.lock:
+            docs = self.client.docs(self.collection)
+            if self._order_fields():
+                ordered = sorted(
+                    (self._order_key(doc_id, data), doc_id) for doc_id, data in docs.items() if self._matches(data))
+                start = bisect.bisect_right(ordered, (self.cursor, chr(0x10FFFF))) if self.cursor else 0
+                candidates = (doc_id for _, doc_id in ordered[start:])
+            else:
+                ordered = self.client.sorted_ids(self.collection)
+                start = bisect.bisect_right(ordered, self.cursor[-1]) if self.cursor else 0
+                candidates = itertools.islice(ordered, start, None)
+            for doc_id in candidates:
+                data = docs[doc_id]
+                if not self._matches(data):
+                    continue
+                if self.fields is not None:
+                    data = {field: data[field] for field in self.fields if field in data}
+                else:
+                    # The real client deserializes a fresh copy of each document
+                    data = dict(data)
+                results.append(FakeSnapshot(doc_id, data))
+                if self.count and len(results) >= self.count:
+                    break
+        return results
+
+    def get(self):
+        self.client.rpc()
+        return self._results()
+
+    def stream(self):
+        return iter(self.get())
+
+
+class FakeCollection(FakeQuery):
+    query_class = FakeQuery
+
+    def __init__(self, client, name):
+        super().__init__(client, name)
+        self.name = name
+
+    def document(self, doc_id):
+        return FakeDocument(self.client, self.name, doc_id)
+
+
+class FakeBatch:
+    def __init__(self, client):
+        self.client = client
+        self.writes = []
+
+    def set(self, ref, data, merge=False):
+        self.writes.append(("set", ref, data, merge))
+
+    def delete(self, ref):
+        self.writes.append(("delete", ref, None, False))
+
+    def commit(self):
+        if len(self.writes) > 500:
+            raise ValueError("maximum 500 writes allowed per request")
+        self.client.rpc(write=True)
+        with self.client.lock:
+            self._apply()
+
+    def _apply(self):
+        self.client.changed()
+        for op, ref, data, merge in self.writes:
+            docs = self.client.docs(ref.collection)
+            if op == "delete":
+                docs.pop(ref.id, None)
+            elif merge and ref.id in docs:
+                docs[ref.id] = {**docs[ref.id], **data}
+            else:
+                docs[ref.id] = dict(data)
+
+
+class FakeFirestore:
+    def __init__(self, latency=0.02):
+        self.latency = latency
+        self.collections = {}
+        self.lock = threading.Lock()
+        self.rpcs = 0
+        self.reads = 0
+        self._sorted_ids = {}
+
+    def rpc(self, write=False):
+        with self.lock:
+            self.rpcs += 1
+            self.reads += not write
+        time.sleep(self.latency)
+
+    def docs(self, collection):
+        return self.collections.setdefault(collection, {})
+
+    def load(self, collection, docs):
+        """Adds documents directly, without RPCs, for seeding benchmarks."""
+        with self.lock:
+            self.docs(collection).update(docs)
+            self.changed()
+
+    def changed(self):
+        self._sorted_ids.clear()
+
+    def sorted_ids(self, collection):
+        """Document ids in query order; called with the lock held."""
+        if collection not in self._sorted_ids:
+            self._sorted_ids[collection] = sorted(self.docs(collection))
+        return self._sorted_ids[collection]
+
+    def collection(self, name):
+        return FakeCollection(self, name)
+
+    def batch(self):
+        return FakeBatch(self)
+
+    def get_all(self, refs, field_paths=None):
+        self.rpc()
+        for ref in refs:
+            yield FakeSnapshot(ref.id, self.docs(ref.collection).get(ref.id))
+
+
+class FakeAsyncQuery(FakeQuery):
+    async def get(self):
+        await self.client.rpc()
+        return self._results()
+
+    async def stream(self):
+        for snapshot in await self.get():
+            yield snapshot
+
+
+class FakeAsyncCollection(FakeAsyncQuery):
+    query_class = FakeAsyncQuery
+
+    def __init__(self, client, name):
+        super().__init__(client, name)
+        self.name = name
+
+    def document(self, doc_id):
+        return FakeDocument(self.client, self.name, doc_id)
+
+
+class FakeAsyncBatch(FakeBatch):
+    async def commit(self):
+        if len(self.writes) > 500:
+            raise ValueError("maximum 500 writes allowed per request")
+        await self.client.rpc(write=True)
+        with self.client.lock:
+            self._apply()
+
+
+class FakeAsyncFirestore:
+    """AsyncClient over the documents of a FakeFirestore."""
+
+    def __init__(self, store):
+        self.store = store
+        self.lock = store.lock
+
+    @property
+    def rpcs(self):
+        return self.store.rpcs
+
+    @property
+    def reads(self):
+        return self.store.reads
+
+    async def rpc(self, write=False):
+        with self.lock:
+            self.store.rpcs += 1
+            self.store.reads += not write
+        await asyncio.sleep(self.store.latency)
+
+    def docs(self, collection):
+        return self.store.docs(collection)
+
+    def changed(self):
+        self.store.changed()
+
+    def sorted_ids(self, collection):
+        return self.store.sorted_ids(collection)
+
+    def collection(self, name):
+        return FakeAsyncCollection(self, name)
+
+    def batch(self):
+        return FakeAsyncBatch(self)
+
+    async def get_all(self, refs, field_paths=None):
+        await self.rpc()
+        for ref in refs:
+            yield FakeSnapshot(ref.id, self.docs(ref.collection).get(ref.id))
@@ -0,0 +1,86 @@
+"""Peak memory and latency of listing keys in a large namespace.
+
+Seeds the in-memory fake Firestore with `--records` synthetic records and
+compares fetching every matching document in one query.get(), as
+list_keys used to, with paging through only the key field via iter_keys.
+Memory is the tracemalloc peak above what the seeded fake already holds.
+
+    poetry run python benchmarks/list_keys_stream.py --records 1000000
+"""
+import os
+import sys
+import time
+import argparse
+import datetime
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from google.cloud import firestore  # noqa: E402
+from firestore_record_manager import FirestoreRecordManager  # noqa: E402
+from fake_firestore import FakeFirestore  # noqa: E402
+
+
+def unpaged_keys(manager, group_ids):
+    """list_keys as it was: every matching document, whole, from one query."""
+    query = manager.collection.where(filter=firestore.FieldFilter("namespace", "==", manager.namespace))
+    if group_ids:
+        query = query.where(filter=firestore.FieldFilter("group_id", "in", group_ids))
+    docs = query.get()
+    return [doc.get("key") for doc in docs]
+
+
+def measure(label, func):
+    tracemalloc.start()
+    started = time.perf_counter()
+    first = None
+    count = 0
+    for _ in func():
+        if first is None:
+            first = time.perf_counter() - started
+        count += 1
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f"{label:<28} {count:>9,} keys  first key {first * 1000:>8,.1f}ms  "
+          f"total {elapsed:>6.2f}s  peak {peak / 2**20:>8,.1f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--records", type=int, default=1_000_000)
+    parser.add_argument("--groups", type=int, default=2000, help="distinct group_ids (source files)")
+    parser.add_argument("--latency", type=float, default=0.005, help="fake round trip in seconds")
+    parser.add_argument("--page-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    client = FakeFirestore(latency=args.latency)
+    manager = FirestoreRecordManager("benchmark", client=client)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    client.load(manager.collection_name, {
+        f"{i:064x}": {
+            "key": f"{i:064x}",
+            "namespace": "benchmark",
+            "updated_at": now,
+            "group_id": f"stargate_documents/file-{i % args.groups:05d}.pdf",
+        }
+        for i in range(args.records)
+    })
+    print(f"seeded {args.records:,} records in {args.groups:,} groups")
+
+    measure("query.get() (previous)", lambda: unpaged_keys(manager, None))
+    measure("iter_keys", lambda: manager.iter_keys(page_size=args.page_size))
+    measure("list_keys", lambda: manager.list_keys())
+
+    # A cleanup pass over 60 sources with a limit: the previous code fetched
+    # up to `limit` keys for each 30-id batch before trimming
+    sources = sorted({f"stargate_documents/file-{i % args.groups:05d}.pdf" for i in range(60)})
+    limit = args.records // args.groups * 45
+    before = client.rpcs
+    keys = manager.list_keys(group_ids=sources, limit=limit)
+    print(f"list_keys over {len(sources)} groups, limit {limit:,}: "
+          f"{len(keys):,} keys in {client.rpcs - before} round trips")
+
+
+if __name__ == "__main__":
+    main()
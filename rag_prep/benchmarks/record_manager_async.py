@@ -0,0 +1,121 @@
+"""Native async FirestoreRecordManager methods against the sync ones they replaced.
+
+First checks that update, exists, list_keys and delete_keys give the same
+results and leave the same documents whether called sync or async. Then
+runs `--tasks` concurrent callers, each calling aexists and aupdate, once
+through the sync methods (as the a* methods used to) and once natively,
+and reports throughput and the longest event loop stall a ticker task saw.
+
+    poetry run python benchmarks/record_manager_async.py --keys 20000
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from firestore_record_manager import FirestoreRecordManager, _chunks  # noqa: E402
+from fake_firestore import FakeFirestore, FakeAsyncFirestore  # noqa: E402
+
+
+def documents(client, manager):
+    return {
+        doc_id: {field: value for field, value in data.items() if field != "updated_at"}
+        for doc_id, data in client.docs(manager.collection_name).items()
+    }
+
+
+async def check_parity(keys, latency):
+    sync_client = FakeFirestore(latency=latency)
+    async_store = FakeFirestore(latency=latency)
+    sync_manager = FirestoreRecordManager("parity", client=sync_client)
+    async_manager = FirestoreRecordManager(
+        "parity", client=async_store, async_client=FakeAsyncFirestore(async_store))
+
+    groups = [f"source-{i % 45}" for i in range(len(keys))]
+    probe = keys[::3] + [f"missing-{i}" for i in range(40)]
+    some_groups = sorted(set(groups))[:35]
+    steps = [
+        ("update", lambda m: m.update(keys, group_ids=groups), lambda m: m.aupdate(keys, group_ids=groups)),
+        ("update again", lambda m: m.update(keys[:100]), lambda m: m.aupdate(keys[:100])),
+        ("exists", lambda m: m.exists(probe), lambda m: m.aexists(probe)),
+        ("list_keys", lambda m: sorted(m.list_keys(group_ids=some_groups)),
+         lambda m: _sorted(m.alist_keys(group_ids=some_groups))),
+        ("list_keys limit", lambda m: len(m.list_keys(group_ids=some_groups, limit=50)),
+         lambda m: _len(m.alist_keys(group_ids=some_groups, limit=50))),
+        ("delete_keys", lambda m: m.delete_keys(probe), lambda m: m.adelete_keys(probe)),
+    ]
+    for name, sync_step, async_step in steps:
+        expected = sync_step(sync_manager)
+        actual = await async_step(async_manager)
+        if expected != actual:
+            raise AssertionError(f"{name}: sync {expected!r} != async {actual!r}")
+    if documents(sync_client, sync_manager) != documents(async_store, async_manager):
+        raise AssertionError("sync and async runs left different documents")
+    print(f"parity: {len(steps)} operations agree on {len(keys)} keys")
+
+
+async def _sorted(result):
+    return sorted(await result)
+
+
+async def _len(result):
+    return len(await result)
+
+
+async def run_callers(label, manager, chunks, native):
+    stall = 0.0
+    running = True
+
+    async def ticker():
+        nonlocal stall
+        while running:
+            started = time.perf_counter()
+            await asyncio.sleep(0.001)
+            stall = max(stall, time.perf_counter() - started)
+
+    async def caller(chunk):
+        if native:
+            await manager.aexists(chunk)
+            await manager.aupdate(chunk)
+        else:
+            manager.exists(chunk)
+            manager.update(chunk)
+
+    tick = asyncio.create_task(ticker())
+    await asyncio.sleep(0)
+    started = time.perf_counter()
+    await asyncio.gather(*(caller(chunk) for chunk in chunks))
+    elapsed = time.perf_counter() - started
+    running = False
+    await tick
+
+    count = sum(len(chunk) for chunk in chunks)
+    print(f"{label:<26} {count / elapsed:>10,.0f} keys/s ({elapsed:.2f}s), longest loop stall {stall * 1000:,.0f}ms")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--keys", type=int, default=20000)
+    parser.add_argument("--tasks", type=int, default=20, help="concurrent callers")
+    parser.add_argument("--latency", type=float, default=0.02, help="fake round trip in seconds")
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+
+    await check_parity([f"doc-{i:06d}" for i in range(1000)], latency=0)
+
+    store = FakeFirestore(latency=args.latency)
+    manager = FirestoreRecordManager(
+        "benchmark", client=store, async_client=FakeAsyncFirestore(store), max_concurrency=args.concurrency)
+    keys = [f"doc-{i:08d}" for i in range(args.keys)]
+    chunks = _chunks(keys, -(-len(keys) // args.tasks))
+
+    await run_callers("sync calls (previous)", manager, chunks, native=False)
+    manager.delete_keys(keys)
+    await run_callers("native async", manager, chunks, native=True)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
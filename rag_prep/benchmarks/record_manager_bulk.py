@@ -0,0 +1,69 @@
+"""Keys/sec for FirestoreRecordManager.update and delete_keys.
+
+Runs against an in-memory fake with a fixed round-trip latency, or against
+the Firestore emulator with --emulator (FIRESTORE_EMULATOR_HOST must be
+set). Compares the batched, concurrent implementation with per-key reads
+as the record manager used to do them.
+
+    poetry run python benchmarks/record_manager_bulk.py --keys 50000
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from firestore_record_manager import FirestoreRecordManager, WRITE_BATCH_LIMIT, _chunks  # noqa: E402
+from fake_firestore import FakeFirestore  # noqa: E402
+
+
+def per_key_update(manager, keys):
+    """update as it was: one read per key, then the writes in batches."""
+    existing = sum(1 for key in keys if manager.collection.document(key).get().exists)
+    now = manager.get_time()
+    for chunk in _chunks(keys, WRITE_BATCH_LIMIT):
+        batch = manager.db.batch()
+        for key in chunk:
+            batch.set(manager.collection.document(key),
+                      {"key": key, "namespace": manager.namespace, "updated_at": now, "group_id": None}, merge=True)
+        batch.commit()
+    return existing
+
+
+def timed(label, func, count):
+    started = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - started
+    print(f"{label:<34} {count / elapsed:>10,.0f} keys/s ({elapsed:.2f}s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--keys", type=int, default=20000)
+    parser.add_argument("--latency", type=float, default=0.02, help="fake round trip in seconds")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--baseline-keys", type=int, default=500, help="keys for the per-key baseline")
+    parser.add_argument("--emulator", action="store_true")
+    args = parser.parse_args()
+
+    if args.emulator:
+        from google.cloud import firestore
+        client = firestore.Client(project=os.getenv("GOOGLE_CLOUD_PROJECT", "benchmark"))
+    else:
+        client = FakeFirestore(latency=args.latency)
+
+    keys = [f"doc-{i:08d}" for i in range(args.keys)]
+    manager = FirestoreRecordManager("benchmark", client=client, max_concurrency=args.concurrency)
+    blind = FirestoreRecordManager("benchmark", client=client, max_concurrency=args.concurrency, count_updates=False)
+
+    baseline = keys[:args.baseline_keys]
+    timed("per-key reads (previous)", lambda: per_key_update(manager, baseline), len(baseline))
+    timed("update, new keys", lambda: manager.update(keys), len(keys))
+    timed("update, existing keys", lambda: manager.update(keys), len(keys))
+    timed("update, count_updates=False", lambda: blind.update(keys), len(keys))
+    timed("delete_keys", lambda: manager.delete_keys(keys), len(keys))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""Firestore reads of an ingestion re-run with and without the record mirror.
+
+Replays the record manager calls LangChain's index() makes with incremental
+cleanup (exists per batch, update of every key, list_keys of the batch's
+sources) for `--files` sources of `--chunks` documents each, against the
+in-memory fake Firestore. Each run starts from a fresh manager, as a new
+ingestion process would, and the mirror reconciles before indexing.
+
+    poetry run python benchmarks/record_mirror_rerun.py --files 200
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from firestore_record_manager import FirestoreRecordManager  # noqa: E402
+from record_mirror import MirroredRecordManager  # noqa: E402
+from fake_firestore import FakeFirestore  # noqa: E402
+
+
+def index_run(record_manager, sources, batch_size):
+    """The record manager side of index(..., cleanup="incremental")."""
+    started = record_manager.get_time()
+    for i in range(0, len(sources), batch_size):
+        batch = sources[i:i + batch_size]
+        uids = [uid for source, source_uids in batch for uid in source_uids]
+        group_ids = [source for source, source_uids in batch for _ in source_uids]
+        record_manager.exists(uids)
+        record_manager.update(uids, group_ids=group_ids)
+        stale = record_manager.list_keys(group_ids=sorted({source for source, _ in batch}), before=started)
+        if stale:
+            record_manager.delete_keys(stale)
+
+
+def run(label, client, open_manager, sources, batch_size):
+    reads, rpcs = client.reads, client.rpcs
+    started = time.perf_counter()
+    index_run(open_manager(), sources, batch_size)
+    elapsed = time.perf_counter() - started
+    print(f"{label:<30} {client.reads - reads:>6} reads {client.rpcs - rpcs - client.reads + reads:>6} writes"
+          f"  {elapsed:>6.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=200)
+    parser.add_argument("--chunks", type=int, default=50, help="documents per file")
+    parser.add_argument("--batch-size", type=int, default=4, help="files per index() call")
+    parser.add_argument("--latency", type=float, default=0.005, help="fake round trip in seconds")
+    args = parser.parse_args()
+
+    sources = [
+        (f"stargate_documents/file-{i:04d}.pdf", [f"{i:04d}-{j:04d}" for j in range(args.chunks)])
+        for i in range(args.files)
+    ]
+    print(f"{args.files} files, {args.files * args.chunks:,} records")
+
+    client = FakeFirestore(latency=args.latency)
+    direct = lambda: FirestoreRecordManager("direct", client=client)  # noqa: E731
+    run("firestore, first run", client, direct, sources, args.batch_size)
+    run("firestore, unchanged re-run", client, direct, sources, args.batch_size)
+
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "mirror.sqlite")
+
+        def mirrored(full=False):
+            mirror = MirroredRecordManager(FirestoreRecordManager("mirrored", client=client), path)
+            mirror.reconcile(full=full)
+            return mirror
+
+        run("mirror, first run", client, mirrored, sources, args.batch_size)
+        run("mirror, unchanged re-run", client, mirrored, sources, args.batch_size)
+        run("mirror, rebuilt then re-run", client, lambda: mirrored(full=True), sources, args.batch_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+import os
+import re
+import mmap
+import array
+import sqlite3
+import hashlib
+import logging
+import threading
+import unicodedata
+from typing import Dict, List, Optional, Sequence
+from langchain_core.embeddings import Embeddings
+from firestore_record_manager import _chunks
+
+logger = logging.getLogger(__name__)
+
+# Texts per embedding request; Vertex AI accepts up to 250 instances
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "250"))
+FLOAT_BYTES = array.array("f").itemsize
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS models (
+    model TEXT PRIMARY KEY,
+    dimension INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS vectors (
+    model TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    row INTEGER NOT NULL,
+    PRIMARY KEY (model, digest)
+);
+"""
+
+
+def text_digest(text: str) -> str:
+    """Hash of the text with Unicode and whitespace differences normalised away."""
+    normalized = re.sub(r"\s+", " ", unicodedata.normalize("NFC", text)).strip()
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+class VectorFile:
+    """Append-only float32 rows of one model, read through a memory map."""
+
+    def __init__(self, path: str, dimension: int) -> None:
+        self.path = path
+        self.dimension = dimension
+        self.row_bytes = dimension * FLOAT_BYTES
+        open(path, "ab").close()
+        self.file = open(path, "r+b")
+        self.map: Optional[mmap.mmap] = None
+        self.view: Optional[memoryview] = None
+        # A crash between appending and indexing leaves unindexed rows; new
+        # rows go after them
+        self.rows = os.path.getsize(path) // self.row_bytes
+
+    def _remap(self) -> None:
+        self.close_map()
+        self.map = mmap.mmap(self.file.fileno(), self.rows * self.row_bytes, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map).cast("f")
+
+    def read(self, row: int) -> List[float]:
+        if self.view is None or (row + 1) * self.dimension > len(self.view):
+            self._remap()
+        return self.view[row * self.dimension:(row + 1) * self.dimension].tolist()
+
+    def append(self, vectors: Sequence[Sequence[float]]) -> int:
+        """Writes the vectors and returns the row of the first."""
+        for vector in vectors:
+            if len(vector) != self.dimension:
+                raise ValueError(f"Expected {self.dimension} dimensions, got {len(vector)}")
+        first = self.rows
+        self.file.seek(first * self.row_bytes)
+        for vector in vectors:
+            self.file.write(array.array("f", vector).tobytes())
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.rows += len(vectors)
+        return first
+
+    def close_map(self) -> None:
+        if self.view is not None:
+            self.view.release()
+            self.map.close()
+            self.view = self.map = None
+
+    def close(self) -> None:
+        self.close_map()
+        self.file.close()
+
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings that are computed once per (model, normalised text) and kept on disk.
+
+    Vectors live in one float32 file per model under `folder`, memory mapped
+    for reads, with a SQLite index from text hash to row. Texts not in the
+    cache are embedded together, EMBED_BATCH_SIZE per request, and appended
+    before they are returned. Queries are not cached."""
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        folder: str,
+        model_name: Optional[str] = None,
+        batch_size: int = EMBED_BATCH_SIZE,
+    ) -> None:
+        self.embeddings = embeddings
+        self.model_name = model_name or getattr(embeddings, "model_name")
+        self.folder = folder
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(folder, "index.sqlite"), check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self.vectors: Optional[VectorFile] = None
+        row = self.db.execute("SELECT dimension FROM models WHERE model = ?", (self.model_name,)).fetchone()
+        if row:
+            self.vectors = self._open(row[0])
+        self.texts = 0
+        self.hits = 0
+        self.requests = 0
+        self.requests_saved = 0
+        logger.info(f"Opened embedding cache {folder} for {self.model_name}")
+
+    def _open(self, dimension: int) -> VectorFile:
+        file_name = re.sub(r"[^A-Za-z0-9_.-]", "_", self.model_name) + ".f32"
+        return VectorFile(os.path.join(self.folder, file_name), dimension)
+
+    def _lookup(self, digests: List[str]) -> Dict[str, List[float]]:
+        found = {}
+        if self.vectors is None:
+            return found
+        for chunk in _chunks(digests, 500):
+            rows = self.db.execute(
+                f"SELECT digest, row FROM vectors WHERE model = ? AND digest IN ({','.join('?' * len(chunk))})",
+                (self.model_name, *chunk))
+            for digest, row in rows:
+                found[digest] = self.vectors.read(row)
+        return found
+
+    def _store(self, digests: List[str], vectors: List[List[float]]) -> None:
+        if self.vectors is None:
+            self.db.execute("INSERT INTO models (model, dimension) VALUES (?, ?)", (self.model_name, len(vectors[0])))
+            self.vectors = self._open(len(vectors[0]))
+        first = self.vectors.append(vectors)
+        self.db.executemany(
+            "INSERT OR REPLACE INTO vectors (model, digest, row) VALUES (?, ?, ?)",
+            [(self.model_name, digest, first + i) for i, digest in enumerate(digests)])
+        self.db.commit()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        digests = [text_digest(text) for text in texts]
+        with self.lock:
+            found = self._lookup(list(set(digests)))
+            # Texts repeated within the call are embedded once
+            missing = {}
+            for digest, text in zip(digests, texts):
+                if digest not in found:
+                    missing.setdefault(digest, text)
+
+            requests = 0
+            for chunk in _chunks(list(missing.items()), self.batch_size):
+                chunk_digests = [digest for digest, _ in chunk]
+                vectors = self.embeddings.embed_documents([text for _, text in chunk])
+                requests += 1
+                self._store(chunk_digests, vectors)
+                # Rounded as they will be read back, so a text's vector is the same every run
+                found.update((digest, array.array("f", vector).tolist()) for digest, vector in zip(chunk_digests, vectors))
+
+            self.texts += len(texts)
+            self.hits += len(texts) - len(missing)
+            self.requests += requests
+            self.requests_saved += -(-len(texts) // self.batch_size) - requests
+        return [list(found[digest]) for digest in digests]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embeddings.embed_query(text)
+
+    def stats(self) -> Dict:
+        return {
+            "texts": self.texts,
+            "hits": self.hits,
+            "hitRate": round(self.hits / self.texts, 3) if self.texts else 0,
+            "embedRequests": self.requests,
+            "embedRequestsSaved": self.requests_saved,
+        }
+
+    def close(self) -> None:
+        if self.vectors is not None:
+            self.vectors.close()
+        self.db.close()
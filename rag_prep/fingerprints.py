@@ -0,0 +1,62 @@
+import os
+import json
+import hashlib
+import logging
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+HASH_CHUNK_BYTES = 1024 * 1024
+
+
+def file_sha256(file_path: str) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK_BYTES):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class FingerprintStore:
+    """Size, mtime and content hash of every file indexed so far, kept in a JSON file.
+
+    A file whose size and mtime are unchanged is not read at all; one that
+    was only touched is hashed and recognised as unchanged."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.fingerprints: Dict[str, Dict] = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.fingerprints = json.load(f)
+            logger.info(f"Loaded {len(self.fingerprints)} fingerprints from {path}")
+
+    def changed(self, file_path: str) -> Optional[Dict]:
+        """Returns the file's new fingerprint if it needs indexing, else None."""
+        stat = os.stat(file_path)
+        known = self.fingerprints.get(file_path)
+        if known and known["size"] == stat.st_size and known["mtime_ns"] == stat.st_mtime_ns:
+            return None
+
+        fingerprint = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": file_sha256(file_path)}
+        if known and known["sha256"] == fingerprint["sha256"]:
+            # Touched but identical; remember the new mtime so it is not hashed again
+            self.fingerprints[file_path] = fingerprint
+            return None
+        return fingerprint
+
+    def removed(self, present: List[str]) -> List[str]:
+        present = set(present)
+        return [file_path for file_path in self.fingerprints if file_path not in present]
+
+    def record(self, file_path: str, fingerprint: Dict) -> None:
+        self.fingerprints[file_path] = fingerprint
+
+    def forget(self, file_path: str) -> None:
+        self.fingerprints.pop(file_path, None)
+
+    def save(self) -> None:
+        temporary_path = f"{self.path}.tmp"
+        with open(temporary_path, "w") as f:
+            json.dump(self.fingerprints, f, indent=1, sort_keys=True)
+        os.replace(temporary_path, self.path)
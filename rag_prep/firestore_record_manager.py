@@ -1,27 +1,187 @@
+import asyncio
 import datetime
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from google.cloud import firestore
-from typing import List, Optional, Sequence, Dict
+from typing import AsyncIterator, Callable, Iterator, List, Optional, Sequence, Dict, Set
 from langchain_core.indexing import RecordManager
 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Firestore's limit on writes in one batch commit
+WRITE_BATCH_LIMIT = 500
+# Documents fetched per get_all call
+GET_ALL_CHUNK = 500
+# Firestore's limit on values in an "in" filter
+IN_FILTER_LIMIT = 30
+# Keys fetched per list_keys round trip
+LIST_PAGE_SIZE = 1000
+
+
+def _chunks(items: Sequence, size: int) -> List[Sequence]:
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
 
 class FirestoreRecordManager(RecordManager):
+    """Record manager on a Firestore collection, one document per key.
+
+    Existence checks for update and delete_keys are batched get_all calls,
+    and writes are split into batches of at most WRITE_BATCH_LIMIT that are
+    committed concurrently, up to `max_concurrency` at a time. With
+    `count_updates=False`, update and delete_keys skip the reads entirely;
+    update reports every key as added and delete_keys every key as deleted.
+    LangChain's index() does not use the counts. `updated_at` on update
+    lets a caller that keeps its own copy of the records (see
+    record_mirror) pick the timestamp that is written.
+
+    The a* methods run the same requests natively on a firestore.AsyncClient,
+    created on first use unless one is passed in, with the same concurrency
+    limit.
+
+    iter_keys and aiter_keys page through matching keys with start_after
+    cursors, fetching only the key field, so listing a large namespace
+    never holds more than a page of documents; list_keys collects them."""
+
     def __init__(
         self,
         namespace: str,
         collection_name: str = "record_manager",
+        client: Optional[firestore.Client] = None,
+        async_client: Optional[firestore.AsyncClient] = None,
+        max_concurrency: int = 8,
+        count_updates: bool = True,
     ) -> None:
         super().__init__(namespace=namespace)
         self.collection_name = collection_name
-        self.db = firestore.Client()
+        self.db = client or firestore.Client()
         self.collection = self.db.collection(self.collection_name)
+        self._async_db = async_client
+        self.max_concurrency = max_concurrency
+        self.count_updates = count_updates
         logger.info(
             f"Initialised FirestoreRecordManager with namespace: {namespace}, collection: {collection_name}")
 
+    @property
+    def async_db(self) -> firestore.AsyncClient:
+        if self._async_db is None:
+            self._async_db = firestore.AsyncClient()
+        return self._async_db
+
+    @property
+    def async_collection(self):
+        return self.async_db.collection(self.collection_name)
+
+    def _record(self, key: str, group_id: Optional[str], updated_at: datetime.datetime) -> Dict:
+        return {
+            "key": key,
+            "namespace": self.namespace,
+            "updated_at": updated_at,
+            "group_id": group_id
+        }
+
+    def _exists_query(self, collection, keys: Sequence[str]):
+        query = collection.where(
+            filter=firestore.FieldFilter("namespace", "==", self.namespace))
+        query = query.where(
+            filter=firestore.FieldFilter("key", "in", list(keys)))
+        return query.select(["key"])
+
+    def _list_queries(
+        self,
+        collection,
+        before: Optional[datetime.datetime],
+        after: Optional[datetime.datetime],
+        group_ids: Optional[Sequence[str]],
+        fields: Sequence[str] = ("key",)
+    ) -> List:
+        """One query per IN_FILTER_LIMIT group ids, or a single one without them."""
+        query = collection.where(
+            filter=firestore.FieldFilter("namespace", "==", self.namespace))
+
+        if after:
+            query = query.where(
+                filter=firestore.FieldFilter("updated_at", ">", after))
+            logger.debug(f"Filtering records after: {after}")
+        if before:
+            query = query.where(filter=firestore.FieldFilter(
+                "updated_at", "<", before))
+            logger.debug(f"Filtering records before: {before}")
+        # Cursors taken from a snapshot need the fields the query is ordered by
+        fields = list(fields)
+        if (before or after) and "updated_at" not in fields:
+            fields.append("updated_at")
+        query = query.select(fields)
+
+        if not group_ids:
+            return [query]
+        logger.debug(f"Filtering by group_ids: {group_ids}")
+        return [
+            query.where(filter=firestore.FieldFilter("group_id", "in", list(batch)))
+            for batch in _chunks(group_ids, IN_FILTER_LIMIT)
+        ]
+
+    def _map(self, func: Callable, chunks: List[Sequence]) -> List:
+        if len(chunks) <= 1:
+            return [func(chunk) for chunk in chunks]
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(chunks))) as pool:
+            return list(pool.map(func, chunks))
+
+    def _existing(self, keys: Sequence[str]) -> Set[str]:
+        def fetch(chunk: Sequence[str]) -> Set[str]:
+            refs = [self.collection.document(key) for key in chunk]
+            return {snapshot.id for snapshot in self.db.get_all(refs, field_paths=["key"]) if snapshot.exists}
+
+        existing = set()
+        for found in self._map(fetch, _chunks(list(dict.fromkeys(keys)), GET_ALL_CHUNK)):
+            existing |= found
+        return existing
+
+    def _commit(self, items: Sequence, write: Callable) -> None:
+        """Commits `write(batch, collection, item)` for every item."""
+        def commit(chunk: Sequence) -> None:
+            batch = self.db.batch()
+            for item in chunk:
+                write(batch, self.collection, item)
+            batch.commit()
+            logger.debug(f"Committed {len(chunk)} writes")
+
+        self._map(commit, _chunks(items, WRITE_BATCH_LIMIT))
+
+    async def _amap(self, func: Callable, chunks: List[Sequence]) -> List:
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def run(chunk: Sequence):
+            async with semaphore:
+                return await func(chunk)
+
+        return await asyncio.gather(*(run(chunk) for chunk in chunks))
+
+    async def _aexisting(self, keys: Sequence[str]) -> Set[str]:
+        async def fetch(chunk: Sequence[str]) -> Set[str]:
+            refs = [self.async_collection.document(key) for key in chunk]
+            return {
+                snapshot.id
+                async for snapshot in self.async_db.get_all(refs, field_paths=["key"])
+                if snapshot.exists
+            }
+
+        existing = set()
+        for found in await self._amap(fetch, _chunks(list(dict.fromkeys(keys)), GET_ALL_CHUNK)):
+            existing |= found
+        return existing
+
+    async def _acommit(self, items: Sequence, write: Callable) -> None:
+        async def commit(chunk: Sequence) -> None:
+            batch = self.async_db.batch()
+            for item in chunk:
+                write(batch, self.async_collection, item)
+            await batch.commit()
+            logger.debug(f"Committed {len(chunk)} writes")
+
+        await self._amap(commit, _chunks(items, WRITE_BATCH_LIMIT))
+
     def create_schema(self) -> None:
         logger.info("Skipping schema creation (Firestore is schemaless)")
         pass
@@ -42,6 +202,7 @@ class FirestoreRecordManager(RecordManager):
         *,
         group_ids: Optional[Sequence[Optional[str]]] = None,
         time_at_least: Optional[float] = None,
+        updated_at: Optional[datetime.datetime] = None,
     ) -> Dict[str, int]:
         if group_ids:
             logger.info(f"Updating all {len(keys)} records")
@@ -50,33 +211,19 @@ class FirestoreRecordManager(RecordManager):
         if group_ids is None:
             group_ids = [None] * len(keys)
 
-        batch = self.db.batch()
-        current_time = self.get_time()
-        num_updated = 0
-        num_added = 0
-
-        for key, group_id in zip(keys, group_ids):
-            doc_ref = self.collection.document(key)
-            doc = doc_ref.get()
-
-            if doc.exists:
-                num_updated += 1
-                if group_id:
-                    logger.info(f"Refreshing timestamp for record: {key}")
-                else:
-                    logger.info(f"Updating existing record: {key}")
-            else:
-                num_added += 1
-                logger.info(f"Adding new record: {key}")
-
-            batch.set(doc_ref, {
-                "key": key,
-                "namespace": self.namespace,
-                "updated_at": current_time,
-                "group_id": group_id
-            }, merge=True)
-
-        batch.commit()
+        current_time = updated_at or self.get_time()
+        if self.count_updates:
+            existing = self._existing(keys)
+            num_updated = sum(1 for key in keys if key in existing)
+        else:
+            num_updated = 0
+        num_added = len(keys) - num_updated
+
+        def write(batch, collection, record) -> None:
+            key, group_id = record
+            batch.set(collection.document(key), self._record(key, group_id, current_time), merge=True)
+
+        self._commit(list(zip(keys, group_ids)), write)
         logger.info(
             f"Update complete. Updated: {num_updated}, Added: {num_added}")
 
@@ -91,35 +238,61 @@ class FirestoreRecordManager(RecordManager):
         *,
         group_ids: Optional[Sequence[Optional[str]]] = None,
         time_at_least: Optional[float] = None,
+        updated_at: Optional[datetime.datetime] = None,
     ) -> Dict[str, int]:
-        logger.info("Calling synchronous update method")
-        return self.update(keys, group_ids=group_ids, time_at_least=time_at_least)
+        logger.info(f"Updating {len(keys)} records")
+        if group_ids is None:
+            group_ids = [None] * len(keys)
+
+        current_time = updated_at or await self.aget_time()
+        if self.count_updates:
+            existing = await self._aexisting(keys)
+            num_updated = sum(1 for key in keys if key in existing)
+        else:
+            num_updated = 0
+        num_added = len(keys) - num_updated
+
+        def write(batch, collection, record) -> None:
+            key, group_id = record
+            batch.set(collection.document(key), self._record(key, group_id, current_time), merge=True)
+
+        await self._acommit(list(zip(keys, group_ids)), write)
+        logger.info(
+            f"Update complete. Updated: {num_updated}, Added: {num_added}")
+
+        return {
+            "num_updated": num_updated,
+            "num_added": num_added
+        }
 
     def exists(self, keys: Sequence[str]) -> List[bool]:
         logger.info(f"Checking existence of {len(keys)} keys")
-        result = [False] * len(keys)
-        key_to_index = {key: i for i, key in enumerate(keys)}
-
-        # Process keys in batches of 30 for Firestore limit
-        for i in range(0, len(keys), 30):
-            batch = keys[i:i+30]
-            query = self.collection.where(
-                filter=firestore.FieldFilter("namespace", "==", self.namespace))
-            query = query.where(
-                filter=firestore.FieldFilter("key", "in", batch))
-            docs = query.get()
 
-            for doc in docs:
-                key = doc.get("key")
-                if key in key_to_index:
-                    result[key_to_index[key]] = True
+        # Keys go in batches of IN_FILTER_LIMIT, queried concurrently
+        def fetch(batch: Sequence[str]) -> Set[str]:
+            return {doc.get("key") for doc in self._exists_query(self.collection, batch).get()}
+
+        found = set()
+        for keys_found in self._map(fetch, _chunks(keys, IN_FILTER_LIMIT)):
+            found |= keys_found
+        result = [key in found for key in keys]
 
         logger.info(f"Existence check complete. Found {sum(result)} records")
         return result
 
     async def aexists(self, keys: Sequence[str]) -> List[bool]:
-        logger.info("Calling synchronous exists method")
-        return self.exists(keys)
+        logger.info(f"Checking existence of {len(keys)} keys")
+
+        async def fetch(batch: Sequence[str]) -> Set[str]:
+            return {doc.get("key") for doc in await self._exists_query(self.async_collection, batch).get()}
+
+        found = set()
+        for keys_found in await self._amap(fetch, _chunks(keys, IN_FILTER_LIMIT)):
+            found |= keys_found
+        result = [key in found for key in keys]
+
+        logger.info(f"Existence check complete. Found {sum(result)} records")
+        return result
 
     def list_keys(
         self,
@@ -130,56 +303,50 @@ class FirestoreRecordManager(RecordManager):
         limit: Optional[int] = None,
     ) -> List[str]:
         logger.info("Listing records with filters")
-
-        all_keys = []
-
-        # If there are group_ids, process them in batches of 30 for Firestore limit
-        if group_ids:
-            for i in range(0, len(group_ids), 30):
-                batch_group_ids = group_ids[i:i+30]
-                keys = self._list_keys_batch(
-                    before, after, batch_group_ids, limit)
-                all_keys.extend(keys)
-                if limit and len(all_keys) >= limit:
-                    all_keys = all_keys[:limit]
-                    break
-        else:
-            all_keys = self._list_keys_batch(before, after, None, limit)
-
+        all_keys = list(self.iter_keys(before=before, after=after, group_ids=group_ids, limit=limit))
         logger.info(f"Listed {len(all_keys)} records")
         return all_keys
 
-    def _list_keys_batch(
+    def iter_keys(
         self,
-        before: Optional[datetime.datetime],
-        after: Optional[datetime.datetime],
-        group_ids: Optional[Sequence[str]],
-        limit: Optional[int]
-    ) -> List[str]:
-        query = self.collection.where(
-            filter=firestore.FieldFilter("namespace", "==", self.namespace))
-
-        if after:
-            query = query.where(
-                filter=firestore.FieldFilter("updated_at", ">", after))
-            logger.debug(f"Filtering records after: {after}")
-        if before:
-            query = query.where(filter=firestore.FieldFilter(
-                "updated_at", "<", before))
-            logger.debug(f"Filtering records before: {before}")
-        if group_ids:
-            query = query.where(filter=firestore.FieldFilter(
-                "group_id", "in", group_ids))
-            logger.debug(f"Filtering by group_ids: {group_ids}")
-
-        if limit:
-            query = query.limit(limit)
-            logger.debug(f"Limiting results to: {limit}")
-
-        docs = query.get()
-        keys = [doc.get("key") for doc in docs]
-        logger.info(f"Listed {len(keys)} records")
-        return keys
+        *,
+        before: Optional[datetime.datetime] = None,
+        after: Optional[datetime.datetime] = None,
+        group_ids: Optional[Sequence[str]] = None,
+        limit: Optional[int] = None,
+        page_size: int = LIST_PAGE_SIZE,
+    ) -> Iterator[str]:
+        """Yields matching keys page by page, `limit` counting across all group batches."""
+        queries = self._list_queries(self.collection, before, after, group_ids)
+        for doc in self._iter_docs(queries, limit, page_size):
+            yield doc.get("key")
+
+    def iter_records(
+        self,
+        *,
+        after: Optional[datetime.datetime] = None,
+        page_size: int = LIST_PAGE_SIZE,
+    ) -> Iterator[Dict]:
+        """Yields key, group_id and updated_at of the records updated after `after`."""
+        queries = self._list_queries(self.collection, None, after, None, fields=("key", "group_id", "updated_at"))
+        for doc in self._iter_docs(queries, None, page_size):
+            yield {field: doc.get(field) for field in ("key", "group_id", "updated_at")}
+
+    def _iter_docs(self, queries: List, limit: Optional[int], page_size: int) -> Iterator:
+        remaining = limit or None
+        for query in queries:
+            cursor = None
+            while remaining is None or remaining > 0:
+                page = query.limit(page_size if remaining is None else min(page_size, remaining))
+                if cursor is not None:
+                    page = page.start_after(cursor)
+                docs = page.get()
+                yield from docs
+                if remaining is not None:
+                    remaining -= len(docs)
+                if len(docs) < page_size:
+                    break
+                cursor = docs[-1]
 
     async def alist_keys(
         self,
@@ -189,28 +356,57 @@ class FirestoreRecordManager(RecordManager):
         group_ids: Optional[Sequence[str]] = None,
         limit: Optional[int] = None,
     ) -> List[str]:
-        logger.info("Calling synchronous list_keys method")
-        return self.list_keys(before=before, after=after, group_ids=group_ids, limit=limit)
+        logger.info("Listing records with filters")
+        all_keys = [key async for key in self.aiter_keys(before=before, after=after, group_ids=group_ids, limit=limit)]
+        logger.info(f"Listed {len(all_keys)} records")
+        return all_keys
+
+    async def aiter_keys(
+        self,
+        *,
+        before: Optional[datetime.datetime] = None,
+        after: Optional[datetime.datetime] = None,
+        group_ids: Optional[Sequence[str]] = None,
+        limit: Optional[int] = None,
+        page_size: int = LIST_PAGE_SIZE,
+    ) -> AsyncIterator[str]:
+        queries = self._list_queries(self.async_collection, before, after, group_ids)
+        async for doc in self._aiter_docs(queries, limit, page_size):
+            yield doc.get("key")
+
+    async def _aiter_docs(self, queries: List, limit: Optional[int], page_size: int) -> AsyncIterator:
+        remaining = limit or None
+        for query in queries:
+            cursor = None
+            while remaining is None or remaining > 0:
+                page = query.limit(page_size if remaining is None else min(page_size, remaining))
+                if cursor is not None:
+                    page = page.start_after(cursor)
+                docs = await page.get()
+                for doc in docs:
+                    yield doc
+                if remaining is not None:
+                    remaining -= len(docs)
+                if len(docs) < page_size:
+                    break
+                cursor = docs[-1]
 
     def delete_keys(self, keys: Sequence[str]) -> Dict[str, int]:
         logger.info(f"Deleting {len(keys)} records")
-        batch = self.db.batch()
-        num_deleted = 0
-
-        for key in keys:
-            doc_ref = self.collection.document(key)
-            doc = doc_ref.get()
+        existing = self._existing(keys) if self.count_updates else set(keys)
+        num_deleted = len(existing)
 
-            if doc.exists:
-                batch.delete(doc_ref)
-                num_deleted += 1
-                logger.info(f"Deleting record: {key}")
-
-        batch.commit()
+        self._commit(sorted(existing), lambda batch, collection, key: batch.delete(collection.document(key)))
         logger.info(f"Deletion complete. Deleted {num_deleted} keys")
 
         return {"num_deleted": num_deleted}
 
     async def adelete_keys(self, keys: Sequence[str]) -> Dict[str, int]:
-        logger.info("Calling synchronous delete_keys method")
-        return self.delete_keys(keys)
+        logger.info(f"Deleting {len(keys)} records")
+        existing = await self._aexisting(keys) if self.count_updates else set(keys)
+        num_deleted = len(existing)
+
+        await self._acommit(sorted(existing), lambda batch, collection, key: batch.delete(collection.document(key)))
+        logger.info(f"Deletion complete. Deleted {num_deleted} keys")
+
+        return {"num_deleted": num_deleted}
@@ -1,34 +1,194 @@
 import os
+import queue
+import logging
+import argparse
+import threading
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from typing import Dict, List, Optional, Tuple
 from langchain.indexes import index
 from langchain_core.documents import Document
+from langchain_core.indexing import RecordManager
 from langchain_google_firestore import FirestoreVectorStore
 from langchain_google_vertexai import VertexAIEmbeddings
 from firestore_record_manager import FirestoreRecordManager
 from langchain_community.document_loaders import UnstructuredPDFLoader
+from fingerprints import FingerprintStore
+from record_mirror import MirroredRecordManager
+from embedding_cache import CachedEmbeddings
+
+logger = logging.getLogger(__name__)
 
 collection_name = "stargate_records"
 namespace = f"firstore/{collection_name}"
-record_manager = FirestoreRecordManager(namespace)
+folder_path = "stargate_documents/"
 
-embedding = VertexAIEmbeddings(model_name="textembedding-gecko@003")
-vectorstore = FirestoreVectorStore(
-    collection=collection_name,
-    embedding_service=embedding
-)
+FINGERPRINT_PATH = os.getenv("FINGERPRINT_PATH", ".ingest_fingerprints.json")
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", str(os.cpu_count() or 1)))
+# Parsed files waiting to be indexed; parsing pauses while this is full
+INDEX_QUEUE_SIZE = int(os.getenv("INDEX_QUEUE_SIZE", "8"))
+INDEX_BATCH_DOCUMENTS = int(os.getenv("INDEX_BATCH_DOCUMENTS", "200"))
+# Local copy of the record manager namespace; empty to always ask Firestore
+RECORD_MIRROR_PATH = os.getenv("RECORD_MIRROR_PATH", ".record_mirror.sqlite")
+# Embeddings of every chunk seen so far; empty to always call Vertex AI
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", ".embedding_cache")
 
-folder_path = "stargate_documents/"
-for filename in os.listdir(folder_path):
-    if filename.endswith(".pdf"):
-        file_path = os.path.join(folder_path, filename)
-        print("Loading: ", file_path)
-        loader = UnstructuredPDFLoader(file_path)
-        docs = loader.load()
-        print(docs[0])
-        
-        index(
-            docs,
-            record_manager,
-            vectorstore,
-            cleanup="incremental",
-            source_id_key="source",
-        )
\ No newline at end of file
+
+def load_pdf(file_path: str) -> List[Document]:
+    return UnstructuredPDFLoader(file_path).load()
+
+
+def scan(folder: str, fingerprints: FingerprintStore) -> Tuple[Dict[str, Dict], List[str], List[str]]:
+    """Splits the folder's PDFs into changed (with new fingerprints), unchanged and removed."""
+    present = sorted(
+        os.path.join(folder, filename)
+        for filename in os.listdir(folder)
+        if filename.endswith(".pdf")
+    )
+    changed = {}
+    unchanged = []
+    for file_path in present:
+        fingerprint = fingerprints.changed(file_path)
+        if fingerprint is None:
+            unchanged.append(file_path)
+        else:
+            changed[file_path] = fingerprint
+    return changed, unchanged, fingerprints.removed(present)
+
+
+def parse_files(changed: Dict[str, Dict], workers: int, parsed: queue.Queue) -> None:
+    """Parses PDFs in a process pool and puts (path, fingerprint, docs) on `parsed`.
+
+    No more files are in flight than there are workers and free queue
+    slots, so a slow indexer holds parsing back instead of filling memory."""
+    pending = {}
+    paths = iter(changed)
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            while True:
+                while len(pending) < workers:
+                    file_path = next(paths, None)
+                    if file_path is None:
+                        break
+                    logger.info(f"Loading: {file_path}")
+                    pending[pool.submit(load_pdf, file_path)] = file_path
+                if not pending:
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    file_path = pending.pop(future)
+                    try:
+                        docs = future.result()
+                    except Exception as e:
+                        logger.error(f"Failed to parse {file_path}, it will be retried next run: {e}")
+                        continue
+                    parsed.put((file_path, changed[file_path], docs))
+    finally:
+        parsed.put(None)
+
+
+def remove_source(source: str, record_manager: RecordManager, vectorstore: FirestoreVectorStore) -> int:
+    keys = record_manager.list_keys(group_ids=[source])
+    if keys:
+        vectorstore.delete(keys)
+        record_manager.delete_keys(keys)
+    return len(keys)
+
+
+def open_record_manager(resync_mirror: bool) -> RecordManager:
+    record_manager = FirestoreRecordManager(namespace)
+    if not RECORD_MIRROR_PATH:
+        return record_manager
+    # This host is the only writer of the namespace, so the mirror only
+    # needs the records written since its last run
+    mirror = MirroredRecordManager(record_manager, RECORD_MIRROR_PATH)
+    mirror.reconcile(full=resync_mirror)
+    return mirror
+
+
+def ingest(folder: str, workers: int, dry_run: bool, resync_mirror: bool = False) -> None:
+    fingerprints = FingerprintStore(FINGERPRINT_PATH)
+    changed, unchanged, removed = scan(folder, fingerprints)
+    new = [file_path for file_path in changed if file_path not in fingerprints.fingerprints]
+    logger.info(
+        f"{len(new)} new, {len(changed) - len(new)} changed, {len(unchanged)} unchanged, {len(removed)} removed")
+
+    if dry_run:
+        for file_path in changed:
+            logger.info(f"Would index ({'new' if file_path in new else 'changed'}): {file_path}")
+        for file_path in removed:
+            logger.info(f"Would remove: {file_path}")
+        return
+    if not changed and not removed:
+        fingerprints.save()
+        if resync_mirror:
+            open_record_manager(resync_mirror)
+        return
+
+    record_manager = open_record_manager(resync_mirror)
+    embedding = VertexAIEmbeddings(model_name="textembedding-gecko@003")
+    if EMBEDDING_CACHE_PATH:
+        embedding = CachedEmbeddings(embedding, EMBEDDING_CACHE_PATH, model_name="textembedding-gecko@003")
+    vectorstore = FirestoreVectorStore(
+        collection=collection_name,
+        embedding_service=embedding
+    )
+
+    for file_path in removed:
+        deleted = remove_source(file_path, record_manager, vectorstore)
+        logger.info(f"Removed {deleted} records for deleted file {file_path}")
+        fingerprints.forget(file_path)
+    fingerprints.save()
+
+    parsed = queue.Queue(maxsize=INDEX_QUEUE_SIZE)
+    parser = threading.Thread(target=parse_files, args=(changed, workers, parsed), daemon=True)
+    parser.start()
+
+    # Small files are indexed together so embedding requests stay full
+    batch_docs: List[Document] = []
+    batch_files: List[Tuple[str, Dict]] = []
+
+    def flush() -> None:
+        if batch_docs:
+            result = index(
+                batch_docs,
+                record_manager,
+                vectorstore,
+                cleanup="incremental",
+                source_id_key="source",
+            )
+            logger.info(f"Indexed {len(batch_files)} files: {result}")
+        for file_path, fingerprint in batch_files:
+            fingerprints.record(file_path, fingerprint)
+        fingerprints.save()
+        batch_docs.clear()
+        batch_files.clear()
+
+    while (item := parsed.get()) is not None:
+        file_path, fingerprint, docs = item
+        if not docs:
+            # Incremental cleanup only sees sources that still have documents
+            remove_source(file_path, record_manager, vectorstore)
+        batch_docs.extend(docs)
+        batch_files.append((file_path, fingerprint))
+        if len(batch_docs) >= INDEX_BATCH_DOCUMENTS:
+            flush()
+    flush()
+    parser.join()
+    if isinstance(embedding, CachedEmbeddings):
+        logger.info(f"Embedding cache: {embedding.stats()}")
+        embedding.close()
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Index the Stargate PDF archive into Firestore")
+    parser.add_argument("--folder", default=folder_path)
+    parser.add_argument("--workers", type=int, default=PARSE_WORKERS, help="PDF parsing processes")
+    parser.add_argument("--dry-run", action="store_true", help="report what would change without indexing")
+    parser.add_argument("--resync-mirror", action="store_true",
+                        help="rebuild the local record mirror from Firestore")
+    args = parser.parse_args(argv)
+    ingest(args.folder, args.workers, args.dry_run, args.resync_mirror)
+
+
+if __name__ == "__main__":
+    main()
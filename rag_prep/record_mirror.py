@@ -0,0 +1,255 @@
+import sqlite3
+import datetime
+import logging
+import threading
+from typing import Dict, Iterator, List, Optional, Sequence
+from langchain_core.indexing import RecordManager
+from firestore_record_manager import FirestoreRecordManager, _chunks
+
+logger = logging.getLogger(__name__)
+
+# Bound parameters per SQLite statement, below the default limit of 999
+SQL_CHUNK = 500
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    group_id TEXT,
+    updated_at INTEGER NOT NULL,
+    PRIMARY KEY (namespace, key)
+);
+CREATE INDEX IF NOT EXISTS records_group ON records (namespace, group_id);
+CREATE INDEX IF NOT EXISTS records_updated ON records (namespace, updated_at);
+CREATE TABLE IF NOT EXISTS watermarks (
+    namespace TEXT PRIMARY KEY,
+    updated_at INTEGER NOT NULL
+);
+"""
+
+
+def to_micros(value: datetime.datetime) -> int:
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    return (value - EPOCH) // datetime.timedelta(microseconds=1)
+
+
+def from_micros(value: int) -> datetime.datetime:
+    return EPOCH + datetime.timedelta(microseconds=value)
+
+
+class MirroredRecordManager(RecordManager):
+    """FirestoreRecordManager with a local SQLite copy of its namespace.
+
+    exists and list_keys are answered from the copy; update and delete_keys
+    write to Firestore first and then to the copy. reconcile(), called on
+    startup, pulls only the records updated after the newest timestamp the
+    copy has seen, so an unchanged namespace costs a single empty query.
+
+    Assumes this process is the only writer of the namespace: deletions
+    by anyone else are not seen until reconcile(full=True)."""
+
+    def __init__(self, manager: FirestoreRecordManager, path: str) -> None:
+        super().__init__(namespace=manager.namespace)
+        self.manager = manager
+        self.path = path
+        # Counting is done against the copy, so Firestore needs no reads
+        self.manager.count_updates = False
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        logger.info(f"Opened record mirror {path} for namespace: {self.namespace}")
+
+    def _watermark(self) -> Optional[int]:
+        row = self.db.execute(
+            "SELECT updated_at FROM watermarks WHERE namespace = ?", (self.namespace,)).fetchone()
+        return row[0] if row else None
+
+    def _advance(self, updated_at: int) -> None:
+        self.db.execute(
+            "INSERT INTO watermarks (namespace, updated_at) VALUES (?, ?) "
+            "ON CONFLICT (namespace) DO UPDATE SET updated_at = MAX(updated_at, excluded.updated_at)",
+            (self.namespace, updated_at))
+
+    def _store(self, rows: List[tuple]) -> None:
+        self.db.executemany(
+            "INSERT OR REPLACE INTO records (namespace, key, group_id, updated_at) VALUES (?, ?, ?, ?)", rows)
+
+    def _existing(self, keys: Sequence[str]) -> set:
+        existing = set()
+        for chunk in _chunks(list(keys), SQL_CHUNK):
+            rows = self.db.execute(
+                f"SELECT key FROM records WHERE namespace = ? AND key IN ({','.join('?' * len(chunk))})",
+                (self.namespace, *chunk))
+            existing.update(key for key, in rows)
+        return existing
+
+    def reconcile(self, full: bool = False) -> int:
+        """Copies records changed in Firestore since the watermark; returns how many."""
+        with self.lock:
+            if full:
+                self.db.execute("DELETE FROM records WHERE namespace = ?", (self.namespace,))
+                self.db.execute("DELETE FROM watermarks WHERE namespace = ?", (self.namespace,))
+            watermark = self._watermark()
+            after = from_micros(watermark) if watermark is not None else None
+
+            count = 0
+            newest = watermark
+            rows = []
+            for record in self.manager.iter_records(after=after):
+                updated_at = to_micros(record["updated_at"])
+                newest = updated_at if newest is None else max(newest, updated_at)
+                rows.append((self.namespace, record["key"], record["group_id"], updated_at))
+                if len(rows) >= SQL_CHUNK:
+                    self._store(rows)
+                    count += len(rows)
+                    rows = []
+            self._store(rows)
+            count += len(rows)
+            if newest is not None:
+                self._advance(newest)
+            self.db.commit()
+
+        logger.info(f"Reconciled record mirror: {count} records changed since {after or 'the start'}")
+        return count
+
+    def close(self) -> None:
+        self.db.close()
+
+    def create_schema(self) -> None:
+        self.manager.create_schema()
+
+    async def acreate_schema(self) -> None:
+        await self.manager.acreate_schema()
+
+    def get_time(self) -> datetime.datetime:
+        return self.manager.get_time()
+
+    async def aget_time(self) -> datetime.datetime:
+        return await self.manager.aget_time()
+
+    def _updated(self, keys: Sequence[str], group_ids: Sequence[Optional[str]], current_time: datetime.datetime) -> Dict[str, int]:
+        updated_at = to_micros(current_time)
+        with self.lock:
+            existing = self._existing(keys)
+            self._store([(self.namespace, key, group_id, updated_at) for key, group_id in zip(keys, group_ids)])
+            self._advance(updated_at)
+            self.db.commit()
+        num_updated = sum(1 for key in keys if key in existing)
+        return {"num_updated": num_updated, "num_added": len(keys) - num_updated}
+
+    def update(
+        self,
+        keys: Sequence[str],
+        *,
+        group_ids: Optional[Sequence[Optional[str]]] = None,
+        time_at_least: Optional[float] = None,
+    ) -> Dict[str, int]:
+        if group_ids is None:
+            group_ids = [None] * len(keys)
+        current_time = self.get_time()
+        self.manager.update(keys, group_ids=group_ids, updated_at=current_time)
+        return self._updated(keys, group_ids, current_time)
+
+    async def aupdate(
+        self,
+        keys: Sequence[str],
+        *,
+        group_ids: Optional[Sequence[Optional[str]]] = None,
+        time_at_least: Optional[float] = None,
+    ) -> Dict[str, int]:
+        if group_ids is None:
+            group_ids = [None] * len(keys)
+        current_time = await self.aget_time()
+        await self.manager.aupdate(keys, group_ids=group_ids, updated_at=current_time)
+        return self._updated(keys, group_ids, current_time)
+
+    def exists(self, keys: Sequence[str]) -> List[bool]:
+        with self.lock:
+            existing = self._existing(keys)
+        return [key in existing for key in keys]
+
+    async def aexists(self, keys: Sequence[str]) -> List[bool]:
+        return self.exists(keys)
+
+    def iter_keys(
+        self,
+        *,
+        before: Optional[datetime.datetime] = None,
+        after: Optional[datetime.datetime] = None,
+        group_ids: Optional[Sequence[str]] = None,
+        limit: Optional[int] = None,
+    ) -> Iterator[str]:
+        conditions = ["namespace = ?"]
+        parameters = [self.namespace]
+        if after:
+            conditions.append("updated_at > ?")
+            parameters.append(to_micros(after))
+        if before:
+            conditions.append("updated_at < ?")
+            parameters.append(to_micros(before))
+        sql = f"SELECT key FROM records WHERE {' AND '.join(conditions)}"
+
+        remaining = limit or None
+        for batch in _chunks(list(group_ids), SQL_CHUNK) if group_ids else [None]:
+            if remaining is not None and remaining <= 0:
+                break
+            batch_sql = sql
+            batch_parameters = list(parameters)
+            if batch:
+                batch_sql += f" AND group_id IN ({','.join('?' * len(batch))})"
+                batch_parameters.extend(batch)
+            if remaining is not None:
+                batch_sql += " LIMIT ?"
+                batch_parameters.append(remaining)
+            with self.lock:
+                rows = self.db.execute(batch_sql, batch_parameters).fetchall()
+            if remaining is not None:
+                remaining -= len(rows)
+            for key, in rows:
+                yield key
+
+    def list_keys(
+        self,
+        *,
+        before: Optional[datetime.datetime] = None,
+        after: Optional[datetime.datetime] = None,
+        group_ids: Optional[Sequence[str]] = None,
+        limit: Optional[int] = None,
+    ) -> List[str]:
+        return list(self.iter_keys(before=before, after=after, group_ids=group_ids, limit=limit))
+
+    async def alist_keys(
+        self,
+        *,
+        before: Optional[datetime.datetime] = None,
+        after: Optional[datetime.datetime] = None,
+        group_ids: Optional[Sequence[str]] = None,
+        limit: Optional[int] = None,
+    ) -> List[str]:
+        return self.list_keys(before=before, after=after, group_ids=group_ids, limit=limit)
+
+    def _deleted(self, keys: Sequence[str]) -> None:
+        with self.lock:
+            for chunk in _chunks(list(keys), SQL_CHUNK):
+                self.db.execute(
+                    f"DELETE FROM records WHERE namespace = ? AND key IN ({','.join('?' * len(chunk))})",
+                    (self.namespace, *chunk))
+            self.db.commit()
+
+    def delete_keys(self, keys: Sequence[str]) -> Dict[str, int]:
+        with self.lock:
+            existing = sorted(self._existing(keys))
+        if existing:
+            self.manager.delete_keys(existing)
+            self._deleted(existing)
+        return {"num_deleted": len(existing)}
+
+    async def adelete_keys(self, keys: Sequence[str]) -> Dict[str, int]:
+        with self.lock:
+            existing = sorted(self._existing(keys))
+        if existing:
+            await self.manager.adelete_keys(existing)
+            self._deleted(existing)
+        return {"num_deleted": len(existing)}
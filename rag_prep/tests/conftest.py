@@ -0,0 +1,7 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The record manager tests run against the in-memory Firestore the
+# benchmarks use
+sys.path[:0] = [ROOT, os.path.join(ROOT, "benchmarks")]
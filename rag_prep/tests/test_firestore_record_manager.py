@@ -0,0 +1,152 @@
+import asyncio
+
+import pytest
+
+from firestore_record_manager import FirestoreRecordManager, GET_ALL_CHUNK, WRITE_BATCH_LIMIT
+from fake_firestore import FakeFirestore, FakeAsyncFirestore
+
+
+def managers(**kwargs):
+    sync_client = FakeFirestore(latency=0)
+    async_store = FakeFirestore(latency=0)
+    sync_manager = FirestoreRecordManager("tests", client=sync_client, **kwargs)
+    async_manager = FirestoreRecordManager(
+        "tests", client=async_store, async_client=FakeAsyncFirestore(async_store), **kwargs)
+    return sync_manager, async_manager
+
+
+def documents(manager):
+    return {
+        doc_id: {field: value for field, value in data.items() if field != "updated_at"}
+        for doc_id, data in manager.db.docs(manager.collection_name).items()
+    }
+
+
+def test_sync_and_async_methods_agree():
+    keys = [f"key-{i:04d}" for i in range(700)]
+    groups = [f"source-{i % 45}" for i in range(len(keys))]
+    probe = keys[::3] + ["missing-1", "missing-2"]
+    some_groups = sorted(set(groups))[:35]
+    sync_manager, async_manager = managers()
+
+    async def run():
+        steps = [
+            (sync_manager.update(keys, group_ids=groups), await async_manager.aupdate(keys, group_ids=groups)),
+            (sync_manager.update(keys[:100]), await async_manager.aupdate(keys[:100])),
+            (sync_manager.exists(probe), await async_manager.aexists(probe)),
+            (sorted(sync_manager.list_keys(group_ids=some_groups)),
+             sorted(await async_manager.alist_keys(group_ids=some_groups))),
+            (sync_manager.delete_keys(probe), await async_manager.adelete_keys(probe)),
+        ]
+        return steps
+
+    for expected, actual in asyncio.run(run()):
+        assert expected == actual
+    assert documents(sync_manager) == documents(async_manager)
+
+
+def test_update_counts_added_and_updated():
+    manager, _ = managers()
+    assert manager.update(["a", "b"]) == {"num_updated": 0, "num_added": 2}
+    assert manager.update(["b", "c"]) == {"num_updated": 1, "num_added": 1}
+    assert manager.exists(["a", "c", "d"]) == [True, True, False]
+
+
+def test_existence_reads_and_writes_are_batched():
+    manager, _ = managers()
+    client = manager.db
+    get_all_sizes = []
+    commit_sizes = []
+    get_all = client.get_all
+    batch = client.batch
+
+    def counting_get_all(refs, field_paths=None):
+        refs = list(refs)
+        get_all_sizes.append(len(refs))
+        return get_all(refs, field_paths=field_paths)
+
+    def counting_batch():
+        created = batch()
+        commit = created.commit
+
+        def counting_commit():
+            commit_sizes.append(len(created.writes))
+            commit()
+        created.commit = counting_commit
+        return created
+
+    client.get_all = counting_get_all
+    client.batch = counting_batch
+
+    keys = [f"key-{i:05d}" for i in range(GET_ALL_CHUNK * 2 + 100)]
+    assert manager.update(keys) == {"num_updated": 0, "num_added": len(keys)}
+    assert sorted(get_all_sizes) == [100, GET_ALL_CHUNK, GET_ALL_CHUNK]
+    assert max(commit_sizes) <= WRITE_BATCH_LIMIT
+    assert sum(commit_sizes) == len(keys)
+
+
+def test_count_updates_false_skips_reads():
+    manager, _ = managers(count_updates=False)
+    manager.update(["a", "b"])
+    reads = manager.db.reads
+    assert manager.update(["a", "c"]) == {"num_updated": 0, "num_added": 2}
+    assert manager.delete_keys(["a", "missing"]) == {"num_deleted": 2}
+    assert manager.db.reads == reads
+    assert manager.exists(["a", "b", "c"]) == [False, True, True]
+
+
+@pytest.mark.parametrize("page_size", [1, 7, 1000])
+def test_iter_keys_pages_through_every_key(page_size):
+    manager, _ = managers()
+    keys = [f"key-{i:03d}" for i in range(50)]
+    manager.update(keys, group_ids=[f"group-{i % 40}" for i in range(len(keys))])
+
+    assert sorted(manager.iter_keys(page_size=page_size)) == keys
+    # More group ids than one "in" filter takes
+    grouped = list(manager.iter_keys(group_ids=[f"group-{i}" for i in range(40)], page_size=page_size))
+    assert sorted(grouped) == keys
+
+
+def test_iter_keys_pages_fetch_a_page_at_a_time():
+    manager, _ = managers()
+    keys = [f"key-{i:03d}" for i in range(25)]
+    manager.update(keys)
+    reads = manager.db.reads
+
+    iterator = manager.iter_keys(page_size=10)
+    assert [next(iterator) for _ in range(10)] == keys[:10]
+    assert manager.db.reads == reads + 1
+    assert list(iterator) == keys[10:]
+    assert manager.db.reads == reads + 3
+
+
+def test_limit_counts_across_group_batches():
+    manager, _ = managers()
+    keys = [f"key-{i:03d}" for i in range(100)]
+    manager.update(keys, group_ids=[f"group-{i % 60}" for i in range(len(keys))])
+    group_ids = [f"group-{i}" for i in range(60)]
+
+    assert len(manager.list_keys(group_ids=group_ids, limit=75)) == 75
+    assert len(list(manager.iter_keys(group_ids=group_ids, limit=7, page_size=3))) == 7
+
+
+def test_aiter_keys_matches_iter_keys():
+    _, manager = managers()
+    keys = [f"key-{i:03d}" for i in range(30)]
+
+    async def run():
+        await manager.aupdate(keys)
+        return [key async for key in manager.aiter_keys(page_size=4)]
+
+    assert asyncio.run(run()) == keys
+
+
+def test_iter_records_after_returns_only_newer_records():
+    manager, _ = managers()
+    manager.update(["old"])
+    cutoff = manager.get_time()
+    manager.update(["new"], updated_at=cutoff.replace(year=cutoff.year + 1))
+
+    records = list(manager.iter_records(after=cutoff))
+    assert [record["key"] for record in records] == ["new"]
+    assert set(records[0]) == {"key", "group_id", "updated_at"}
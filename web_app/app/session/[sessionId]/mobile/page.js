@@ -116,7 +116,7 @@ export default function MobileSessionPage() {
       ws.onopen = () => {
         console.log("Connected to server");
         setWsConnected(true);
-        ws.send(JSON.stringify({ type: "joinSession", sessionId }));
+        ws.send(JSON.stringify({ type: "joinSession", sessionId, imageDelivery: "none" }));
         reconnectAttempts = 0;
       };
 
@@ -126,6 +126,9 @@ export default function MobileSessionPage() {
           case "draw":
             drawReceivedStroke(data);
             break;
+          case "drawBatch":
+            data.segments.forEach(drawReceivedStroke);
+            break;
           case "clear":
             clearCanvas();
             break;
@@ -48,12 +48,32 @@ export default function SessionPage() {
   const [detailsList, setDetailsList] = useState([]);
   const [wsReconnectCount, setWsReconnectCount] = useState(0);
   const [targetImageBase64, setTargetImageBase64] = useState(null);
+  const [targetImageUrl, setTargetImageUrl] = useState(null);
+  const [historyCursor, setHistoryCursor] = useState(null);
   const [targetImages, setTargetImages] = useState([]);
   const [isSessionComplete, setIsSessionComplete] = useState(false);
   const [completionData, setCompletionData] = useState(null);
   const [actualTargetImage, setActualTargetImage] = useState(null);
   const [isAnalysing, setIsAnalysing] = useState(false);
   const [modelledTargetImage, setModelledTargetImage] = useState(null);
+  const [busyNotice, setBusyNotice] = useState(null);
+  const busyNoticeTimeoutRef = useRef(null);
+
+  const showBusyNotice = useCallback((data) => {
+    // The message itself is already in the chat; only the reply was skipped
+    let notice = "MONITOR BUSY - TRANSMISSION LOGGED WITHOUT REPLY";
+    if (data.reason === "superseded") {
+      notice = "MONITOR WILL ANSWER YOUR LATEST TRANSMISSION";
+    } else if (data.requestType === "completeSession") {
+      notice = "MONITOR BUSY - COMPLETE THE SESSION AGAIN SHORTLY";
+      setIsAnalysing(false);
+    }
+    setBusyNotice(notice);
+    clearTimeout(busyNoticeTimeoutRef.current);
+    busyNoticeTimeoutRef.current = setTimeout(() => setBusyNotice(null), 5000);
+  }, []);
+
+  useEffect(() => () => clearTimeout(busyNoticeTimeoutRef.current), []);
 
   const handleCompleteSession = () => {
     setIsAnalysing(true);
@@ -260,13 +280,30 @@ export default function SessionPage() {
       const existingMessageIndex = prevMessages.findIndex(
         (msg) => msg.id === response.id
       );
+      const existingMessage = existingMessageIndex !== -1 ? prevMessages[existingMessageIndex] : null;
+
+      let text = response.text;
+      let seq = existingMessage?.seq;
+      if (response.delta !== undefined) {
+        // Deltas already applied by a resync frame are skipped
+        if (existingMessage?.seq !== undefined && response.seq <= existingMessage.seq) {
+          return prevMessages;
+        }
+        text = (existingMessage?.text || "") + response.delta;
+        seq = response.seq;
+      } else if (response.type === "geminiStreamResync") {
+        seq = response.seq;
+      } else if (text === undefined) {
+        text = existingMessage?.text;
+      }
 
-      if (existingMessageIndex !== -1) {
+      if (existingMessage) {
         const updatedMessages = [...prevMessages];
         updatedMessages[existingMessageIndex] = {
-          ...updatedMessages[existingMessageIndex],
-          text: response.text,
-          timestamp: response.timestamp,
+          ...existingMessage,
+          text,
+          seq,
+          timestamp: response.timestamp ?? existingMessage.timestamp,
         };
         return updatedMessages;
       } else {
@@ -275,7 +312,8 @@ export default function SessionPage() {
           {
             id: response.id,
             user: response.user,
-            text: response.text,
+            text,
+            seq,
             timestamp: response.timestamp,
           },
         ];
@@ -283,6 +321,18 @@ export default function SessionPage() {
     });
   };
 
+  const loadEarlierHistory = useCallback(() => {
+    if (historyCursor && socketRef.current?.readyState === WebSocket.OPEN) {
+      socketRef.current.send(
+        JSON.stringify({
+          type: "fetchHistory",
+          sessionId,
+          before: historyCursor,
+        }),
+      );
+    }
+  }, [historyCursor, sessionId]);
+
   const submitMessage = useCallback(() => {
     if (socketRef.current && socketRef.current.readyState === WebSocket.OPEN) {
       const newMessage = {
@@ -354,7 +404,7 @@ export default function SessionPage() {
     ws.onopen = () => {
       console.log("WebSocket connected");
       setWsConnected(true);
-      ws.send(JSON.stringify({ type: "joinSession", sessionId }));
+      ws.send(JSON.stringify({ type: "joinSession", sessionId, imageDelivery: "url" }));
       setWsReconnectCount(0);
     };
   
@@ -363,6 +413,7 @@ export default function SessionPage() {
       switch (data.type) {
         case "initialHistory":
           setMessages(data.history);
+          setHistoryCursor(data.historyCursor);
           setCurrentStage(data.currentStage);
           if (data.status === 'completed') {
             setIsSessionComplete(true);
@@ -371,6 +422,16 @@ export default function SessionPage() {
             setTargetImageBase64(data.latestTargetImage);
           }
           break;
+        case "historyPage":
+          setMessages((prevMessages) => {
+            const knownIds = new Set(prevMessages.map((msg) => msg.id));
+            return [
+              ...data.messages.filter((msg) => !knownIds.has(msg.id)),
+              ...prevMessages,
+            ];
+          });
+          setHistoryCursor(data.historyCursor);
+          break;
         case "draw":
           drawReceivedStroke(data);
           saveCanvasToFirestore(
@@ -378,6 +439,15 @@ export default function SessionPage() {
             stageRefs.current[data.stageNumber - 1]?.getCanvasData(),
           );
           break;
+        case "drawBatch":
+          data.segments.forEach((segment) =>
+            drawReceivedStroke({ ...segment, stageNumber: data.stageNumber }),
+          );
+          saveCanvasToFirestore(
+            data.stageNumber,
+            stageRefs.current[data.stageNumber - 1]?.getCanvasData(),
+          );
+          break;
         case "clear":
           clearReceivedCanvas(data.stageNumber);
           break;
@@ -389,14 +459,29 @@ export default function SessionPage() {
           updateDetailsList(data.details.details);
           break;
         case "geminiStreamResponse":
+        case "geminiStreamResync":
           handleGeminiStreamResponse(data);
           break;
         case "geminiError":
           console.error("Gemini Error:", data.message);
           break;
+        case "busy":
+          console.warn(`${data.requestType} not run (${data.reason})`);
+          showBusyNotice(data);
+          break;
         case "updateTargetImage":
-          setTargetImageBase64(data.imageBase64);
-          saveTargetImageToStorage(data.imageBase64);
+          if (data.imageUrl) {
+            setTargetImageBase64(null);
+            setTargetImageUrl(data.imageUrl);
+          } else {
+            setTargetImageUrl(null);
+            setTargetImageBase64(data.imageBase64);
+            // A join that could not get a signed URL resends the stored
+            // image; only newly generated ones are saved
+            if (!data.restored) {
+              saveTargetImageToStorage(data.imageBase64);
+            }
+          }
           break;
         case "sessionCompleted":
           setIsSessionComplete(true);
@@ -624,6 +709,9 @@ export default function SessionPage() {
             textareaRef={textareaRef}
             cursorRef={cursorRef}
             handleKeyDown={handleKeyDown}
+            hasMoreHistory={Boolean(historyCursor)}
+            loadEarlierHistory={loadEarlierHistory}
+            notice={busyNotice}
           />
         </div>
         <div className="w-[350px] flex-col text-center">
@@ -669,9 +757,9 @@ export default function SessionPage() {
             <div className="mb-3 p-3 h-[365px] border border-outline border-white rounded items-center text-center">
             <p className="pt-1">Target Modelling</p>
             <div className="flex m-2 p-2 bg-slate-700 space-x-2 mt-5 h-[280px] rounded items-center justify-center" style={{ backgroundColor: "#242526" }}>
-              {targetImageBase64 ? (
+              {targetImageBase64 || targetImageUrl ? (
                 <img 
-                  src={`data:image/jpeg;base64,${targetImageBase64}`} 
+                  src={targetImageUrl || `data:image/jpeg;base64,${targetImageBase64}`} 
                   alt="Target Model" 
                   className="max-w-full max-h-full object-contain"
                 />
@@ -9,6 +9,9 @@ export default function ChatWindow({
   textareaRef,
   cursorRef,
   handleKeyDown,
+  hasMoreHistory,
+  loadEarlierHistory,
+  notice,
 }) {
   const messagesEndRef = useRef(null);
 
@@ -31,11 +34,22 @@ export default function ChatWindow({
     <div className="w-full flex flex-col">
       <div className="h-[635px] relative mb-4">
         <div className="absolute inset-0 overflow-y-auto flex flex-col scanlines bg-green-900 bg-opacity-20 p-4 rounded-lg border-2 border-green-500">
+          {hasMoreHistory && (
+            <button
+              onClick={loadEarlierHistory}
+              className="mb-2 text-green-700 hover:text-green-500 glow"
+            >
+              LOAD EARLIER TRANSMISSIONS
+            </button>
+          )}
           {sortedMessages.map(renderMessage)}
           <div ref={messagesEndRef} />
         </div>
       </div>
 
+      {notice && (
+        <div className="mb-2 text-center text-yellow-400 glow">{notice}</div>
+      )}
       <div className="relative">
         <textarea
           ref={textareaRef}
@@ -0,0 +1,130 @@
+import os
+import time
+import asyncio
+from contextlib import contextmanager
+from collections import OrderedDict, defaultdict
+
+from metrics import Histogram
+
+MODEL_CONCURRENCY = int(os.getenv("MODEL_CONCURRENCY", "8"))
+# "latest": a newer request of the same type replaces a queued one
+# "busy": any request while the session has one running or queued is refused
+# Chat messages are recorded before their reply is queued, so either way
+# only the reply is skipped, never the message
+ADMISSION_POLICY = os.getenv("ADMISSION_POLICY", "latest")
+
+
+class ModelRequest:
+    def __init__(self, session_id: str, kind: str, run, reject):
+        self.session_id = session_id
+        self.kind = kind
+        self.run = run
+        self.reject = reject
+        self.submitted = time.perf_counter()
+
+
+class ModelScheduler:
+    """Admits model-bound requests: chat replies, sketches and completions.
+
+    Each session runs one request at a time and holds at most one more
+    waiting, and no more than `max_concurrent` run across all sessions.
+    Waiting requests are started in the order their sessions queued, so a
+    busy session cannot starve the others. `run` is a coroutine function,
+    `reject` an async callback taking the reason a request was refused.
+
+    Model calls made for work already admitted, such as detail extraction
+    and rolling summaries, go through `background()`. They start at once,
+    since the request waiting on them may hold the last slot, but count
+    against `max_concurrent` so no new request is admitted until they end."""
+
+    def __init__(self, max_concurrent: int = MODEL_CONCURRENCY, policy: str = ADMISSION_POLICY):
+        self.max_concurrent = max_concurrent
+        self.policy = policy
+        self._running = {}
+        self._waiting = OrderedDict()
+        self._tasks = set()
+        self._background = 0
+        self.counters = {"admitted": 0, "rejected": 0, "superseded": 0, "failed": 0}
+        self.background_calls = defaultdict(int)
+        self.wait_ms = defaultdict(Histogram)
+
+    def submit(self, session_id: str, kind: str, run, reject) -> bool:
+        request = ModelRequest(session_id, kind, run, reject)
+        waiting = self._waiting.get(session_id)
+        busy = session_id in self._running or waiting is not None
+        if busy and self.policy == "busy":
+            self._refuse(request, "sessionBusy")
+            return False
+        if waiting is not None:
+            if waiting.kind != kind:
+                self._refuse(request, "sessionBusy")
+                return False
+            # Latest wins; the session keeps its place in the queue
+            self._waiting[session_id] = request
+            self.counters["superseded"] += 1
+            self._refuse(waiting, "superseded")
+        else:
+            self._waiting[session_id] = request
+        self._dispatch()
+        return True
+
+    def _refuse(self, request: ModelRequest, reason: str):
+        self.counters["rejected"] += 1
+        self._spawn(request.reject(reason))
+
+    def _spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    @contextmanager
+    def background(self, kind: str):
+        self._background += 1
+        self.background_calls[kind] += 1
+        try:
+            yield
+        finally:
+            self._background -= 1
+            self._dispatch()
+
+    def _dispatch(self):
+        for session_id in list(self._waiting):
+            if len(self._running) + self._background >= self.max_concurrent:
+                break
+            if session_id in self._running:
+                continue
+            request = self._waiting.pop(session_id)
+            self._running[session_id] = request
+            self.counters["admitted"] += 1
+            self.wait_ms[request.kind].observe((time.perf_counter() - request.submitted) * 1000)
+            self._spawn(self._run(request))
+
+    async def _run(self, request: ModelRequest):
+        try:
+            await request.run()
+        except Exception as e:
+            self.counters["failed"] += 1
+            print(f"{request.kind} failed for session {request.session_id}: {e}")
+        finally:
+            del self._running[request.session_id]
+            self._dispatch()
+
+    async def stop(self):
+        self._waiting.clear()
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "running": len(self._running),
+            "background": self._background,
+            "backgroundCalls": dict(self.background_calls),
+            "queueDepth": len(self._waiting),
+            "waitMs": {kind: histogram.summary() for kind, histogram in self.wait_ms.items()},
+        }
+
+
+model_scheduler = ModelScheduler()
@@ -1,19 +1,58 @@
 import os
-import json
+from functools import partial
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_google_firestore import FirestoreChatMessageHistory
 import vertexai
 from vertexai.preview.vision_models import ImageGenerationModel
 
-from session_management import handle_session_join, broadcast_to_session, update_stage, connected_clients
-from chat_management import process_chat, process_sketch_and_chat, complete_session
-
 load_dotenv()
 
-app = FastAPI()
+from session_management import (
+    handle_session_join, handle_fetch_history, handle_fetch_sketch, broadcast_to_session, update_stage,
+    register_client, unregister_client, join_payload_bytes, fanout_stats,
+    start_session_bus, session_bus, on_session_event, notify_session_event
+)
+from chat_management import queue_chat, complete_session, push_target_image
+from streaming import resync_client
+from history_cache import history_cache
+from metrics import snapshot_timings
+from clients import clients
+from target_pool import target_pool
+from draw_pipeline import draw_pipeline
+from session_state import session_state
+from sketches import sketch_store
+from details import detail_extractor
+from prompt_builder import snapshot_prompt_tokens
+from codec import negotiate, socket_codecs, send_message
+from admission import model_scheduler
+from image_jobs import ImageJobQueue, ImagenBackend, FakeImageBackend, IMAGE_BACKEND
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    clients.open()
+    # Other nodes drop their cached copy once our write-through lands
+    on_session_event("historyChanged", history_cache.invalidate)
+    history_cache.on_written = lambda session_id: notify_session_event(session_id, "historyChanged")
+    on_session_event("sessionStateChanged", session_state.invalidate)
+    session_state.on_written = lambda session_id: notify_session_event(session_id, "sessionStateChanged")
+    await start_session_bus()
+    image_jobs.start()
+    target_pool.start()
+    draw_pipeline.start()
+    yield
+    await model_scheduler.stop()
+    await draw_pipeline.stop()
+    await target_pool.stop()
+    await image_jobs.stop()
+    await history_cache.flush_all()
+    await session_state.flush_all()
+    await session_bus.stop()
+    await clients.close()
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -25,80 +64,121 @@ app.add_middleware(
 
 llm = ChatGoogleGenerativeAI(model="gemini-1.5-pro")
 
-vertexai.init(project=os.getenv("GOOGLE_CLOUD_PROJECT"), location="us-central1")
-imagen_model = ImageGenerationModel.from_pretrained("imagegeneration@005")
+if IMAGE_BACKEND == "fake":
+    image_backend = FakeImageBackend()
+else:
+    vertexai.init(project=os.getenv("GOOGLE_CLOUD_PROJECT"), location="us-central1")
+    image_backend = ImagenBackend(ImageGenerationModel.from_pretrained("imagegeneration@005"))
+
+image_jobs = ImageJobQueue(image_backend, on_complete=push_target_image)
 
-chat_events = ["joinSession", "chatOnly", "sketchAndChat", "completeSession"]
+chat_events = ["chatOnly", "sketchAndChat", "completeSession"]
+
+@app.get("/metrics")
+async def metrics():
+    return {
+        "historyCache": history_cache.stats(),
+        "stageTimings": snapshot_timings(),
+        "imageJobs": image_jobs.stats(),
+        "targetPool": target_pool.stats(),
+        "joinPayloadBytes": {mode: histogram.summary() for mode, histogram in join_payload_bytes.items()},
+        "fanout": fanout_stats(),
+        "draw": draw_pipeline.stats(),
+        "sessionState": session_state.stats(),
+        "sketches": sketch_store.stats(),
+        "details": detail_extractor.stats(),
+        "promptTokens": snapshot_prompt_tokens(),
+        "admission": model_scheduler.stats()
+    }
+
+def busy_reply(websocket: WebSocket, data: dict):
+    async def reject(reason: str):
+        try:
+            await send_message(websocket, {
+                "type": "busy",
+                "requestType": data["type"],
+                "id": data.get("id"),
+                "reason": reason
+            })
+        except Exception:
+            pass
+    return reject
+
+async def finish_session(websocket: WebSocket, session_id: str, chat_history):
+    try:
+        completion_data = await complete_session(session_id, chat_history, llm)
+        await broadcast_to_session(session_id, {
+            "type": "sessionCompleted",
+            "targetImagePath": completion_data['targetImagePath'],
+            "modelledImagePath": completion_data['modelledImagePath'],
+            "summary": completion_data['summary'],
+            "details": completion_data['details']
+        })
+    except Exception as e:
+        print("Failed to complete, error: ", e)
+        await send_message(websocket, {
+            "type": "error",
+            "message": f"Failed to complete session: {str(e)}"
+        })
 
 @app.websocket("/session")
 async def websocket_endpoint(websocket: WebSocket):
-    await websocket.accept()
+    codec, subprotocol = negotiate(websocket)
+    socket_codecs[websocket] = codec
+    await websocket.accept(subprotocol=subprotocol)
     session_id = None
     try:
         while True:
-            data = await websocket.receive_text()
-            data = json.loads(data)
+            data = await codec.receive(websocket)
             session_id = data.get("sessionId")
 
             if session_id is None:
                 await websocket.close(code=1008, reason="Session ID is required")
                 return
 
-            if session_id not in connected_clients:
-                connected_clients[session_id] = {
-                    "clients": set(),
-                    "stage": 1
-                }
-            connected_clients[session_id]["clients"].add(websocket)
+            await register_client(session_id, websocket)
 
             chat_history = []
             if data["type"] in chat_events:
-                chat_history = FirestoreChatMessageHistory(
-                    session_id=session_id, collection="RVSessionChats"
-                )
+                chat_history = await history_cache.get(session_id)
 
             match data["type"]:
                 case "joinSession":
-                    await handle_session_join(chat_history, websocket, session_id)
+                    await handle_session_join(websocket, session_id, data.get("imageDelivery", "inline"))
+                    await resync_client(session_id, websocket)
+                case "fetchHistory":
+                    await handle_fetch_history(websocket, session_id, data.get("before"), data.get("limit"))
+                case "fetchSketch":
+                    await handle_fetch_sketch(websocket, data.get("hash"))
                 case "draw":
-                    current_stage = connected_clients[session_id]["stage"]
-                    data["stageNumber"] = current_stage
-                    await broadcast_to_session(session_id, data, exclude=websocket)
+                    draw_pipeline.submit(session_id, websocket, data)
                 case "clear":
+                    await draw_pipeline.flush_session(session_id)
                     await broadcast_to_session(session_id, {"type": "clear"})
                 case "syncStage":
+                    await draw_pipeline.flush_session(session_id)
                     await update_stage(session_id, data["stageNumber"])
-                case "chatOnly":
-                    await process_chat(data, session_id, chat_history, websocket, llm)
-                case "sketchAndChat":
-                    await process_sketch_and_chat(data, session_id, chat_history, websocket, llm, imagen_model)
+                # Model calls run once the scheduler admits them, so this
+                # socket keeps receiving draw traffic meanwhile
+                case "chatOnly" | "sketchAndChat":
+                    await queue_chat(data, session_id, chat_history, websocket, llm, image_jobs, busy_reply(websocket, data))
                 case "completeSession":
                     print("COMPLETE received")
-                    try:
-                        completion_data = await complete_session(session_id, chat_history, llm)
-                        await broadcast_to_session(session_id, {
-                            "type": "sessionCompleted",
-                            "targetImagePath": completion_data['targetImagePath'],
-                            "modelledImagePath": completion_data['modelledImagePath'],
-                            "summary": completion_data['summary'],
-                            "details": completion_data['details']
-                        })
-                    except Exception as e:
-                        print("Failed to complete, error: ", e)
-                        await websocket.send_text(json.dumps({
-                            "type": "error",
-                            "message": f"Failed to complete session: {str(e)}"
-                        }))
+                    image_jobs.cancel(session_id)
+                    model_scheduler.submit(
+                        session_id, "completeSession",
+                        partial(finish_session, websocket, session_id, chat_history),
+                        busy_reply(websocket, data)
+                    )
     except WebSocketDisconnect:
         print("WebSocket disconnected")
     except Exception as error:
         print(f"Error in WebSocket connection: {str(error)}")
-        await websocket.send_text(json.dumps({"type": "error", "message": str(error)}))
+        await send_message(websocket, {"type": "error", "message": str(error)})
     finally:
-        if session_id and session_id in connected_clients:
-            connected_clients[session_id]["clients"].remove(websocket)
-            if not connected_clients[session_id]["clients"]:
-                del connected_clients[session_id]
+        if session_id:
+            await unregister_client(session_id, websocket)
+        socket_codecs.pop(websocket, None)
 
 if __name__ == "__main__":
     import uvicorn
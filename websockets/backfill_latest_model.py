@@ -0,0 +1,61 @@
+"""Records latestModelImagePath on sessions modelled before it was tracked.
+
+Lists each session's targetModels once and stores the newest image path on
+the session document, so joins and completions stop listing blobs.
+
+    poetry run python backfill_latest_model.py [--dry-run] [--session SESSION_ID ...]
+"""
+import argparse
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from clients import clients  # noqa: E402
+from session_management import find_latest_model_image  # noqa: E402
+
+
+def backfill(session_ids=None, dry_run=False):
+    collection = clients.firestore.collection('sessions')
+    if session_ids:
+        snapshots = [collection.document(session_id).get() for session_id in session_ids]
+    else:
+        snapshots = collection.stream()
+
+    counts = {"checked": 0, "updated": 0, "skipped": 0, "empty": 0}
+    for snapshot in snapshots:
+        if not snapshot.exists:
+            continue
+        counts["checked"] += 1
+        session_data = snapshot.to_dict()
+        if session_data.get('latestModelImagePath'):
+            counts["skipped"] += 1
+            continue
+
+        image_path = find_latest_model_image(snapshot.id, session_data)
+        if not image_path:
+            counts["empty"] += 1
+            continue
+
+        print(f"{snapshot.id}: {image_path}{' (dry run)' if dry_run else ''}")
+        if not dry_run:
+            snapshot.reference.update({'latestModelImagePath': image_path})
+        counts["updated"] += 1
+
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dry-run", action="store_true", help="report changes without writing them")
+    parser.add_argument("--session", dest="session_ids", nargs="+", help="only backfill these sessions")
+    args = parser.parse_args()
+
+    clients.open()
+    counts = backfill(args.session_ids, args.dry_run)
+    print(f"Checked {counts['checked']} sessions: {counts['updated']} "
+          f"{'to update' if args.dry_run else 'updated'}, {counts['skipped']} already set, "
+          f"{counts['empty']} without model images")
+
+
+if __name__ == "__main__":
+    main()
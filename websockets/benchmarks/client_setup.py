@@ -0,0 +1,71 @@
+"""Per-request cost of building Google Cloud clients versus sharing them.
+
+Replays the cloud calls of the join flow (session document read, target
+model listing) and the sketch flow (model upload, session update) with
+clients built per request, as the handlers used to, and with the shared
+`clients` registry. Point it at a scratch project or at the emulators
+(FIRESTORE_EMULATOR_HOST / STORAGE_EMULATOR_HOST) and a test bucket.
+
+    STORAGE_BUCKET=my-test-bucket poetry run python benchmarks/client_setup.py -n 20
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from google.cloud import storage  # noqa: E402
+from google.cloud import firestore  # noqa: E402
+from clients import clients  # noqa: E402
+
+SESSION_ID = "benchmark-client-setup"
+
+
+def join_flow(db, storage_client):
+    db.collection('sessions').document(SESSION_ID).get()
+    bucket = storage_client.bucket(os.getenv("STORAGE_BUCKET"))
+    list(bucket.list_blobs(prefix=f'sessions/{SESSION_ID}/targetModels', max_results=10))
+
+
+def sketch_flow(db, storage_client):
+    bucket = storage_client.bucket(os.getenv("STORAGE_BUCKET"))
+    bucket.blob(f'sessions/{SESSION_ID}/targetModels/benchmark.jpg').upload_from_string(
+        b"\xff\xd8" + b"\x00" * 1024, content_type='image/jpeg'
+    )
+    db.collection('sessions').document(SESSION_ID).set({'targetImages': []}, merge=True)
+
+
+def time_flow(flow, per_request: bool, iterations: int):
+    samples = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        if per_request:
+            flow(firestore.Client(), storage.Client())
+        else:
+            flow(clients.firestore, clients.storage)
+        samples.append((time.perf_counter() - started) * 1000)
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", "--iterations", type=int, default=20)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    clients.open()
+    print(f"shared registry open: {(time.perf_counter() - started) * 1000:.0f}ms (once per process)")
+
+    print(f"{'flow':<8}{'clients':<13}{'p50 ms':>9}{'max ms':>9}")
+    for name, flow in (("join", join_flow), ("sketch", sketch_flow)):
+        # Warm the shared clients so their first-call setup is not counted per request
+        flow(clients.firestore, clients.storage)
+        for label, per_request in (("per-request", True), ("shared", False)):
+            samples = time_flow(flow, per_request, args.iterations)
+            print(f"{name:<8}{label:<13}{statistics.median(samples):>9.1f}{max(samples):>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""Encode/decode cost and size of /session frames per wire codec.
+
+Runs a message mix through stdlib json, orjson and MessagePack (with image
+fields as raw bytes), whichever are installed. The mix is either a recording,
+one JSON frame per line as captured from a browser's websocket inspector,
+or a synthetic session shaped like one: mostly stream deltas and draw
+batches, with occasional sketches, target images and a join.
+
+    poetry run python benchmarks/codec_mix.py --recording frames.jsonl
+"""
+import os
+import sys
+import json
+import time
+import base64
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import codec  # noqa: E402
+
+
+def synthetic_mix(count: int, sketch_bytes: int, image_bytes: int, seed: int = 0):
+    rng = random.Random(seed)
+    sketch = "data:image/png;base64," + base64.b64encode(rng.randbytes(sketch_bytes)).decode()
+    image = base64.b64encode(rng.randbytes(image_bytes)).decode()
+    history = [
+        {"seq": i, "id": f"message-{i}", "user": "Monitor" if i % 2 else "Viewer",
+         "text": "Describe the texture of the curved lines. " * 4, "timestamp": "2024-08-01T12:00:00"}
+        for i in range(50)
+    ]
+    kinds = [
+        ("delta", 70), ("drawBatch", 20), ("chat", 6), ("sketch", 2), ("image", 1), ("join", 1),
+    ]
+    frames = []
+    for i in range(count):
+        kind = rng.choices([k for k, _ in kinds], [w for _, w in kinds])[0]
+        if kind == "delta":
+            frames.append({"type": "geminiStreamResponse", "id": "reply", "seq": i, "delta": "the viewer notes ",
+                           "user": "Monitor", "isComplete": False, "stageNumber": 2})
+        elif kind == "drawBatch":
+            frames.append({"type": "drawBatch", "stageNumber": 2, "segments": [
+                {"x0": rng.random(), "y0": rng.random(), "x1": rng.random(), "y1": rng.random(),
+                 "color": "#00ff00", "lineWidth": 2} for _ in range(rng.randint(1, 40))
+            ]})
+        elif kind == "chat":
+            frames.append({"type": "chatOnly", "sessionId": "session", "id": f"chat-{i}", "user": "Viewer",
+                           "message": "I sense a tall structure near water", "stageNumber": 2})
+        elif kind == "sketch":
+            frames.append({"type": "sketchAndChat", "sessionId": "session", "id": f"sketch-{i}", "user": "Viewer",
+                           "message": "Here is the outline", "sketch": sketch, "stageNumber": 2})
+        elif kind == "image":
+            frames.append({"type": "updateTargetImage", "imageBase64": image, "stageNumber": 2})
+        else:
+            frames.append({"type": "initialHistory", "history": history, "historyCursor": 12, "currentStage": 2,
+                           "status": "incomplete", "detailsList": [], "latestTargetImage": image,
+                           "completionData": None})
+    return frames
+
+
+def load_recording(path: str):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def measure(name, encode, decode, frames, rounds):
+    encoded = [encode(frame) for frame in frames]
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for frame in frames:
+            encode(frame)
+    encode_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for data in encoded:
+            decode(data)
+    decode_seconds = time.perf_counter() - started
+    total = len(frames) * rounds
+    size = sum(len(data) for data in encoded)
+    print(f"{name:<8} encode={encode_seconds / total * 1e6:8.1f}us decode={decode_seconds / total * 1e6:8.1f}us "
+          f"bytes={size:>11,} ({size / len(frames):,.0f}/frame)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--recording", help="JSON lines file of recorded frames")
+    parser.add_argument("--frames", type=int, default=2000)
+    parser.add_argument("--sketch-bytes", type=int, default=120 * 1024)
+    parser.add_argument("--image-bytes", type=int, default=300 * 1024)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.recording:
+        frames = load_recording(args.recording)
+    else:
+        frames = synthetic_mix(args.frames, args.sketch_bytes, args.image_bytes)
+    print(f"{len(frames)} frames, {args.rounds} rounds")
+
+    measure("json", json.dumps, json.loads, frames, args.rounds)
+    if codec.orjson is not None:
+        measure("orjson", codec.dumps, codec.loads, frames, args.rounds)
+    else:
+        print("orjson   not installed")
+    try:
+        msgpack_codec = codec.MsgpackCodec()
+    except ImportError:
+        print("msgpack  not installed")
+    else:
+        measure("msgpack", msgpack_codec.encode, msgpack_codec.msgpack.unpackb, frames, args.rounds)
+
+
+if __name__ == "__main__":
+    main()
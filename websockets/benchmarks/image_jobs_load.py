@@ -0,0 +1,70 @@
+"""Offline load test for the target image job queue.
+
+Each simulated session submits a burst of sketches faster than the fake
+backend can generate, as a viewer hammering send would. Reports how many
+generations actually ran, how many were coalesced away and how long the
+latest sketch of each session waited for its pushed image.
+
+    poetry run python benchmarks/image_jobs_load.py --sessions 50 --burst 5
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from image_jobs import ImageJob, ImageJobQueue, FakeImageBackend  # noqa: E402
+
+
+async def run(sessions: int, burst: int, interval: float, workers: int, backend: FakeImageBackend):
+    last_submit = {}
+    last_push = {}
+
+    async def on_complete(session_id, image_bytes, image_path):
+        last_push[session_id] = time.perf_counter()
+
+    queue = ImageJobQueue(backend, on_complete=on_complete, workers=workers)
+    queue.start()
+
+    async def viewer(session_id):
+        for i in range(burst):
+            last_submit[session_id] = time.perf_counter()
+            queue.submit(ImageJob(session_id, [f"detail{i}"], [f"message {i}"]))
+            await asyncio.sleep(interval)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(viewer(f"session-{i}") for i in range(sessions)))
+    while queue.stats()["pending"] or queue.stats()["running"]:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - started
+    await queue.stop()
+    latencies = [last_push[session_id] - submitted for session_id, submitted in last_submit.items()]
+    return queue.stats(), latencies, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sessions", type=int, default=50)
+    parser.add_argument("--burst", type=int, default=5)
+    parser.add_argument("--interval", type=float, default=0.05)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--generate-seconds", type=float, default=0.5)
+    parser.add_argument("--store-seconds", type=float, default=0.05)
+    args = parser.parse_args()
+
+    backend = FakeImageBackend(args.generate_seconds, args.store_seconds)
+    stats, latencies, elapsed = asyncio.run(
+        run(args.sessions, args.burst, args.interval, args.workers, backend)
+    )
+    print(f"submitted={stats['submitted']} generated={backend.generated} coalesced={stats['coalesced']} "
+          f"failed={stats['failed']} elapsed={elapsed:.2f}s")
+    print(f"latest-sketch-to-push p50={statistics.median(latencies) * 1000:.0f}ms "
+          f"max={max(latencies) * 1000:.0f}ms")
+    print(f"queue wait {stats['waitMs']}")
+
+
+if __name__ == "__main__":
+    main()
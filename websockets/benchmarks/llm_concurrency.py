@@ -0,0 +1,118 @@
+"""Concurrency benchmark for the Gemini streaming path.
+
+Runs N simultaneous sessions against a fake streaming LLM and reports event
+loop lag and per-session time-to-first-token (TTFT). The "blocking" mode
+iterates `llm.stream` directly inside the coroutine, which is what the chat
+handlers used to do; "executor" and "native" go through `llm_async`.
+
+    poetry run python benchmarks/llm_concurrency.py --sessions 1 4 16 32
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llm_async import astream_llm  # noqa: E402
+
+
+class FakeChunk:
+    def __init__(self, content):
+        self.content = content
+
+
+class FakeStreamingLLM:
+    """Sync-only client: `llm_async` has to fall back to the executor."""
+
+    def __init__(self, tokens=40, first_token_delay=0.2, token_delay=0.01):
+        self.tokens = tokens
+        self.first_token_delay = first_token_delay
+        self.token_delay = token_delay
+
+    def stream(self, messages):
+        time.sleep(self.first_token_delay)
+        for i in range(self.tokens):
+            if i:
+                time.sleep(self.token_delay)
+            yield FakeChunk(f"token{i} ")
+
+    def invoke(self, messages):
+        return FakeChunk("".join(chunk.content for chunk in self.stream(messages)))
+
+
+class FakeAsyncStreamingLLM(FakeStreamingLLM):
+    """Client with native async streaming."""
+
+    async def astream(self, messages):
+        await asyncio.sleep(self.first_token_delay)
+        for i in range(self.tokens):
+            if i:
+                await asyncio.sleep(self.token_delay)
+            yield FakeChunk(f"token{i} ")
+
+    async def ainvoke(self, messages):
+        return FakeChunk("".join([chunk.content async for chunk in self.astream(messages)]))
+
+
+async def blocking_stream(llm, messages):
+    for chunk in llm.stream(messages):
+        yield chunk
+
+
+async def monitor_lag(stop: asyncio.Event, samples: list, interval=0.005):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        started = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(loop.time() - started - interval)
+
+
+async def run_session(stream_factory, llm, started):
+    ttft = None
+    async for _ in stream_factory(llm, []):
+        if ttft is None:
+            ttft = time.perf_counter() - started
+        await asyncio.sleep(0)
+    return ttft, time.perf_counter() - started
+
+
+async def run(mode: str, sessions: int, llm):
+    stream_factory = blocking_stream if mode == "blocking" else astream_llm
+    stop = asyncio.Event()
+    lag = []
+    monitor = asyncio.create_task(monitor_lag(stop, lag))
+    await asyncio.sleep(0)
+    started = time.perf_counter()
+    results = await asyncio.gather(*(run_session(stream_factory, llm, started) for _ in range(sessions)))
+    stop.set()
+    await monitor
+    ttfts = [ttft for ttft, _ in results]
+    return {
+        "ttft_p50": statistics.median(ttfts),
+        "ttft_max": max(ttfts),
+        "total_max": max(total for _, total in results),
+        "lag_max": max(lag) if lag else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sessions", type=int, nargs="+", default=[1, 4, 16, 32])
+    parser.add_argument("--modes", nargs="+", default=["blocking", "executor", "native"])
+    parser.add_argument("--tokens", type=int, default=40)
+    args = parser.parse_args()
+
+    print(f"{'mode':<10}{'N':>5}{'ttft p50 ms':>14}{'ttft max ms':>14}{'total max ms':>15}{'loop lag max ms':>18}")
+    for mode in args.modes:
+        llm_class = FakeAsyncStreamingLLM if mode == "native" else FakeStreamingLLM
+        for n in args.sessions:
+            stats = asyncio.run(run(mode, n, llm_class(tokens=args.tokens)))
+            print(f"{mode:<10}{n:>5}{stats['ttft_p50'] * 1000:>14.1f}{stats['ttft_max'] * 1000:>14.1f}"
+                  f"{stats['total_max'] * 1000:>15.1f}{stats['lag_max'] * 1000:>18.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""Cross-process fan-out latency through the session bus.
+
+Starts a local broker, then for each worker count W spawns W processes that
+each join one session with a set of fake clients, as separate uvicorn workers
+would. A publisher process broadcasts timestamped frames and every worker
+records how long each frame took to reach its clients.
+
+    poetry run python benchmarks/session_bus_fanout.py --workers 1 2 4 8
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import statistics
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from session_bus import NetworkSessionBus, LocalBroker, serve_local_broker  # noqa: E402
+
+SESSION_ID = "bench-session"
+
+
+def worker(address, clients, messages, ready, results):
+    async def run():
+        latencies = []
+        done = asyncio.Event()
+        inboxes = [[] for _ in range(clients)]
+
+        def deliver(session_id, payload, exclude):
+            for inbox in inboxes:
+                inbox.append(payload)
+            frame = json.loads(payload)
+            latencies.append((time.time() - frame["sentAt"]) * 1000)
+            if len(latencies) == messages:
+                done.set()
+
+        bus = NetworkSessionBus(LocalBroker(address))
+        await bus.start(deliver, lambda *args: None, lambda *args: None)
+        await bus.join(SESSION_ID)
+        # A round trip through the broker guarantees the subscription landed
+        await bus.broker.get("ready")
+        ready.release()
+        await done.wait()
+        await bus.stop()
+        results.put(latencies)
+
+    asyncio.run(run())
+
+
+def publisher(address, messages, interval, size):
+    async def run():
+        bus = NetworkSessionBus(LocalBroker(address))
+        await bus.start(lambda *args: None, lambda *args: None, lambda *args: None)
+        padding = "x" * size
+        for seq in range(messages):
+            payload = json.dumps({"type": "geminiStreamResponse", "seq": seq, "sentAt": time.time(), "delta": padding})
+            await bus.publish(SESSION_ID, payload)
+            await asyncio.sleep(interval)
+        await bus.stop()
+
+    asyncio.run(run())
+
+
+def broker(address, ready):
+    async def run():
+        server = await serve_local_broker(address)
+        ready.release()
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(run())
+
+
+def run_round(address, workers, clients, messages, interval, size):
+    ready = multiprocessing.Semaphore(0)
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(target=worker, args=(address, clients, messages, ready, results))
+        for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    for _ in processes:
+        ready.acquire()
+
+    started = time.perf_counter()
+    publisher(address, messages, interval, size)
+    latencies = []
+    for _ in processes:
+        latencies.extend(results.get())
+    elapsed = time.perf_counter() - started
+    for process in processes:
+        process.join()
+    return sorted(latencies), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--clients", type=int, default=10, help="fake clients per worker")
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--interval", type=float, default=0.002)
+    parser.add_argument("--size", type=int, default=64, help="delta bytes per frame")
+    parser.add_argument("--address", default="127.0.0.1:7399")
+    args = parser.parse_args()
+
+    ready = multiprocessing.Semaphore(0)
+    broker_process = multiprocessing.Process(target=broker, args=(args.address, ready), daemon=True)
+    broker_process.start()
+    ready.acquire()
+
+    try:
+        for workers in args.workers:
+            latencies, elapsed = run_round(args.address, workers, args.clients, args.messages, args.interval, args.size)
+            p99 = latencies[int(len(latencies) * 0.99) - 1]
+            print(f"workers={workers} clients={workers * args.clients} frames={len(latencies)} "
+                  f"p50={statistics.median(latencies):.2f}ms p99={p99:.2f}ms max={latencies[-1]:.2f}ms "
+                  f"elapsed={elapsed:.2f}s")
+    finally:
+        broker_process.terminate()
+
+
+if __name__ == "__main__":
+    main()
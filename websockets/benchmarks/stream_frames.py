@@ -0,0 +1,68 @@
+"""Bytes on the wire and serialization CPU for one streamed Monitor reply.
+
+Compares the old sketchAndChat frames, which resent the accumulated text on
+every chunk, with the delta frames from `streaming`. Figures are per reply
+and cover every receiving client, since broadcasts serialize once per client.
+
+    poetry run python benchmarks/stream_frames.py --clients 3
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from streaming import delta_frame, complete_frame  # noqa: E402
+
+
+def chunks_for(length: int, chunk_size: int):
+    text = ("lorem ipsum dolor sit amet " * (length // 27 + 1))[:length]
+    return [text[i:i + chunk_size] for i in range(0, length, chunk_size)]
+
+
+def full_text_frames(chunks, message_id):
+    full_response = ""
+    for chunk in chunks:
+        full_response += chunk
+        yield {"type": "geminiStreamResponse", "id": message_id, "text": full_response,
+               "user": "Monitor", "isComplete": False, "stageNumber": 1}
+    yield {"type": "geminiStreamResponse", "id": message_id, "isComplete": True,
+           "text": full_response, "user": "Monitor", "stageNumber": 1}
+
+
+def delta_frames(chunks, message_id):
+    for seq, chunk in enumerate(chunks, start=1):
+        yield {**delta_frame(message_id, seq, chunk), "stageNumber": 1}
+    yield {**complete_frame(message_id, len(chunks)), "stageNumber": 1}
+
+
+def measure(frames, clients: int):
+    sent = 0
+    started = time.perf_counter()
+    for frame in frames:
+        for _ in range(clients):
+            sent += len(json.dumps(frame).encode("utf-8"))
+    return sent, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lengths", type=int, nargs="+", default=[500, 2000, 8000, 32000])
+    parser.add_argument("--chunk-size", type=int, default=40)
+    parser.add_argument("--clients", type=int, default=3)
+    args = parser.parse_args()
+
+    message_id = "00000000-0000-0000-0000-000000000000"
+    print(f"{'chars':>7}{'frames':>8}{'full KB':>11}{'delta KB':>11}{'full ms':>10}{'delta ms':>10}")
+    for length in args.lengths:
+        chunks = chunks_for(length, args.chunk_size)
+        full_bytes, full_cpu = measure(full_text_frames(chunks, message_id), args.clients)
+        delta_bytes, delta_cpu = measure(delta_frames(chunks, message_id), args.clients)
+        print(f"{length:>7}{len(chunks) + 1:>8}{full_bytes / 1024:>11.1f}{delta_bytes / 1024:>11.1f}"
+              f"{full_cpu * 1000:>10.2f}{delta_cpu * 1000:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""Completion-time target selection against a large fake bucket.
+
+"listing" is the old completion path: list every object under targets/,
+pick one, download it, upload it as actual_target.jpg and download it
+again. "pool" picks from a pre-built `TargetPool` index, copies the object
+server side and downloads it once. The fake bucket charges a per-page
+listing latency and a per-request plus per-byte transfer cost.
+
+    poetry run python benchmarks/target_selection.py --sizes 1000 10000 100000
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from target_pool import TargetPool  # noqa: E402
+
+PAGE_SIZE = 1000
+
+
+class FakeBlob:
+    def __init__(self, bucket, name, size=200_000, generation=1):
+        self.bucket = bucket
+        self.name = name
+        self.size = size
+        self.generation = generation
+
+    def download_as_bytes(self):
+        self.bucket.transfer(self.size)
+        return b"\x00" * self.size
+
+    def upload_from_string(self, data, content_type=None):
+        self.bucket.transfer(len(data))
+
+
+class FakeBucket:
+    def __init__(self, objects: int, request_seconds=0.02, page_seconds=0.03, bytes_per_second=50e6):
+        self.names = [f"targets/{i:06d}.jpg" for i in range(objects)]
+        self.request_seconds = request_seconds
+        self.page_seconds = page_seconds
+        self.bytes_per_second = bytes_per_second
+
+    def transfer(self, size):
+        time.sleep(self.request_seconds + size / self.bytes_per_second)
+
+    def blob(self, name, generation=None):
+        return FakeBlob(self, name, generation=generation)
+
+    def list_blobs(self, prefix, fields=None):
+        for i, name in enumerate(self.names):
+            if i % PAGE_SIZE == 0:
+                time.sleep(self.page_seconds)
+            if name.startswith(prefix):
+                yield FakeBlob(self, name)
+
+    def copy_blob(self, blob, destination_bucket, new_name, source_generation=None):
+        time.sleep(self.request_seconds)
+
+
+def complete_by_listing(bucket):
+    target = random.choice(list(bucket.list_blobs(prefix="targets/")))
+    image_bytes = target.download_as_bytes()
+    bucket.blob("sessions/s/targetImage/actual_target.jpg").upload_from_string(image_bytes)
+    return bucket.blob("sessions/s/targetImage/actual_target.jpg").download_as_bytes()
+
+
+async def complete_from_pool(bucket, pool):
+    target = await pool.choose()
+    source = bucket.blob(target.name, generation=target.generation)
+    bucket.copy_blob(source, bucket, "sessions/s/targetImage/actual_target.jpg", source_generation=target.generation)
+    return source.download_as_bytes()
+
+
+async def run(objects: int, iterations: int):
+    bucket = FakeBucket(objects)
+    pool = TargetPool(lambda: bucket)
+
+    started = time.perf_counter()
+    await pool.refresh()
+    index_ms = (time.perf_counter() - started) * 1000
+
+    listing, pooled = [], []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        complete_by_listing(bucket)
+        listing.append((time.perf_counter() - started) * 1000)
+
+        started = time.perf_counter()
+        await complete_from_pool(bucket, pool)
+        pooled.append((time.perf_counter() - started) * 1000)
+    return index_ms, statistics.median(listing), statistics.median(pooled)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("-n", "--iterations", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'objects':>9}{'index build ms':>16}{'listing p50 ms':>16}{'pool p50 ms':>13}")
+    for objects in args.sizes:
+        index_ms, listing_ms, pooled_ms = asyncio.run(run(objects, args.iterations))
+        print(f"{objects:>9}{index_ms:>16.0f}{listing_ms:>16.0f}{pooled_ms:>13.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,65 +1,99 @@
-import os
 import uuid
+import asyncio
 from datetime import datetime
-import json
-import re
 import base64
-from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
+from functools import partial
+from langchain_core.messages import HumanMessage, AIMessage
 from fastapi import WebSocket
 
-import random
-from google.cloud import storage
 from google.cloud import firestore
-
-from prompts.map import SESSION_SYSTEM_PROMPT, DETAIL_EXTRACTION_PROMPT
-from session_management import broadcast_to_session
-
-async def process_chat(data: dict, session_id: str, chat_history, websocket: WebSocket, llm):
-    print("PROCESS_CHAT_REQUEST")
+from google.api_core.exceptions import NotFound
+
+from prompts.map import SESSION_SYSTEM_PROMPT
+from session_management import broadcast_to_session, find_latest_model_image, notify_session_event, share_sketch, local_peers
+from llm_async import astream_llm, ainvoke_llm, run_blocking
+from streaming import ResponseStream
+from metrics import StageTimer
+from image_jobs import ImageJob
+from clients import clients
+from target_pool import target_pool
+from session_state import session_state
+from sketches import sketch_store
+from details import detail_extractor, recorded_details
+from prompt_builder import chat_messages, transcript, refresh_summary
+from admission import model_scheduler
+
+TARGET_PICK_ATTEMPTS = 3
+
+async def record_user_message(data: dict, session_id: str, chat_history, websocket: WebSocket):
+    """Adds the viewer's message to the history and shows it to the rest of
+    the session. Returns the message and its normalized sketch, if any."""
     message = data.get("message", "")
     user = data.get("user", "Viewer")
 
+    # Decoded and downscaled once; peers get the hash and can fetch the
+    # image with fetchSketch
+    sketch = await sketch_store.ingest(data["sketch"]) if data.get("sketch") else None
+    if sketch is not None:
+        await share_sketch(sketch)
+        sketch_store.record_peer_refs(sketch, local_peers(session_id, websocket))
+
+    user_message = HumanMessage(
+        content=message,
+        additional_kwargs={
+            "id": data.get("id", str(uuid.uuid4())),
+            "timestamp": datetime.now(),
+            "user": user
+        }
+    )
+    chat_history.add_user_message(user_message)
+
+    await broadcast_to_session(session_id, {
+        "type": "geminiStreamResponse",
+        "id": data.get("id"),
+        "timestamp": data.get("timestamp"),
+        "user": user,
+        "text": message,
+        "sketchRef": sketch.hash if sketch else None,
+        "timestamp": datetime.now().isoformat()
+    }, exclude=websocket)
+    return user_message, sketch
+
+async def queue_chat(data: dict, session_id: str, chat_history, websocket: WebSocket, llm, image_jobs, reject):
+    """Records a chatOnly or sketchAndChat message, then queues the Monitor's reply.
+
+    The message is recorded first so it stays in the history even if the
+    reply is refused, or superseded by a newer message whose reply will
+    have it in view."""
+    timer = StageTimer(data["type"], session_id)
     try:
-        user_message = HumanMessage(
-            content=message,
-            additional_kwargs={
-                "id": data.get("id", str(uuid.uuid4())),
-                "timestamp": datetime.now(),
-                "user": user
-            }
-        )
-        chat_history.add_user_message(user_message)
-
+        user_message, sketch = await record_user_message(data, session_id, chat_history, websocket)
+    except Exception as e:
+        print(f"Error recording message: {e}")
         await broadcast_to_session(session_id, {
-            "type": "geminiStreamResponse",
-            "id": data.get("id"),
-            "timestamp": data.get("timestamp"),
-            "user": user,
-            "text": message,
-            "timestamp": datetime.now().isoformat()
-        }, exclude=websocket)
-
-        chat_history_messages = [
-            SystemMessage(content=SESSION_SYSTEM_PROMPT)
-        ] + chat_history.messages
+            "type": "geminiError",
+            "message": "Error processing your request"
+        })
+        return
+    timer.mark("messageRecorded")
 
-        message_id = str(uuid.uuid4())
-        full_response = ""
-        for chunk in llm.stream(chat_history_messages):
-            full_response += chunk.content
-            await broadcast_to_session(session_id, {
-                "type": "geminiStreamResponse",
-                "id": message_id,
-                "text": chunk.content,
-                "user": "Monitor",
-                "isComplete": False
-            })
+    if data["type"] == "sketchAndChat":
+        run = partial(process_sketch_and_chat, session_id, chat_history, user_message, sketch, llm, image_jobs, timer)
+    else:
+        run = partial(process_chat, session_id, chat_history, llm)
+    model_scheduler.submit(session_id, data["type"], run, reject)
 
-        await broadcast_to_session(session_id, {
-            "type": "geminiStreamResponse",
-            "id": message_id,
-            "isComplete": True
-        })
+async def process_chat(session_id: str, chat_history, llm):
+    print("PROCESS_CHAT_REQUEST")
+    try:
+        chat_history_messages = await chat_messages(chat_history, SESSION_SYSTEM_PROMPT, session_id, llm)
+
+        message_id = str(uuid.uuid4())
+        async with ResponseStream(session_id, message_id) as stream:
+            async for chunk in astream_llm(llm, chat_history_messages):
+                await stream.send(chunk.content)
+            await stream.complete()
+        full_response = stream.text
 
         ai_message = AIMessage(
             content=full_response,
@@ -71,6 +105,7 @@ async def process_chat(data: dict, session_id: str, chat_history, websocket: Web
         )
 
         chat_history.add_ai_message(ai_message)
+        refresh_summary(chat_history, llm)
     except Exception as e:
         print(f"Error querying Gemini: {e}")
         await broadcast_to_session(session_id, {
@@ -78,33 +113,39 @@ async def process_chat(data: dict, session_id: str, chat_history, websocket: Web
             "message": "Error processing your request"
         })
 
-async def process_sketch_and_chat(data: dict, session_id: str, chat_history, websocket: WebSocket, llm, imagen_model):
+async def process_sketch_and_chat(session_id: str, chat_history, user_message, sketch, llm, image_jobs, timer):
     print("PROCESS_SKETCH_REQUEST")
-    message = data.get("message", "")
-    sketch_base64 = data.get("sketch")
-    user = data.get("user", "Viewer")
+    message = user_message.content
 
     try:
-        await broadcast_to_session(session_id, {
-            "type": "geminiStreamResponse",
-            "id": data.get("id"),
-            "timestamp": data.get("timestamp"),
-            "user": user,
-            "text": message,
-            "sketch": sketch_base64,
-            "timestamp": datetime.now().isoformat()
-        }, exclude=websocket)
-
-        combined_text = "\n\nChat History:\n"
-        for msg in chat_history.messages:
-            if isinstance(msg, HumanMessage):
-                combined_text += f"Human: {msg.content}\n"
-            elif isinstance(msg, AIMessage):
-                combined_text += f"AI: {msg.content}\n"
-        
-        combined_text += f"\nCurrent User Message: {message}"
-
-        details = await extract_details_with_gemini(session_id, combined_text, sketch_base64, llm)
+        sketch_base64 = sketch.data_url if sketch else None
+        timer.mark("admitted")
+
+        # The message is already in the history; it is labelled as the one
+        # to answer, after any that were superseded before getting a reply
+        conversation = await transcript(
+            chat_history,
+            lambda msg: (
+                f"Current User Message: {msg.content}\n" if msg is user_message
+                else f"{'Human' if isinstance(msg, HumanMessage) else 'AI'}: {msg.content}\n"
+            ),
+            SESSION_SYSTEM_PROMPT,
+            session_id,
+            "sketchAndChat",
+            llm
+        )
+        combined_text = f"\n\nChat History:\n{conversation}"
+
+        # Detail extraction and target modelling only need the sketch and the
+        # history so far, so they run alongside the Monitor's streamed reply.
+        # A resent sketch still goes through, since the message with it may
+        # add details; the extractor's cache absorbs exact repeats.
+        conversation_history = [msg.content for msg in chat_history.messages[-5:]]
+        modelling_task = asyncio.create_task(
+            model_target(session_id, combined_text, sketch, conversation_history, llm, image_jobs, timer)
+        )
+        if sketch is not None:
+            sketch_store.record_model_send(sketch)
 
         combined_text = SESSION_SYSTEM_PROMPT + combined_text
 
@@ -114,34 +155,18 @@ async def process_sketch_and_chat(data: dict, session_id: str, chat_history, web
         ])
 
         message_id = str(uuid.uuid4())
-        full_response = ""
-        for chunk in llm.stream([combined_query]):
-            full_response += chunk.content
-            await broadcast_to_session(session_id, {
-                "type": "geminiStreamResponse",
-                "id": message_id,
-                "text": full_response,
-                "user": "Monitor",
-                "isComplete": False
-            })
-
-        await broadcast_to_session(session_id, {
-            "type": "geminiStreamResponse",
-            "id": message_id,
-            "isComplete": True,
-            "text": full_response,
-            "user": "Monitor"
-        })
-
-        user_message = HumanMessage(
-            content=message,
-            additional_kwargs={
-                "id": data.get("id", str(uuid.uuid4())),
-                "timestamp": datetime.now(),
-                "user": user
-            }
-        )
-        chat_history.add_user_message(user_message)
+        try:
+            async with ResponseStream(session_id, message_id) as stream:
+                async for chunk in astream_llm(llm, [combined_query]):
+                    if "firstToken" not in timer.marks:
+                        timer.mark("firstToken")
+                    await stream.send(chunk.content)
+                await stream.complete()
+            timer.mark("streamComplete")
+        except BaseException:
+            modelling_task.cancel()
+            raise
+        full_response = stream.text
 
         ai_message = AIMessage(
             content=full_response,
@@ -153,40 +178,15 @@ async def process_sketch_and_chat(data: dict, session_id: str, chat_history, web
         )
 
         chat_history.add_ai_message(ai_message)
+        refresh_summary(chat_history, llm)
 
-        conversation_history = [msg.content for msg in chat_history.messages[-5:]]
-        if isinstance(details, list) and len(details) > 0:
-            first_detail_dict = details[0]
-            if isinstance(first_detail_dict, dict):
-                detail_list = first_detail_dict.get('details', [])
-            else:
-                detail_list = []
-        else:
-            detail_list = []
-
-        print("Extracted details:", detail_list)
-        
-        image_base64 = await generate_target_image(session_id, detail_list, conversation_history, imagen_model)
-
-        if image_base64:
-            print("Generated image base64")
-
-            image_path = f'sessions/{session_id}/targetModels/{str(uuid.uuid4())}.jpg'
-            
-            bucket = storage.Client().bucket(os.getenv("STORAGE_BUCKET"))
-            blob = bucket.blob(image_path)
-            blob.upload_from_string(base64.b64decode(image_base64), content_type='image/jpeg')
-
-            db = firestore.Client()
-            session_ref = db.collection('sessions').document(session_id)
-            session_ref.update({
-                'targetImages': firestore.ArrayUnion([image_path])
-            })
-
-            await broadcast_to_session(session_id, {
-                "type": "updateTargetImage",
-                "imageBase64": image_base64
-            })
+        # Once an image job is submitted it owns the timer and reports it
+        submitted = False
+        try:
+            submitted = await modelling_task
+        finally:
+            if not submitted:
+                timer.report()
     except Exception as e:
         print(f"Error querying Gemini: {e}")
         await broadcast_to_session(session_id, {
@@ -194,126 +194,114 @@ async def process_sketch_and_chat(data: dict, session_id: str, chat_history, web
             "message": "Error processing your request"
         })
 
-async def extract_details_with_gemini(session_id, combined_text, sketch_data, llm):
-    combined_text = DETAIL_EXTRACTION_PROMPT + combined_text
-
-    combined_query = HumanMessage(content=[
-        {"type": "text", "text": combined_text},
-        {"type": "image_url", "image_url": sketch_data}
-    ])
-
-    response = llm.invoke([combined_query])
-
-    text = response.content
-    pattern = r"```json(.*?)```"
-    matches = re.findall(pattern, text, re.DOTALL)
-
-    try:
-        details = [json.loads(match.strip()) for match in matches]
-        print(details)
-        await broadcast_to_session(session_id, {
-            "type": "updateDetails",
-            "details": details[0]
-        })
-        return details[0]
-    except Exception:
-        raise ValueError(f"Failed to parse: {response}")
-
-async def generate_target_image(session_id, details, conversation_history, imagen_model):
-    prompt = f"Generate an image of a target based on the following details: {', '.join(details)}. "
-    prompt += f"Additional context from conversation: {' '.join(conversation_history[-5:])}"
-
-    try:
-        images = imagen_model.generate_images(
-            prompt=prompt,
-            number_of_images=1,
-            aspect_ratio="1:1",
-        )
-
-        image_base64 = base64.b64encode(images[0]._image_bytes).decode('utf-8')
-
-        return image_base64
-    except Exception as e:
-        print(f"Error generating image: {str(e)}")
-        return None
+async def extract_details_with_gemini(session_id, combined_text, sketch, conversation_history, llm):
+    known_details = recorded_details(await session_state.get(session_id))
+    with model_scheduler.background("details"):
+        details = await detail_extractor.extract(llm, sketch, combined_text, conversation_history, known_details)
+    print(details)
+    await session_state.update(session_id, {'detailsList': {'details': details}})
+    await broadcast_to_session(session_id, {
+        "type": "updateDetails",
+        "details": {"details": details}
+    })
+    return details
+
+async def model_target(session_id, combined_text, sketch, conversation_history, llm, image_jobs, timer):
+    detail_list = await extract_details_with_gemini(session_id, combined_text, sketch, conversation_history, llm)
+    timer.mark("extract")
+    print("Extracted details:", detail_list)
+
+    image_jobs.submit(ImageJob(session_id, detail_list, conversation_history, timer))
+    return True
+
+async def push_target_image(session_id: str, image_bytes: bytes, image_path: str):
+    print("Generated image base64")
+    # ImagenBackend.store has already written the pointer with the upload
+    session_state.remember(session_id, {'latestModelImagePath': image_path})
+    await notify_session_event(session_id, "sessionStateChanged")
+    await broadcast_to_session(session_id, {
+        "type": "updateTargetImage",
+        "imageBase64": base64.b64encode(image_bytes).decode('utf-8')
+    })
 
 async def complete_session(session_id: str, chat_history, llm):
     print(session_id)
-    db = firestore.Client()
-    storage_client = storage.Client()
-
-    bucket = storage_client.bucket(os.getenv("STORAGE_BUCKET"))
-    blobs = list(bucket.list_blobs(prefix='targets/'))
-    
-    if blobs:
-        random_target = random.choice(blobs)
-        
-        image_bytes = random_target.download_as_bytes()
-        
-        target_image_path = f'sessions/{session_id}/targetImage/actual_target.jpg'
-        target_blob = bucket.blob(target_image_path)
-        target_blob.upload_from_string(image_bytes, content_type='image/jpeg')
-        
-        modelled_blobs = list(bucket.list_blobs(prefix=f'sessions/{session_id}/targetModels'))
-        if modelled_blobs:
-            latest_modelled_blob = max(modelled_blobs, key=lambda x: x.time_created)
-            modelled_image_path = latest_modelled_blob.name
-        else:
-            modelled_image_path = None
-            target_image_base64 = None
-
-        modelled_image_base64 = None
-
-        if target_image_path:
-            target_blob = bucket.blob(target_image_path)
-            target_image_bytes = target_blob.download_as_bytes()
-            target_image_base64 = base64.b64encode(target_image_bytes).decode('utf-8')
-
+    bucket = clients.bucket()
+    target_image_path = f'sessions/{session_id}/targetImage/actual_target.jpg'
+    # The web app writes detailsList, currentStage and targetImages straight
+    # to the document, so completion reads it afresh rather than from cache
+    await session_state.flush(session_id)
+    session_state.invalidate(session_id)
+    session_data = await session_state.get(session_id)
+
+    def fetch_images(target):
+        # Server-side copy for the session's record, and a single download
+        # of the same generation for the summary prompt
+        source_blob = bucket.blob(target.name, generation=target.generation)
+        bucket.copy_blob(source_blob, bucket, target_image_path, source_generation=target.generation)
+        target_image_bytes = source_blob.download_as_bytes()
+
+        modelled_image_path = find_latest_model_image(session_id, session_data)
+        modelled_image_bytes = None
         if modelled_image_path:
-            modelled_blob = bucket.blob(modelled_image_path)
-            modelled_image_bytes = modelled_blob.download_as_bytes()
-            modelled_image_base64 = base64.b64encode(modelled_image_bytes).decode('utf-8')
-
-        summary_prompt = f"Summarise the remote viewing session with ID {session_id}. Compare the target image with the modelled image. Here's the chat history:\n\n"
-        for msg in chat_history.messages:
-            summary_prompt += f"{msg.additional_kwargs.get('user', 'Unknown')}: {msg.content}\n"
-
-        query_content = [
-            {"type": "text", "text": summary_prompt},
-        ]
-
-        if target_image_base64:
-            query_content.append({"type": "image_url", "image_url": f"data:image/jpeg;base64,{target_image_base64}"})
-
-        if modelled_image_base64:
-            query_content.append({"type": "image_url", "image_url": f"data:image/jpeg;base64,{modelled_image_base64}"})
-
-        summary_response = llm.invoke([HumanMessage(content=query_content)])
-        summary = summary_response.content
-        
-        session_ref = db.collection('sessions').document(session_id)
-        session_ref.update({
-            'status': 'completed',
-            'completedAt': firestore.SERVER_TIMESTAMP,
-            'targetImagePath': target_image_path,
-            'modelledImagePath': modelled_image_path,
-        })
-        session_ref.update({
-            'summary': summary
-        })
+            modelled_image_bytes = bucket.blob(modelled_image_path).download_as_bytes()
 
-        print(session_ref)
-        session_details = []
+        return target_image_bytes, modelled_image_path, modelled_image_bytes
+
+    for _ in range(TARGET_PICK_ATTEMPTS):
+        target = await target_pool.choose()
         try:
-            session_details = session_ref.get().to_dict().get('detailsList', {})
-        except:
-            print("Failed to get details")
-
-        return {
-            'targetImagePath': target_image_path,
-            'modelledImagePath': modelled_image_path,
-            'summary': summary,
-            'details': session_details
-        }
+            target_image_bytes, modelled_image_path, modelled_image_bytes = await run_blocking(fetch_images, target)
+            break
+        except NotFound:
+            print(f"Target {target.name} no longer exists, picking another")
+            target_pool.discard(target)
     else:
-        raise ValueError("No target images found")
\ No newline at end of file
+        raise ValueError("No target images found")
+
+    target_image_base64 = base64.b64encode(target_image_bytes).decode('utf-8')
+    modelled_image_base64 = None
+    if modelled_image_bytes:
+        modelled_image_base64 = base64.b64encode(modelled_image_bytes).decode('utf-8')
+
+    summary_prompt = f"Summarise the remote viewing session with ID {session_id}. Compare the target image with the modelled image. Here's the chat history:\n\n"
+    summary_prompt += await transcript(
+        chat_history,
+        lambda msg: f"{msg.additional_kwargs.get('user', 'Unknown')}: {msg.content}\n",
+        summary_prompt,
+        session_id,
+        "completeSession",
+        llm
+    )
+
+    query_content = [
+        {"type": "text", "text": summary_prompt},
+    ]
+
+    if target_image_base64:
+        query_content.append({"type": "image_url", "image_url": f"data:image/jpeg;base64,{target_image_base64}"})
+
+    if modelled_image_base64:
+        query_content.append({"type": "image_url", "image_url": f"data:image/jpeg;base64,{modelled_image_base64}"})
+
+    summary_response = await ainvoke_llm(llm, [HumanMessage(content=query_content)])
+    summary = summary_response.content
+    
+    await session_state.update(session_id, {
+        'status': 'completed',
+        'completedAt': firestore.SERVER_TIMESTAMP,
+        'targetImagePath': target_image_path,
+        'modelledImagePath': modelled_image_path,
+        'summary': summary
+    })
+    # Completion is written straight away rather than with the next batch
+    await session_state.flush(session_id)
+
+    session_details = recorded_details(session_data)
+
+    return {
+        'targetImagePath': target_image_path,
+        'modelledImagePath': modelled_image_path,
+        'summary': summary,
+        'details': session_details
+    }
@@ -0,0 +1,76 @@
+import os
+import inspect
+from datetime import timedelta
+from requests.adapters import HTTPAdapter
+import google.auth.transport.requests
+from google.cloud import storage
+from google.cloud import firestore
+
+STORAGE_POOL_SIZE = int(os.getenv("STORAGE_POOL_SIZE", "32"))
+SIGNED_URL_SECONDS = int(os.getenv("SIGNED_URL_SECONDS", "900"))
+
+
+class CloudClients:
+    """Google Cloud clients shared for the lifetime of the app.
+
+    Opened once from the FastAPI lifespan so credential discovery, TLS and
+    channel setup are not paid on the request path. Firestore has an async
+    client for use on the event loop; the sync one is for code already
+    running on an executor thread. Cloud Storage has no async client, so
+    its calls go through `llm_async.run_blocking` on a pooled HTTP
+    session."""
+
+    def __init__(self):
+        self.firestore = None
+        self.firestore_async = None
+        self.storage = None
+
+    def open(self, storage_pool_size: int = STORAGE_POOL_SIZE):
+        if self.storage is not None:
+            return
+        self.firestore = firestore.Client()
+        self.firestore_async = firestore.AsyncClient()
+        self.storage = storage.Client()
+        # The default requests adapter keeps only 10 connections per host,
+        # fewer than the executor threads that may upload at once
+        adapter = HTTPAdapter(pool_connections=storage_pool_size, pool_maxsize=storage_pool_size)
+        self.storage._http.mount("https://", adapter)
+
+    async def close(self):
+        for client in (self.firestore_async, self.firestore, self.storage):
+            if client is None:
+                continue
+            try:
+                result = client.close()
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as e:
+                print(f"Failed to close {type(client).__name__}: {e}")
+        self.firestore = None
+        self.firestore_async = None
+        self.storage = None
+
+    def bucket(self):
+        return self.storage.bucket(os.getenv("STORAGE_BUCKET"))
+
+    def signed_url(self, blob_name: str) -> str:
+        credentials = self.storage._credentials
+        kwargs = {}
+        if not hasattr(credentials, "sign_bytes"):
+            # Cloud Run / Compute Engine credentials hold no private key, so
+            # the URL is signed through the IAM API with an access token
+            if not credentials.valid:
+                credentials.refresh(google.auth.transport.requests.Request())
+            kwargs = {
+                "service_account_email": credentials.service_account_email,
+                "access_token": credentials.token,
+            }
+        return self.bucket().blob(blob_name).generate_signed_url(
+            version="v4",
+            expiration=timedelta(seconds=SIGNED_URL_SECONDS),
+            method="GET",
+            **kwargs
+        )
+
+
+clients = CloudClients()
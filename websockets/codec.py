@@ -0,0 +1,124 @@
+"""Wire formats for the /session websocket.
+
+Clients pick one with the websocket subprotocol. "stargate.json" is the
+default and is what a client asking for nothing gets: JSON text frames,
+serialized with orjson when it is installed. "stargate.msgpack" sends
+MessagePack binary frames, and the image fields listed in BINARY_FIELDS
+carry raw bytes instead of base64 strings. It needs the `msgpack` package.
+
+Broadcasts are serialized once as JSON, which is also what the session bus
+carries between nodes, and transcoded once per codec in use when they are
+delivered.
+"""
+import json
+import base64
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BINARY_FIELDS = ("sketch", "imageBase64", "latestTargetImage")
+SKETCH_MEDIA_TYPE = "image/png"
+
+socket_codecs = {}
+
+
+def dumps(message) -> str:
+    if orjson is not None:
+        return orjson.dumps(message).decode("utf-8")
+    return json.dumps(message)
+
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _decode_base64(value: str) -> bytes:
+    # Sketches arrive as data URLs, images as bare base64
+    if value.startswith("data:"):
+        value = value.split(",", 1)[1]
+    return base64.b64decode(value)
+
+
+class JsonCodec:
+    subprotocol = "stargate.json"
+    binary = False
+
+    def encode(self, message: dict) -> str:
+        return dumps(message)
+
+    def transcode(self, payload: str) -> str:
+        return payload
+
+    async def send(self, websocket, encoded: str):
+        await websocket.send_text(encoded)
+
+    async def receive(self, websocket) -> dict:
+        return loads(await websocket.receive_text())
+
+
+class MsgpackCodec:
+    subprotocol = "stargate.msgpack"
+    binary = True
+
+    def __init__(self):
+        import msgpack
+
+        self.msgpack = msgpack
+
+    def encode(self, message: dict) -> bytes:
+        fields = {
+            key: _decode_base64(message[key])
+            for key in BINARY_FIELDS
+            if isinstance(message.get(key), str)
+        }
+        return self.msgpack.packb({**message, **fields} if fields else message)
+
+    def transcode(self, payload: str) -> bytes:
+        return self.encode(loads(payload))
+
+    async def send(self, websocket, encoded: bytes):
+        await websocket.send_bytes(encoded)
+
+    async def receive(self, websocket) -> dict:
+        message = self.msgpack.unpackb(await websocket.receive_bytes())
+        # Everything past the socket still expects a sketch data URL
+        sketch = message.get("sketch")
+        if isinstance(sketch, bytes):
+            message["sketch"] = f"data:{SKETCH_MEDIA_TYPE};base64,{base64.b64encode(sketch).decode('ascii')}"
+        return message
+
+
+json_codec = JsonCodec()
+# Created on first use, as msgpack is optional
+msgpack_codec = None
+
+
+def negotiate(websocket):
+    """Picks the codec from the subprotocols the client offered.
+
+    Returns the codec and the subprotocol to accept with, if any."""
+    global msgpack_codec
+    offered = websocket.scope.get("subprotocols", [])
+    if MsgpackCodec.subprotocol in offered:
+        try:
+            if msgpack_codec is None:
+                msgpack_codec = MsgpackCodec()
+            return msgpack_codec, MsgpackCodec.subprotocol
+        except ImportError:
+            print("msgpack requested but not installed, falling back to JSON")
+    if JsonCodec.subprotocol in offered:
+        return json_codec, JsonCodec.subprotocol
+    return json_codec, None
+
+
+def codec_for(websocket):
+    return socket_codecs.get(websocket, json_codec)
+
+
+async def send_message(websocket, message: dict):
+    codec = codec_for(websocket)
+    await codec.send(websocket, codec.encode(message))
@@ -0,0 +1,183 @@
+import os
+import re
+import json
+import time
+import hashlib
+from collections import OrderedDict
+from langchain_core.messages import HumanMessage
+
+from prompts.map import DETAIL_EXTRACTION_PROMPT
+from llm_async import ainvoke_llm
+from sketches import sketch_store
+
+DETAIL_CACHE_SIZE = int(os.getenv("DETAIL_CACHE_SIZE", "1024"))
+DETAIL_CACHE_TTL_SECONDS = float(os.getenv("DETAIL_CACHE_TTL_SECONDS", "3600"))
+DETAIL_CONVERSATION_MESSAGES = 4
+# Gemini bills an image as a fixed number of tokens
+IMAGE_TOKENS = 258
+
+JSON_BLOCK = re.compile(r"```(?:json)?(.*?)```", re.DOTALL)
+JSON_OBJECT = re.compile(r"\{.*\}|\[.*\]", re.DOTALL)
+
+REFORMAT_PROMPT = """
+Rewrite the following answer as JSON of the form {"details": ["red", "doorway"]}
+and return nothing else.
+
+"""
+
+
+def conversation_digest(messages) -> str:
+    """Hash of the recent conversation that ignores case, spacing and punctuation."""
+    normalized = []
+    for message in messages[-DETAIL_CONVERSATION_MESSAGES:]:
+        text = re.sub(r"[^\w\s]", "", str(message).lower())
+        normalized.append(" ".join(text.split()))
+    return hashlib.sha256("\n".join(normalized).encode("utf-8")).hexdigest()
+
+
+def details_digest(details) -> str:
+    """Hash of a detail list that ignores order and case."""
+    normalized = sorted({detail.lower() for detail in details})
+    return hashlib.sha256("\n".join(normalized).encode("utf-8")).hexdigest()
+
+
+def parse_details(text: str):
+    """Pulls a list of detail strings out of a model answer, or returns None.
+
+    Accepts a fenced or bare JSON object with a "details" list, or a bare
+    list, and ignores anything that is not a non-empty string."""
+    candidates = [match.strip() for match in JSON_BLOCK.findall(text)]
+    candidates += JSON_OBJECT.findall(text)
+    for candidate in candidates:
+        try:
+            parsed = json.loads(candidate)
+        except ValueError:
+            continue
+        if isinstance(parsed, dict):
+            parsed = parsed.get("details")
+        if isinstance(parsed, list):
+            return [str(detail).strip() for detail in parsed if isinstance(detail, (str, int, float)) and str(detail).strip()]
+    return None
+
+
+def recorded_details(session_data: dict) -> list:
+    """The session's detail list, whether stored as a list or {"details": [...]}."""
+    details = (session_data or {}).get('detailsList') or []
+    if isinstance(details, dict):
+        details = details.get('details', [])
+    return [detail for detail in details if isinstance(detail, str)]
+
+
+def merge_details(existing, new) -> list:
+    merged = list(existing)
+    seen = {detail.lower() for detail in merged}
+    for detail in new:
+        if detail.lower() not in seen:
+            seen.add(detail.lower())
+            merged.append(detail)
+    return merged
+
+
+def _tokens(response, prompt: str, images: int) -> int:
+    usage = getattr(response, "usage_metadata", None)
+    if usage:
+        return usage.get("total_tokens", 0)
+    # Rough estimate when the model does not report usage
+    return len(prompt) // 4 + images * IMAGE_TOKENS + len(response.content) // 4
+
+
+class DetailExtractor:
+    """Extracts viewer details from a sketch and the conversation around it.
+
+    The model is told the details already recorded and only asked for new
+    ones, which are merged into the session's list. With a sketch, results
+    are cached by sketch hash and the recorded details, under both the list
+    before and after the merge, so an unchanged sketch resent with a new
+    message costs no multimodal call. Without one they are cached by
+    conversation digest, so a resent message does not either."""
+
+    def __init__(self, max_entries: int = DETAIL_CACHE_SIZE, ttl_seconds: float = DETAIL_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self.counters = {"hits": 0, "misses": 0, "retries": 0, "parseFailures": 0,
+                         "tokensSpent": 0, "tokensSaved": 0}
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        stored_at, details, tokens = entry
+        if time.monotonic() - stored_at > self.ttl_seconds:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return details, tokens
+
+    def _store(self, key, details, tokens):
+        self._entries[key] = (time.monotonic(), details, tokens)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def extract(self, llm, sketch, conversation_text: str, recent_messages, known_details) -> list:
+        """Returns `known_details` with any new details from this message added."""
+        if sketch is not None:
+            key = (sketch.hash, details_digest(known_details))
+        else:
+            key = (None, conversation_digest(recent_messages))
+        cached = self._lookup(key)
+        if cached is not None:
+            details, tokens = cached
+            self.counters["hits"] += 1
+            self.counters["tokensSaved"] += tokens
+            if sketch is not None:
+                sketch_store.record_model_skip(sketch)
+            return merge_details(known_details, details)
+        self.counters["misses"] += 1
+
+        prompt = DETAIL_EXTRACTION_PROMPT
+        if known_details:
+            prompt += f"\nDetails already recorded, do not repeat them: {json.dumps(known_details)}\n"
+        prompt += conversation_text
+        content = [{"type": "text", "text": prompt}]
+        if sketch is not None:
+            content.append({"type": "image_url", "image_url": sketch.data_url})
+            sketch_store.record_model_send(sketch)
+
+        response = await ainvoke_llm(llm, [HumanMessage(content=content)])
+        tokens = _tokens(response, prompt, 1 if sketch else 0)
+        details = parse_details(response.content)
+        if details is None:
+            # Reformatting the answer is text only and far cheaper than
+            # asking again with the sketch
+            self.counters["retries"] += 1
+            retry_prompt = REFORMAT_PROMPT + response.content
+            response = await ainvoke_llm(llm, [HumanMessage(content=retry_prompt)])
+            tokens += _tokens(response, retry_prompt, 0)
+            details = parse_details(response.content)
+        self.counters["tokensSpent"] += tokens
+
+        if details is None:
+            self.counters["parseFailures"] += 1
+            print(f"Could not parse details from: {response.content!r}")
+            return list(known_details)
+
+        self._store(key, details, tokens)
+        merged = merge_details(known_details, details)
+        if sketch is not None:
+            # The session records the merged list, which the next send of
+            # this sketch is looked up with
+            self._store((sketch.hash, details_digest(merged)), details, tokens)
+        return merged
+
+    def stats(self) -> dict:
+        lookups = self.counters["hits"] + self.counters["misses"]
+        return {
+            **self.counters,
+            "entries": len(self._entries),
+            "hitRate": self.counters["hits"] / lookups if lookups else 0.0,
+        }
+
+
+detail_extractor = DetailExtractor()
@@ -0,0 +1,135 @@
+import os
+import asyncio
+from fastapi import WebSocket
+
+from session_management import broadcast_to_session, session_backlog, OUTBOUND_QUEUE_SIZE
+from metrics import Histogram
+
+DRAW_TICK_MS = float(os.getenv("DRAW_TICK_MS", "25"))
+DRAW_MAX_SEGMENTS = int(os.getenv("DRAW_MAX_SEGMENTS", "200"))
+DRAW_BACKPRESSURE_SEGMENTS = int(os.getenv("DRAW_BACKPRESSURE_SEGMENTS", "16"))
+
+SEGMENT_FIELDS = ("prevX", "prevY", "x", "y", "color")
+
+
+def _runs(segments):
+    """Splits segments into runs drawn as one continuous line."""
+    run = []
+    for segment in segments:
+        if run and not (
+            segment["color"] == run[-1]["color"]
+            and segment["prevX"] == run[-1]["x"]
+            and segment["prevY"] == run[-1]["y"]
+        ):
+            yield run
+            run = []
+        run.append(segment)
+    if run:
+        yield run
+
+
+def decimate(segments: list, max_segments: int) -> list:
+    """Drops intermediate points so at most about `max_segments` remain.
+
+    Each continuous run keeps its first and last point, so strokes still
+    join up and are replayed in their original order."""
+    if len(segments) <= max_segments:
+        return segments
+    runs = list(_runs(segments))
+    budget = max(max_segments, len(runs))
+    decimated = []
+    for run in runs:
+        keep = max(1, round(len(run) * budget / len(segments)))
+        step = len(run) / keep
+        start = run[0]
+        for i in range(1, keep + 1):
+            end = run[min(len(run) - 1, round(i * step) - 1)]
+            decimated.append({
+                "prevX": start["prevX"] if i == 1 else decimated[-1]["x"],
+                "prevY": start["prevY"] if i == 1 else decimated[-1]["y"],
+                "x": end["x"],
+                "y": end["y"],
+                "color": run[0]["color"]
+            })
+    return decimated
+
+
+class DrawPipeline:
+    """Batches draw segments into one drawBatch frame per sender per tick.
+
+    Viewers get every sender's segments in the order they were drawn. When
+    a viewer's outbound queue is backing up, or a tick collects more than
+    DRAW_MAX_SEGMENTS, intermediate points are dropped instead of queuing
+    more frames."""
+
+    def __init__(
+        self,
+        tick_ms: float = DRAW_TICK_MS,
+        max_segments: int = DRAW_MAX_SEGMENTS,
+        backpressure_segments: int = DRAW_BACKPRESSURE_SEGMENTS,
+    ):
+        self.tick_seconds = tick_ms / 1000
+        self.max_segments = max_segments
+        self.backpressure_segments = backpressure_segments
+        self._buffers = {}
+        self._flusher = None
+        self.points_per_frame = Histogram()
+        self.counters = {"framesIn": 0, "framesOut": 0, "pointsIn": 0, "pointsOut": 0, "pointsDropped": 0}
+
+    def submit(self, session_id: str, websocket: WebSocket, data: dict):
+        segment = {field: data.get(field) for field in SEGMENT_FIELDS}
+        self._buffers.setdefault(session_id, {}).setdefault(websocket, []).append(segment)
+        self.counters["framesIn"] += 1
+        self.counters["pointsIn"] += 1
+
+    def start(self):
+        self._flusher = asyncio.create_task(self._flush_periodically())
+
+    async def stop(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        await self.flush()
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.tick_seconds)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Error flushing draw batches: {e}")
+
+    async def flush(self):
+        for session_id in list(self._buffers):
+            await self.flush_session(session_id)
+
+    async def flush_session(self, session_id: str):
+        """Sends anything buffered for the session, e.g. before a clear."""
+        senders = self._buffers.pop(session_id, None)
+        if not senders:
+            return
+        limit = self.max_segments
+        if session_backlog(session_id) > OUTBOUND_QUEUE_SIZE // 2:
+            limit = self.backpressure_segments
+
+        for sender, segments in senders.items():
+            batch = decimate(segments, limit)
+            self.counters["framesOut"] += 1
+            self.counters["pointsOut"] += len(batch)
+            self.counters["pointsDropped"] += len(segments) - len(batch)
+            self.points_per_frame.observe(len(batch))
+            await broadcast_to_session(session_id, {
+                "type": "drawBatch",
+                "segments": batch
+            }, exclude=sender)
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "pending": sum(len(segments) for senders in self._buffers.values() for segments in senders.values()),
+            "pointsPerFrame": self.points_per_frame.summary(),
+        }
+
+
+draw_pipeline = DrawPipeline()
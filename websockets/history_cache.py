@@ -0,0 +1,280 @@
+import os
+import time
+import asyncio
+from collections import OrderedDict
+from langchain_core.messages import BaseMessage, HumanMessage, AIMessage
+from langchain_google_firestore import FirestoreChatMessageHistory
+from langchain_google_firestore.chat_message_history import encode_messages, convert_messages_to_langchain
+from google.cloud import firestore
+
+from llm_async import run_blocking
+from clients import clients
+from message_log import HISTORY_COLLECTION, history_entry, write_entries, logged_count, log_complete, mark_complete
+HISTORY_CACHE_MAX_SESSIONS = int(os.getenv("HISTORY_CACHE_MAX_SESSIONS", "500"))
+HISTORY_CACHE_MAX_BYTES = int(os.getenv("HISTORY_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+HISTORY_CACHE_IDLE_SECONDS = float(os.getenv("HISTORY_CACHE_IDLE_SECONDS", "1800"))
+HISTORY_WRITE_RETRIES = int(os.getenv("HISTORY_WRITE_RETRIES", "5"))
+HISTORY_RETRY_SECONDS = float(os.getenv("HISTORY_RETRY_SECONDS", "0.5"))
+
+
+def _message_size(message: BaseMessage) -> int:
+    if isinstance(message.content, str):
+        return len(message.content)
+    return sum(len(str(part)) for part in message.content)
+
+
+class SessionHistory:
+    """Chat history for one session that is read from Firestore once.
+
+    Messages are appended to the local list immediately and written through
+    to Firestore in order by a background task, both to the chat history
+    document and to the per-message log that history paging queries. A
+    failed write stays at the front of the queue and is retried with
+    backoff; only after HISTORY_WRITE_RETRIES are its messages given up.
+
+    Other nodes may append to the same session, so the document is appended
+    to in a transaction rather than overwritten with this node's copy. The
+    messages it already holds give the seq of the new ones, and any that
+    this copy has not seen yet are merged in ahead of the pending ones."""
+
+    def __init__(self, session_id: str, backend: FirestoreChatMessageHistory, on_written=None):
+        self.session_id = session_id
+        self.on_written = on_written
+        self.messages = list(backend.messages)
+        self.size = sum(_message_size(message) for message in self.messages)
+        self.last_used = time.monotonic()
+        self._backend = backend
+        self._pending = []
+        # (first seq, count) of the leading pending messages already in the
+        # chat history document but not yet in the message log
+        self._appended = None
+        self._writer = None
+        self.write_errors = 0
+        self.lost_messages = 0
+        self.backfill = None
+        # Rolling summary of messages[:summarized], kept by prompt_builder
+        self.summary = None
+        self.summarized = 0
+        self.summarizer = None
+
+    @property
+    def dirty(self) -> bool:
+        return bool(self._pending) or (self._writer is not None and not self._writer.done())
+
+    def add_message(self, message: BaseMessage) -> None:
+        self.messages.append(message)
+        self.size += _message_size(message)
+        self._pending.append(message)
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.get_running_loop().create_task(self._write_pending())
+
+    def add_user_message(self, message) -> None:
+        self.add_message(message if isinstance(message, HumanMessage) else HumanMessage(content=message))
+
+    def add_ai_message(self, message) -> None:
+        self.add_message(message if isinstance(message, AIMessage) else AIMessage(content=message))
+
+    async def _write_pending(self):
+        failures = 0
+        while self._pending:
+            # Messages added while a write is in flight or backing off join the next attempt
+            batch = list(self._pending)
+            try:
+                if self._appended is None:
+                    stored = await run_blocking(self._append, batch)
+                    self._merge(stored)
+                    self._appended = (len(stored), len(batch))
+                first_seq, count = self._appended
+                batch = batch[:count]
+                await run_blocking(write_entries, self.session_id, [
+                    history_entry(seq, message) for seq, message in enumerate(batch, start=first_seq)
+                ])
+            except Exception as e:
+                self.write_errors += 1
+                failures += 1
+                if failures > HISTORY_WRITE_RETRIES:
+                    print(f"Gave up writing {len(batch)} chat messages for session {self.session_id}: {e}")
+                    self.lost_messages += len(batch)
+                    if self._appended is None:
+                        self._drop(batch)
+                    del self._pending[:len(batch)]
+                    self._appended = None
+                    failures = 0
+                    continue
+                delay = HISTORY_RETRY_SECONDS * 2 ** (failures - 1)
+                print(f"Failed to write chat history for session {self.session_id}, retrying in {delay}s: {e}")
+                await asyncio.sleep(delay)
+                continue
+
+            del self._pending[:len(batch)]
+            self._appended = None
+            failures = 0
+            if self.on_written is not None:
+                await self.on_written(self.session_id)
+
+    def _append(self, messages: list) -> list:
+        """Appends to the chat history document; returns what it held before, encoded."""
+        backend = self._backend
+        if backend.encode_message:
+            encoded = encode_messages(messages)
+        else:
+            encoded = [message.json() for message in messages]
+
+        @firestore.transactional
+        def append(transaction):
+            snapshot = backend.doc_ref.get(transaction=transaction)
+            stored = (snapshot.to_dict() or {}).get("messages", []) if snapshot.exists else []
+            transaction.set(backend.doc_ref, {"messages": stored + encoded})
+            return stored
+
+        return append(backend.client.transaction())
+
+    def _merge(self, stored: list):
+        """Inserts messages other nodes wrote ahead of this node's pending ones."""
+        known = len(self.messages) - len(self._pending)
+        if len(stored) <= known:
+            return
+        peers = convert_messages_to_langchain(self._backend.encode_message, stored[known:])
+        self.messages[known:known] = peers
+        self.size += sum(_message_size(message) for message in peers)
+        # The summary stays valid; messages after `known` just moved along
+        self.summarized = min(self.summarized, known)
+
+    def _drop(self, lost: list):
+        """Keeps the local list in step with the document after giving up on messages."""
+        lost_ids = {id(message) for message in lost}
+        known = len(self.messages) - len(self._pending)
+        self.messages = [message for message in self.messages if id(message) not in lost_ids]
+        self.size -= sum(_message_size(message) for message in lost)
+        self.summarized = min(self.summarized, known)
+
+    async def backfill_log(self):
+        """Logs messages written before the per-message log existed, then
+        marks the log complete so joins and paging can rely on it alone."""
+        loaded = len(self.messages) - len(self._pending)
+        try:
+            if await log_complete(self.session_id):
+                return
+            count = await logged_count(self.session_id)
+            if count < loaded:
+                entries = [history_entry(seq, self.messages[seq]) for seq in range(count, loaded)]
+                await run_blocking(write_entries, self.session_id, entries)
+                print(f"Backfilled {len(entries)} logged messages for session {self.session_id}")
+            await mark_complete(self.session_id)
+        except Exception as e:
+            print(f"Failed to backfill message log for session {self.session_id}: {e}")
+
+    async def flush(self):
+        while self._writer is not None and not self._writer.done():
+            await self._writer
+
+
+class HistoryCache:
+    def __init__(
+        self,
+        max_sessions: int = HISTORY_CACHE_MAX_SESSIONS,
+        max_bytes: int = HISTORY_CACHE_MAX_BYTES,
+        idle_seconds: float = HISTORY_CACHE_IDLE_SECONDS,
+    ):
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.idle_seconds = idle_seconds
+        self._entries = OrderedDict()
+        self._loading = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Awaited with the session id after each batch reaches Firestore
+        self.on_written = None
+
+    async def get(self, session_id: str) -> SessionHistory:
+        entry = self._entries.get(session_id)
+        if entry is not None:
+            self.hits += 1
+            self._entries.move_to_end(session_id)
+        else:
+            self.misses += 1
+            loading = self._loading.get(session_id)
+            if loading is None:
+                loading = asyncio.ensure_future(self._load(session_id))
+                self._loading[session_id] = loading
+            entry = await asyncio.shield(loading)
+        entry.last_used = time.monotonic()
+        self._evict(keep=session_id)
+        return entry
+
+    def peek(self, session_id: str):
+        """The cached history, without loading it or counting a lookup."""
+        return self._entries.get(session_id)
+
+    async def logged(self, session_id: str):
+        """Waits until the message log holds the session's whole history.
+
+        Returns the cached history when the session is loaded (or had to be
+        loaded to backfill the log), and None when the log can be read on
+        its own without loading the chat history document."""
+        entry = self.peek(session_id)
+        if entry is None:
+            try:
+                if await log_complete(session_id):
+                    return None
+            except Exception as e:
+                print(f"Failed to read message log state for session {session_id}: {e}")
+            entry = await self.get(session_id)
+        if entry.backfill is not None:
+            await asyncio.shield(entry.backfill)
+        return entry
+
+    async def _load(self, session_id: str) -> SessionHistory:
+        try:
+            backend = await run_blocking(
+                lambda: FirestoreChatMessageHistory(
+                    session_id=session_id, collection=HISTORY_COLLECTION, client=clients.firestore
+                )
+            )
+            entry = SessionHistory(session_id, backend, self.on_written)
+            self._entries[session_id] = entry
+            entry.backfill = asyncio.create_task(entry.backfill_log())
+            return entry
+        finally:
+            del self._loading[session_id]
+
+    def _evict(self, keep: str = None):
+        now = time.monotonic()
+        total_bytes = sum(entry.size for entry in self._entries.values())
+        # Least recently used first; sessions with unwritten messages are kept
+        for session_id, entry in list(self._entries.items()):
+            over_capacity = len(self._entries) > self.max_sessions or total_bytes > self.max_bytes
+            idle = now - entry.last_used > self.idle_seconds
+            if not (over_capacity or idle):
+                break
+            if entry.dirty or session_id == keep:
+                continue
+            del self._entries[session_id]
+            total_bytes -= entry.size
+            self.evictions += 1
+
+    def invalidate(self, session_id: str):
+        """Drops a session whose history was changed by another node."""
+        entry = self._entries.get(session_id)
+        if entry is not None and not entry.dirty:
+            del self._entries[session_id]
+
+    async def flush_all(self):
+        await asyncio.gather(*(entry.flush() for entry in list(self._entries.values())))
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "sessions": len(self._entries),
+            "bytes": sum(entry.size for entry in self._entries.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "writeErrors": sum(entry.write_errors for entry in self._entries.values()),
+            "lostMessages": sum(entry.lost_messages for entry in self._entries.values()),
+        }
+
+
+history_cache = HistoryCache()
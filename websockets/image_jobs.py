@@ -0,0 +1,209 @@
+import os
+import time
+import uuid
+import asyncio
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from google.cloud import firestore
+
+from llm_async import run_blocking
+from clients import clients
+from metrics import Histogram
+
+IMAGE_JOB_WORKERS = int(os.getenv("IMAGE_JOB_WORKERS", "4"))
+IMAGE_BACKEND = os.getenv("IMAGE_BACKEND", "imagen")
+
+# Image generation holds a thread per job for seconds at a time, so it runs
+# on its own pool instead of the shared I/O one
+image_executor = ThreadPoolExecutor(max_workers=IMAGE_JOB_WORKERS, thread_name_prefix="imagen")
+
+
+def build_target_prompt(details, conversation_history) -> str:
+    prompt = f"Generate an image of a target based on the following details: {', '.join(details)}. "
+    prompt += f"Additional context from conversation: {' '.join(conversation_history[-5:])}"
+    return prompt
+
+
+class ImagenBackend:
+    """Generates with Imagen and stores under the session in GCS."""
+
+    def __init__(self, imagen_model):
+        self.imagen_model = imagen_model
+
+    def generate(self, prompt: str) -> bytes:
+        images = self.imagen_model.generate_images(
+            prompt=prompt,
+            number_of_images=1,
+            aspect_ratio="1:1",
+        )
+        return images[0]._image_bytes
+
+    def store(self, session_id: str, image_bytes: bytes) -> str:
+        image_path = f'sessions/{session_id}/targetModels/{str(uuid.uuid4())}.jpg'
+
+        blob = clients.bucket().blob(image_path)
+        blob.upload_from_string(image_bytes, content_type='image/jpeg')
+
+        session_ref = clients.firestore.collection('sessions').document(session_id)
+        session_ref.update({
+            'targetImages': firestore.ArrayUnion([image_path]),
+            'latestModelImagePath': image_path
+        })
+        return image_path
+
+
+class FakeImageBackend:
+    """Offline stand-in with fixed latencies, for load testing the queue."""
+
+    def __init__(self, generate_seconds: float = 2.0, store_seconds: float = 0.2):
+        self.generate_seconds = generate_seconds
+        self.store_seconds = store_seconds
+        self.generated = 0
+        self.stored = {}
+
+    def generate(self, prompt: str) -> bytes:
+        time.sleep(self.generate_seconds)
+        self.generated += 1
+        return hashlib.sha256(prompt.encode("utf-8")).digest()
+
+    def store(self, session_id: str, image_bytes: bytes) -> str:
+        time.sleep(self.store_seconds)
+        image_path = f'sessions/{session_id}/targetModels/{str(uuid.uuid4())}.jpg'
+        self.stored[image_path] = image_bytes
+        return image_path
+
+
+class ImageJob:
+    def __init__(self, session_id: str, details, conversation_history, timer=None):
+        self.session_id = session_id
+        self.details = details
+        self.conversation_history = conversation_history
+        self.timer = timer
+        self.submitted_at = time.perf_counter()
+        # Read from executor threads, which cancelling the task cannot stop
+        self.cancelled = False
+        self.task = None
+
+
+class ImageJobQueue:
+    """Target image generation on a bounded pool of workers.
+
+    Each session has at most one pending job; submitting again replaces it,
+    so rapid sketch submissions only generate for the latest one. A session
+    never has two jobs running at once, which keeps pushed images in order.
+    `on_complete(session_id, image_bytes, image_path)` is awaited when a job
+    finishes. A job's timer is reported once, when it finishes, fails or is
+    dropped."""
+
+    def __init__(self, backend, on_complete, workers: int = IMAGE_JOB_WORKERS):
+        self.backend = backend
+        self.on_complete = on_complete
+        self.workers = workers
+        self._queue = asyncio.Queue()
+        self._pending = {}
+        self._queued = set()
+        self._running = {}
+        self._worker_tasks = []
+        self.wait_time = Histogram()
+        self.run_time = Histogram()
+        self.counters = {"submitted": 0, "coalesced": 0, "completed": 0, "failed": 0, "cancelled": 0}
+
+    def start(self):
+        self._worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._worker_tasks:
+            task.cancel()
+        running = [job.task for job in self._running.values()]
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, *running, return_exceptions=True)
+        self._worker_tasks = []
+
+    def submit(self, job: ImageJob):
+        self.counters["submitted"] += 1
+        replaced = self._pending.get(job.session_id)
+        if replaced is not None:
+            self.counters["coalesced"] += 1
+            self._report(replaced)
+        self._pending[job.session_id] = job
+        self._enqueue(job.session_id)
+
+    def cancel(self, session_id: str):
+        pending = self._pending.pop(session_id, None)
+        if pending is not None:
+            self.counters["cancelled"] += 1
+            self._report(pending)
+        running = self._running.get(session_id)
+        if running is not None:
+            running.cancelled = True
+            running.task.cancel()
+
+    def _report(self, job: ImageJob):
+        if job.timer:
+            job.timer.report()
+
+    def _enqueue(self, session_id: str):
+        if session_id not in self._queued and session_id not in self._running:
+            self._queued.add(session_id)
+            self._queue.put_nowait(session_id)
+
+    async def _worker(self):
+        while True:
+            session_id = await self._queue.get()
+            self._queued.discard(session_id)
+            job = self._pending.pop(session_id, None)
+            if job is None:
+                continue
+
+            job.task = asyncio.create_task(self._run(job))
+            self._running[session_id] = job
+            try:
+                await job.task
+            except asyncio.CancelledError:
+                if asyncio.current_task().cancelling():
+                    raise
+                self.counters["cancelled"] += 1
+            except Exception as e:
+                print(f"Error generating image for session {session_id}: {str(e)}")
+                self.counters["failed"] += 1
+            finally:
+                self._report(job)
+                del self._running[session_id]
+                if session_id in self._pending:
+                    self._enqueue(session_id)
+
+    async def _run(self, job: ImageJob):
+        started = time.perf_counter()
+        self.wait_time.observe((started - job.submitted_at) * 1000)
+
+        prompt = build_target_prompt(job.details, job.conversation_history)
+        image_bytes = await run_blocking(self.backend.generate, prompt, executor=image_executor)
+        if job.timer:
+            job.timer.mark("imageReady")
+
+        image_path = await run_blocking(self._store, job, image_bytes)
+        if image_path is None:
+            raise asyncio.CancelledError()
+        if job.timer:
+            job.timer.mark("upload")
+
+        self.run_time.observe((time.perf_counter() - started) * 1000)
+        self.counters["completed"] += 1
+        await self.on_complete(job.session_id, image_bytes, image_path)
+
+    def _store(self, job: ImageJob, image_bytes: bytes):
+        # The upload also moves latestModelImagePath, so a job cancelled
+        # while its image was generating must not get this far
+        if job.cancelled:
+            return None
+        return self.backend.store(job.session_id, image_bytes)
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "pending": len(self._pending),
+            "running": len(self._running),
+            "waitMs": self.wait_time.summary(),
+            "runMs": self.run_time.summary(),
+        }
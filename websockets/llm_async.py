@@ -0,0 +1,84 @@
+import os
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from langchain_core.language_models.chat_models import BaseChatModel
+
+LLM_EXECUTOR_WORKERS = int(os.getenv("LLM_EXECUTOR_WORKERS", "16"))
+IO_EXECUTOR_WORKERS = int(os.getenv("IO_EXECUTOR_WORKERS", "16"))
+
+# Sync-only LLM clients hold a thread for a whole stream, so they get their
+# own pool; Firestore and Cloud Storage calls go on the I/O pool and are
+# never stuck behind them
+llm_executor = ThreadPoolExecutor(max_workers=LLM_EXECUTOR_WORKERS, thread_name_prefix="llm")
+io_executor = ThreadPoolExecutor(max_workers=IO_EXECUTOR_WORKERS, thread_name_prefix="io")
+
+_STREAM_END = object()
+
+
+class _StreamError:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+def has_native_async(llm, method: str) -> bool:
+    """Whether `llm` implements `method` ("_astream" or "_agenerate") without
+    LangChain's default sync fallback. Non-LangChain objects are duck typed on
+    their public `astream` / `ainvoke`."""
+    if isinstance(llm, BaseChatModel):
+        return getattr(type(llm), method) is not getattr(BaseChatModel, method)
+    public = {"_astream": "astream", "_agenerate": "ainvoke"}[method]
+    return hasattr(llm, public)
+
+
+async def run_blocking(func, *args, executor=None):
+    """Runs `func(*args)` on `executor`, the I/O pool by default."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor or io_executor, func, *args)
+
+
+async def ainvoke_llm(llm, messages):
+    if has_native_async(llm, "_agenerate"):
+        return await llm.ainvoke(messages)
+    return await run_blocking(llm.invoke, messages, executor=llm_executor)
+
+
+async def astream_llm(llm, messages):
+    if has_native_async(llm, "_astream"):
+        async for chunk in llm.astream(messages):
+            yield chunk
+        return
+
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    cancelled = threading.Event()
+
+    def put(item):
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+        except RuntimeError:
+            # Event loop already closed, nobody is listening any more
+            cancelled.set()
+
+    def produce():
+        try:
+            for chunk in llm.stream(messages):
+                if cancelled.is_set():
+                    break
+                put(chunk)
+        except BaseException as e:
+            put(_StreamError(e))
+        finally:
+            put(_STREAM_END)
+
+    loop.run_in_executor(llm_executor, produce)
+    try:
+        while True:
+            item = await queue.get()
+            if item is _STREAM_END:
+                break
+            if isinstance(item, _StreamError):
+                raise item.error
+            yield item
+    finally:
+        cancelled.set()
@@ -0,0 +1,68 @@
+from datetime import datetime
+from google.cloud import firestore
+
+from clients import clients
+
+HISTORY_COLLECTION = "RVSessionChats"
+MESSAGES_SUBCOLLECTION = "messages"
+# Holds a "complete" flag once every message of the session is in the log
+LOG_STATE_SUBCOLLECTION = "messageLog"
+FIRESTORE_BATCH_LIMIT = 500
+
+
+def history_entry(seq: int, message) -> dict:
+    timestamp = message.additional_kwargs.get("timestamp")
+    if isinstance(timestamp, datetime):
+        timestamp = timestamp.isoformat()
+    return {
+        "seq": seq,
+        "id": message.additional_kwargs.get("id"),
+        "user": message.additional_kwargs.get("user"),
+        "text": message.content,
+        "timestamp": timestamp
+    }
+
+
+def _messages_ref(client, session_id: str):
+    return client.collection(HISTORY_COLLECTION).document(session_id).collection(MESSAGES_SUBCOLLECTION)
+
+
+def write_entries(session_id: str, entries: list):
+    """Writes history entries as one document per message, ordered by seq.
+
+    Document ids are derived from seq so rewriting an entry is idempotent."""
+    messages_ref = _messages_ref(clients.firestore, session_id)
+    for i in range(0, len(entries), FIRESTORE_BATCH_LIMIT):
+        batch = clients.firestore.batch()
+        for entry in entries[i:i + FIRESTORE_BATCH_LIMIT]:
+            batch.set(messages_ref.document(f"{entry['seq']:08d}"), entry)
+        batch.commit()
+
+
+def _state_ref(client, session_id: str):
+    return client.collection(HISTORY_COLLECTION).document(session_id).collection(LOG_STATE_SUBCOLLECTION).document("state")
+
+
+async def log_complete(session_id: str) -> bool:
+    snapshot = await _state_ref(clients.firestore_async, session_id).get()
+    return snapshot.exists and bool(snapshot.get("complete"))
+
+
+async def mark_complete(session_id: str):
+    await _state_ref(clients.firestore_async, session_id).set({"complete": True})
+
+
+async def logged_count(session_id: str) -> int:
+    result = await _messages_ref(clients.firestore_async, session_id).count().get()
+    return int(result[0][0].value)
+
+
+async def fetch_page(session_id: str, before: int, limit: int) -> list:
+    """Up to `limit` entries with seq below `before`, oldest first; the
+    newest entries when `before` is None."""
+    query = _messages_ref(clients.firestore_async, session_id)
+    if before is not None:
+        query = query.where(filter=firestore.FieldFilter("seq", "<", before))
+    query = query.order_by("seq", direction=firestore.Query.DESCENDING).limit(limit)
+    docs = await query.get()
+    return [doc.to_dict() for doc in reversed(docs)]
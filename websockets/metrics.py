@@ -0,0 +1,52 @@
+import time
+from collections import defaultdict, deque
+
+
+class Histogram:
+    """Rolling window of recent samples, summarised on demand."""
+
+    def __init__(self, window: int = 1000):
+        self.samples = deque(maxlen=window)
+        self.count = 0
+
+    def observe(self, value: float):
+        self.samples.append(value)
+        self.count += 1
+
+    def summary(self) -> dict:
+        ordered = sorted(self.samples)
+        if not ordered:
+            return {"count": self.count}
+        return {
+            "count": self.count,
+            "p50": ordered[len(ordered) // 2],
+            "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+            "max": ordered[-1],
+        }
+
+
+stage_timings = defaultdict(Histogram)
+
+
+class StageTimer:
+    """Records elapsed milliseconds from the start of a request to each stage."""
+
+    def __init__(self, flow: str, session_id: str):
+        self.flow = flow
+        self.session_id = session_id
+        self.started = time.perf_counter()
+        self.marks = {}
+
+    def mark(self, stage: str) -> float:
+        elapsed = (time.perf_counter() - self.started) * 1000
+        self.marks[stage] = elapsed
+        stage_timings[f"{self.flow}.{stage}"].observe(elapsed)
+        return elapsed
+
+    def report(self):
+        stages = " ".join(f"{stage}={elapsed:.0f}ms" for stage, elapsed in self.marks.items())
+        print(f"[timings] {self.flow} session={self.session_id} {stages}")
+
+
+def snapshot_timings() -> dict:
+    return {name: histogram.summary() for name, histogram in sorted(stage_timings.items())}
@@ -0,0 +1,141 @@
+import os
+import asyncio
+from collections import defaultdict
+from langchain_core.messages import HumanMessage, SystemMessage
+
+from prompts.map import ROLLING_SUMMARY_PROMPT
+from llm_async import ainvoke_llm
+from admission import model_scheduler
+from metrics import Histogram
+
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "16000"))
+PROMPT_RECENT_MESSAGES = int(os.getenv("PROMPT_RECENT_MESSAGES", "8"))
+PROMPT_SUMMARY_BATCH = int(os.getenv("PROMPT_SUMMARY_BATCH", "12"))
+
+prompt_tokens = defaultdict(Histogram)
+omitted_messages = defaultdict(int)
+
+
+def estimate_tokens(text: str) -> int:
+    # Close enough to Gemini's tokenizer for budgeting English text
+    return len(text) // 4 + 1
+
+
+def message_text(message) -> str:
+    if isinstance(message.content, str):
+        return message.content
+    return " ".join(part.get("text", "") for part in message.content if isinstance(part, dict))
+
+
+def select_history(chat_history, reserved_tokens: int, budget: int = PROMPT_TOKEN_BUDGET):
+    """Picks the rolling summary and the newest messages that fit the budget.
+
+    The last PROMPT_RECENT_MESSAGES are always kept verbatim. Older messages
+    not yet folded into the summary are added newest first while they fit.
+    Returns the summary, the messages and how many messages were left out
+    of both."""
+    messages = chat_history.messages
+    summary = chat_history.summary
+    summarized = chat_history.summarized
+    remaining = budget - reserved_tokens - (estimate_tokens(summary) if summary else 0)
+    recent_start = max(summarized, len(messages) - PROMPT_RECENT_MESSAGES)
+
+    start = len(messages)
+    for index in range(len(messages) - 1, summarized - 1, -1):
+        cost = estimate_tokens(message_text(messages[index]))
+        if index < recent_start and cost > remaining:
+            break
+        remaining -= cost
+        start = index
+    return summary, messages[start:], start - summarized
+
+
+async def fit_history(chat_history, reserved_tokens: int, llm):
+    """select_history, first folding older turns into the summary if some
+    would otherwise be left out of the prompt.
+
+    Waits for a summary already in progress, or starts one for whatever is
+    outside the recent window. Turns are only omitted if summarising fails."""
+    selected = select_history(chat_history, reserved_tokens)
+    for _ in range(2):
+        if not selected[2]:
+            break
+        summarizer = chat_history.summarizer
+        if summarizer is None or summarizer.done():
+            refresh_summary(chat_history, llm, force=True)
+            summarizer = chat_history.summarizer
+        if summarizer is None or summarizer.done():
+            break
+        # Shielded so a cancelled prompt does not cancel the shared summary
+        await asyncio.shield(summarizer)
+        selected = select_history(chat_history, reserved_tokens)
+    return selected
+
+
+def log_prompt(flow: str, session_id: str, text: str, messages: int, omitted: int):
+    tokens = estimate_tokens(text)
+    prompt_tokens[flow].observe(tokens)
+    omitted_messages[flow] += omitted
+    print(f"[prompt] {flow} session={session_id} tokens={tokens} messages={messages} omitted={omitted}")
+
+
+async def chat_messages(chat_history, system_prompt: str, session_id: str, llm, flow: str = "chatOnly") -> list:
+    """System prompt, rolling summary and recent turns as chat messages."""
+    summary, messages, omitted = await fit_history(chat_history, estimate_tokens(system_prompt), llm)
+    if summary:
+        system_prompt = f"{system_prompt}\n\nSummary of the session so far:\n{summary}"
+    log_prompt(flow, session_id, "\n".join([system_prompt] + [message_text(m) for m in messages]), len(messages), omitted)
+    return [SystemMessage(content=system_prompt)] + messages
+
+
+async def transcript(chat_history, line, reserved_text: str, session_id: str, flow: str, llm) -> str:
+    """The summary and recent turns as text, one `line(message)` per message.
+
+    `reserved_text` is the rest of the prompt, counted against the budget."""
+    summary, messages, omitted = await fit_history(chat_history, estimate_tokens(reserved_text), llm)
+    parts = [f"Summary of earlier conversation: {summary}\n"] if summary else []
+    parts.extend(line(message) for message in messages)
+    text = "".join(parts)
+    log_prompt(flow, session_id, reserved_text + text, len(messages), omitted)
+    return text
+
+
+def refresh_summary(chat_history, llm, force: bool = False):
+    """Folds messages older than the recent window into the rolling summary.
+
+    Runs in the background once a batch of them has built up, or at once
+    with `force`; fit_history waits on it when a prompt would otherwise
+    leave turns out."""
+    end = len(chat_history.messages) - PROMPT_RECENT_MESSAGES
+    if end - chat_history.summarized < (1 if force else PROMPT_SUMMARY_BATCH):
+        return
+    if chat_history.summarizer is not None and not chat_history.summarizer.done():
+        return
+    chat_history.summarizer = asyncio.create_task(_summarize(chat_history, llm, end))
+
+
+async def _summarize(chat_history, llm, end: int):
+    start = chat_history.summarized
+    turns = "".join(
+        f"{message.additional_kwargs.get('user', 'Unknown')}: {message_text(message)}\n"
+        for message in chat_history.messages[start:end]
+    )
+    parts = [ROLLING_SUMMARY_PROMPT]
+    if chat_history.summary:
+        parts.append(f"\nSummary so far:\n{chat_history.summary}\n")
+    parts.append(f"\nNew turns:\n{turns}")
+    try:
+        with model_scheduler.background("summary"):
+            response = await ainvoke_llm(llm, [HumanMessage(content="".join(parts))])
+    except Exception as e:
+        print(f"Failed to summarise session {chat_history.session_id}: {e}")
+        return
+    chat_history.summary = response.content
+    chat_history.summarized = end
+
+
+def snapshot_prompt_tokens() -> dict:
+    return {
+        flow: {**histogram.summary(), "omittedMessages": omitted_messages[flow]}
+        for flow, histogram in sorted(prompt_tokens.items())
+    }
@@ -3,4 +3,5 @@ from .sessions import (
 )
 
 SESSION_SYSTEM_PROMPT = core.SYSTEM_INSTRUCTION
-DETAIL_EXTRACTION_PROMPT = core.DETAIL_EXTRACTION
\ No newline at end of file
+DETAIL_EXTRACTION_PROMPT = core.DETAIL_EXTRACTION
+ROLLING_SUMMARY_PROMPT = core.ROLLING_SUMMARY
\ No newline at end of file
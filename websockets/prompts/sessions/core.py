@@ -36,4 +36,12 @@ Collecting specific details such as
 - General terrain features
 - Cultural aspects
 - Sounds
+"""
+
+ROLLING_SUMMARY = """
+You are keeping notes for a project monitor on a remote viewing session. Update
+the summary below with the new turns of the conversation. Keep every impression,
+detail and sketch description the viewer gave and any instructions the monitor
+gave, in the order they happened. Write plain prose of no more than 300 words
+and return only the updated summary.
 """
\ No newline at end of file
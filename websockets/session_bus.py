@@ -0,0 +1,311 @@
+"""Session fan-out across server processes.
+
+`InMemorySessionBus` keeps everything on this process, as a single worker
+always has. `NetworkSessionBus` relays broadcasts, stage changes and session
+events through a pub/sub broker so several uvicorn workers or Cloud Run
+instances can serve one session: Redis in production, or `LocalBroker`, a
+small TCP stand-in started with
+
+    python session_bus.py --serve 127.0.0.1:7379
+
+What is shared between nodes serving one session: broadcasts, the stage,
+chat history (appended in a transaction, with `historyChanged` dropping
+stale copies), the session document (`sessionStateChanged`) and sketches
+sent as a sketchRef (kept in the broker for SKETCH_SHARE_SECONDS). What
+stays per node: admission (one model call at a time per session is
+enforced on each node, not across them) and resync of a reply still being
+streamed, which only the node generating it can send to a client that
+reconnects there.
+"""
+import os
+import sys
+import json
+import uuid
+import asyncio
+import itertools
+from collections import defaultdict
+
+SESSION_BUS = os.getenv("SESSION_BUS", "memory")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+SESSION_BUS_ADDRESS = os.getenv("SESSION_BUS_ADDRESS", "127.0.0.1:7379")
+SKETCH_SHARE_SECONDS = int(os.getenv("SKETCH_SHARE_SECONDS", "3600"))
+# A session's shared stage is dropped this long after its last change
+SESSION_STAGE_SECONDS = int(os.getenv("SESSION_STAGE_SECONDS", "86400"))
+BROKER_RETRY_SECONDS = float(os.getenv("BROKER_RETRY_SECONDS", "1"))
+
+CHANNEL_PREFIX = "stargate:session:"
+LINE_LIMIT = 16 * 1024 * 1024
+
+
+class InMemorySessionBus:
+    def __init__(self):
+        self.deliver = None
+
+    async def start(self, deliver, on_stage, on_event):
+        self.deliver = deliver
+
+    async def stop(self):
+        pass
+
+    async def join(self, session_id: str):
+        """Subscribes this node to a session; returns the shared stage if known."""
+        return None
+
+    async def leave(self, session_id: str):
+        pass
+
+    async def publish(self, session_id: str, payload: str, exclude=None):
+        self.deliver(session_id, payload, exclude)
+
+    async def set_stage(self, session_id: str, stage: int):
+        pass
+
+    async def notify(self, session_id: str, event: str):
+        pass
+
+    async def share(self, key: str, value: str, ttl: int):
+        """Makes `value` available to other nodes for `ttl` seconds."""
+
+    async def lookup(self, key: str):
+        """A value another node shared, or None."""
+        return None
+
+
+class NetworkSessionBus(InMemorySessionBus):
+    """Relays through a broker; local clients are delivered to directly.
+
+    Messages on a session's channel are framed as "kind|node|body" so each
+    node can skip its own: "m" is a serialized frame, "s" a stage change and
+    "e" a named session event."""
+
+    def __init__(self, broker):
+        super().__init__()
+        self.broker = broker
+        self.node_id = uuid.uuid4().hex
+        self.on_stage = None
+        self.on_event = None
+
+    async def start(self, deliver, on_stage, on_event):
+        self.deliver = deliver
+        self.on_stage = on_stage
+        self.on_event = on_event
+        await self.broker.connect(self._on_message)
+
+    async def stop(self):
+        await self.broker.close()
+
+    async def join(self, session_id: str):
+        await self.broker.subscribe(CHANNEL_PREFIX + session_id)
+        stage = await self.broker.get(f"{CHANNEL_PREFIX}{session_id}:stage")
+        return int(stage) if stage is not None else None
+
+    async def leave(self, session_id: str):
+        await self.broker.unsubscribe(CHANNEL_PREFIX + session_id)
+
+    async def publish(self, session_id: str, payload: str, exclude=None):
+        self.deliver(session_id, payload, exclude)
+        await self.broker.publish(CHANNEL_PREFIX + session_id, f"m|{self.node_id}|{payload}")
+
+    async def set_stage(self, session_id: str, stage: int):
+        await self.broker.set(f"{CHANNEL_PREFIX}{session_id}:stage", str(stage), SESSION_STAGE_SECONDS)
+        await self.broker.publish(CHANNEL_PREFIX + session_id, f"s|{self.node_id}|{stage}")
+
+    async def notify(self, session_id: str, event: str):
+        await self.broker.publish(CHANNEL_PREFIX + session_id, f"e|{self.node_id}|{event}")
+
+    async def share(self, key: str, value: str, ttl: int):
+        await self.broker.set(f"stargate:shared:{key}", value, ttl)
+
+    async def lookup(self, key: str):
+        return await self.broker.get(f"stargate:shared:{key}")
+
+    def _on_message(self, channel: str, data: str):
+        kind, node_id, body = data.split("|", 2)
+        if node_id == self.node_id:
+            return
+        session_id = channel[len(CHANNEL_PREFIX):]
+        if kind == "m":
+            self.deliver(session_id, body, None)
+        elif kind == "s":
+            self.on_stage(session_id, int(body))
+        elif kind == "e":
+            self.on_event(session_id, body)
+
+
+class RedisBroker:
+    """Broker on Redis pub/sub; needs the `redis` package (>= 5.0.1)."""
+
+    def __init__(self, url: str = REDIS_URL):
+        import redis.asyncio as redis
+
+        self.redis = redis.from_url(url, decode_responses=True)
+        self.pubsub = self.redis.pubsub()
+        self._reader = None
+
+    async def connect(self, on_message):
+        self.on_message = on_message
+        self._reader = asyncio.create_task(self._read())
+
+    async def _read(self):
+        failures = 0
+        while True:
+            if not self.pubsub.subscribed:
+                await asyncio.sleep(0.1)
+                continue
+            try:
+                # A dropped connection is reopened, and its channels
+                # resubscribed, by the next get_message
+                message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                failures = 0
+                if message is not None:
+                    self.on_message(message["channel"], message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                failures += 1
+                delay = min(BROKER_RETRY_SECONDS * 2 ** (failures - 1), 30)
+                print(f"Redis session bus read failed, reconnecting in {delay}s: {e}")
+                await asyncio.sleep(delay)
+
+    async def subscribe(self, channel: str):
+        await self.pubsub.subscribe(channel)
+
+    async def unsubscribe(self, channel: str):
+        await self.pubsub.unsubscribe(channel)
+
+    async def publish(self, channel: str, data: str):
+        await self.redis.publish(channel, data)
+
+    async def get(self, key: str):
+        return await self.redis.get(key)
+
+    async def set(self, key: str, value: str, ttl: int = None):
+        await self.redis.set(key, value, ex=ttl)
+
+    async def close(self):
+        if self._reader is not None:
+            self._reader.cancel()
+        await self.pubsub.aclose()
+        await self.redis.aclose()
+
+
+class LocalBroker:
+    """Client for the newline-delimited JSON broker served by `serve_local_broker`."""
+
+    def __init__(self, address: str = SESSION_BUS_ADDRESS):
+        host, port = address.rsplit(":", 1)
+        self.host = host
+        self.port = int(port)
+        self._ids = itertools.count()
+        self._replies = {}
+        self._reader_task = None
+
+    async def connect(self, on_message):
+        self.on_message = on_message
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port, limit=LINE_LIMIT)
+        self._reader_task = asyncio.create_task(self._read())
+
+    async def _read(self):
+        async for line in self.reader:
+            message = json.loads(line)
+            if message["op"] == "msg":
+                self.on_message(message["ch"], message["data"])
+            elif message["op"] == "val":
+                reply = self._replies.pop(message["id"], None)
+                if reply is not None and not reply.done():
+                    reply.set_result(message["value"])
+
+    async def _send(self, command: dict):
+        self.writer.write((json.dumps(command) + "\n").encode("utf-8"))
+        await self.writer.drain()
+
+    async def subscribe(self, channel: str):
+        await self._send({"op": "sub", "ch": channel})
+
+    async def unsubscribe(self, channel: str):
+        await self._send({"op": "unsub", "ch": channel})
+
+    async def publish(self, channel: str, data: str):
+        await self._send({"op": "pub", "ch": channel, "data": data})
+
+    async def get(self, key: str):
+        request_id = next(self._ids)
+        reply = self._replies[request_id] = asyncio.get_running_loop().create_future()
+        await self._send({"op": "get", "key": key, "id": request_id})
+        return await reply
+
+    async def set(self, key: str, value: str, ttl: int = None):
+        await self._send({"op": "set", "key": key, "value": value, "ttl": ttl})
+
+    async def close(self):
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except Exception:
+            pass
+
+
+async def serve_local_broker(address: str = SESSION_BUS_ADDRESS):
+    host, port = address.rsplit(":", 1)
+    subscribers = defaultdict(set)
+    # key -> (value, expiry in loop time or None)
+    values = {}
+
+    async def handle(reader, writer):
+        channels = set()
+        try:
+            async for line in reader:
+                command = json.loads(line)
+                op = command["op"]
+                if op == "sub":
+                    subscribers[command["ch"]].add(writer)
+                    channels.add(command["ch"])
+                elif op == "unsub":
+                    subscribers[command["ch"]].discard(writer)
+                    channels.discard(command["ch"])
+                elif op == "pub":
+                    message = (json.dumps({"op": "msg", "ch": command["ch"], "data": command["data"]}) + "\n").encode("utf-8")
+                    for subscriber in list(subscribers[command["ch"]]):
+                        subscriber.write(message)
+                elif op == "get":
+                    value, expires = values.get(command["key"], (None, None))
+                    if expires is not None and expires < loop.time():
+                        value = None
+                        values.pop(command["key"], None)
+                    reply = {"op": "val", "id": command["id"], "value": value}
+                    writer.write((json.dumps(reply) + "\n").encode("utf-8"))
+                elif op == "set":
+                    ttl = command.get("ttl")
+                    values[command["key"]] = (command["value"], loop.time() + ttl if ttl else None)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            for channel in channels:
+                subscribers[channel].discard(writer)
+            writer.close()
+
+    loop = asyncio.get_running_loop()
+    return await asyncio.start_server(handle, host, int(port), limit=LINE_LIMIT)
+
+
+def create_session_bus(kind: str = SESSION_BUS):
+    if kind == "redis":
+        return NetworkSessionBus(RedisBroker())
+    if kind == "local":
+        return NetworkSessionBus(LocalBroker())
+    return InMemorySessionBus()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "--serve":
+        sys.exit("usage: python session_bus.py --serve [host:port]")
+
+    async def serve_forever(address):
+        server = await serve_local_broker(address)
+        print(f"Local session broker listening on {address}")
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(serve_forever(sys.argv[2] if len(sys.argv) > 2 else SESSION_BUS_ADDRESS))
@@ -1,48 +1,292 @@
 import os
-import json
+import time
+import uuid
+import asyncio
+from collections import defaultdict
 from fastapi import WebSocket
-from google.cloud import storage
-from google.cloud import firestore
 import base64
 
+from clients import clients
+from llm_async import run_blocking
+from metrics import Histogram, StageTimer
+from message_log import history_entry, fetch_page
+from session_bus import create_session_bus, SKETCH_SHARE_SECONDS
+from session_state import session_state
+from history_cache import history_cache
+from codec import dumps, codec_for, send_message
+from sketches import sketch_store
+from details import recorded_details
+
+IMAGE_DELIVERY_MODES = ("inline", "url", "binary", "none")
+IMAGE_CHUNK_BYTES = int(os.getenv("IMAGE_CHUNK_BYTES", str(64 * 1024)))
+HISTORY_WINDOW = int(os.getenv("HISTORY_WINDOW", "50"))
+HISTORY_PAGE_MAX = 200
+
+OUTBOUND_QUEUE_SIZE = int(os.getenv("OUTBOUND_QUEUE_SIZE", "256"))
+SEND_TIMEOUT_SECONDS = float(os.getenv("SEND_TIMEOUT_SECONDS", "5"))
+
 connected_clients = {}
+channels = {}
+join_payload_bytes = defaultdict(Histogram)
+fanout_latency = defaultdict(Histogram)
+fanout_counters = {"broadcasts": 0, "frames": 0, "evicted": 0}
+session_event_handlers = defaultdict(list)
+session_bus = create_session_bus()
+
+
+class ClientChannel:
+    """Outbound queue and sender task for one websocket.
+
+    Broadcasts only enqueue, so a slow client never delays the rest of its
+    session. A client whose queue fills up, or whose send stalls past the
+    timeout, is evicted and its socket closed."""
+
+    def __init__(self, session_id: str, websocket: WebSocket):
+        self.session_id = session_id
+        self.websocket = websocket
+        self.codec = codec_for(websocket)
+        self.queue = asyncio.Queue(maxsize=OUTBOUND_QUEUE_SIZE)
+        self.closed = False
+        self._sender = asyncio.create_task(self._send_loop())
+        self._closer = None
+
+    def offer(self, payload: str):
+        if self.closed:
+            return
+        try:
+            self.queue.put_nowait((payload, time.perf_counter()))
+        except asyncio.QueueFull:
+            self.evict("outbound queue full")
+
+    async def _send_loop(self):
+        while True:
+            payload, queued_at = await self.queue.get()
+            try:
+                await asyncio.wait_for(self.codec.send(self.websocket, payload), SEND_TIMEOUT_SECONDS)
+            except asyncio.TimeoutError:
+                self.evict("send timed out")
+                return
+            except Exception as e:
+                self.evict(f"send failed: {e}")
+                return
+            fanout_latency[self.session_id].observe((time.perf_counter() - queued_at) * 1000)
+
+    def evict(self, reason: str):
+        if self.closed:
+            return
+        print(f"Evicting client from session {self.session_id}: {reason}")
+        fanout_counters["evicted"] += 1
+        self.closed = True
+        session = connected_clients.get(self.session_id)
+        if session is not None:
+            session["clients"].discard(self.websocket)
+        self._closer = asyncio.create_task(self._close_socket(reason))
+
+    async def _close_socket(self, reason: str):
+        self.close()
+        try:
+            await asyncio.wait_for(self.websocket.close(code=1013, reason=reason), SEND_TIMEOUT_SECONDS)
+        except Exception:
+            pass
+
+    def close(self):
+        self.closed = True
+        if self._sender is not asyncio.current_task():
+            self._sender.cancel()
+
+
+def deliver_local(session_id: str, payload: str, exclude: WebSocket = None):
+    session = connected_clients.get(session_id)
+    if session is None:
+        return
+    # Encoded at most once per codec, however many clients use it
+    encoded = {}
+    for client in list(session["clients"]):
+        if client != exclude:
+            channel = channels[client]
+            if channel.codec not in encoded:
+                encoded[channel.codec] = channel.codec.transcode(payload)
+            channel.offer(encoded[channel.codec])
+            fanout_counters["frames"] += 1
+
+
+def apply_stage(session_id: str, stage: int):
+    session = connected_clients.get(session_id)
+    if session is not None:
+        session["stage"] = stage
+    # The node that changed the stage writes it
+    session_state.remember(session_id, {"currentStage": stage})
+
+
+def on_session_event(event: str, handler):
+    """Registers `handler(session_id)` for events notified on other nodes."""
+    session_event_handlers[event].append(handler)
+
+
+def dispatch_session_event(session_id: str, event: str):
+    for handler in session_event_handlers.get(event, []):
+        handler(session_id)
+
+
+async def notify_session_event(session_id: str, event: str):
+    await session_bus.notify(session_id, event)
+
+
+async def start_session_bus():
+    await session_bus.start(deliver_local, apply_stage, dispatch_session_event)
+
+
+async def register_client(session_id: str, websocket: WebSocket):
+    session = connected_clients.get(session_id)
+    if session is None:
+        session = connected_clients[session_id] = {
+            "clients": set(),
+            "stage": 1
+        }
+        stage = await session_bus.join(session_id)
+        if stage is None:
+            stage = (await session_state.get(session_id)).get('currentStage', 1)
+        session["stage"] = stage
+    channel = channels.get(websocket)
+    if channel is None:
+        channel = channels[websocket] = ClientChannel(session_id, websocket)
+    # An evicted client stays out even if its socket delivers more messages
+    if not channel.closed:
+        session["clients"].add(websocket)
+
+
+async def unregister_client(session_id: str, websocket: WebSocket):
+    channel = channels.pop(websocket, None)
+    if channel is not None:
+        channel.close()
+    session = connected_clients.get(session_id)
+    if session is not None:
+        session["clients"].discard(websocket)
+        if not session["clients"]:
+            del connected_clients[session_id]
+            fanout_latency.pop(session_id, None)
+            await session_bus.leave(session_id)
+            await session_state.release(session_id)
+
+
+def local_peers(session_id: str, websocket: WebSocket) -> int:
+    """Clients of the session on this node other than `websocket`."""
+    session = connected_clients.get(session_id)
+    if session is None:
+        return 0
+    return len(session["clients"] - {websocket})
 
 async def broadcast_to_session(session_id: str, message: dict, exclude: WebSocket = None):
     if session_id in connected_clients:
         current_stage = connected_clients[session_id]["stage"]
         message["stageNumber"] = current_stage
-        for client in connected_clients[session_id]["clients"]:
-            if client != exclude:
-                await client.send_text(json.dumps(message))
+        payload = dumps(message)
+        fanout_counters["broadcasts"] += 1
+        await session_bus.publish(session_id, payload, exclude)
+
+
+def session_backlog(session_id: str) -> int:
+    """Deepest outbound queue among the session's clients."""
+    session = connected_clients.get(session_id)
+    if session is None:
+        return 0
+    return max((channels[client].queue.qsize() for client in session["clients"] if client in channels), default=0)
+
+
+def fanout_stats() -> dict:
+    return {
+        **fanout_counters,
+        "sessions": {session_id: histogram.summary() for session_id, histogram in fanout_latency.items()},
+    }
 
 async def update_stage(session_id: str, new_stage: int):
     if session_id in connected_clients:
         connected_clients[session_id]["stage"] = new_stage
+        await session_state.update(session_id, {'currentStage': new_stage})
+        await session_bus.set_stage(session_id, new_stage)
         await broadcast_to_session(session_id, {
             "type": "syncStage",
             "stageNumber": new_stage,
         })
 
-async def handle_session_join(chat_history, websocket, session_id):
-    initial_history = []
-    for message in chat_history.messages:
-        initial_history.append({
-            "id": message.additional_kwargs.get("id"),
-            "user": message.additional_kwargs.get("user"),
-            "text": message.content,
-            "timestamp": message.additional_kwargs.get("timestamp")
-        })
+def find_latest_model_image(session_id: str, session_data: dict):
+    image_path = (session_data or {}).get('latestModelImagePath')
+    if image_path:
+        return image_path
+
+    # Sessions modelled before the pointer was recorded on the document;
+    # backfill_latest_model.py migrates these
+    blobs = list(clients.bucket().list_blobs(prefix=f'sessions/{session_id}/targetModels'))
+    if blobs:
+        return max(blobs, key=lambda x: x.time_created).name
+
+async def send_image_frames(websocket: WebSocket, image_path: str, target: str):
+    """Streams an image from GCS as binary frames, one chunk in memory at a time.
+
+    Each binary frame is the 36 character transfer id followed by the chunk,
+    so transfers can be told apart from other binary traffic on the socket."""
+    transfer_id = str(uuid.uuid4())
+    prefix = transfer_id.encode("ascii")
+    # Binary codec clients get imageChunk messages instead, since every
+    # frame on their socket is a MessagePack message
+    binary_codec = codec_for(websocket).binary
+    await send_message(websocket, {
+        "type": "imageTransfer",
+        "id": transfer_id,
+        "target": target,
+        "contentType": "image/jpeg"
+    })
+
+    reader = await run_blocking(
+        lambda: clients.bucket().blob(image_path).open("rb", chunk_size=IMAGE_CHUNK_BYTES)
+    )
+    try:
+        while chunk := await run_blocking(reader.read, IMAGE_CHUNK_BYTES):
+            if binary_codec:
+                await send_message(websocket, {"type": "imageChunk", "id": transfer_id, "data": chunk})
+            else:
+                await websocket.send_bytes(prefix + chunk)
+    finally:
+        reader.close()
+
+    await send_message(websocket, {
+        "type": "imageTransferComplete",
+        "id": transfer_id,
+        "target": target
+    })
 
-    db = firestore.Client()
-    session_ref = db.collection('sessions').document(session_id)
-    session_data = session_ref.get().to_dict()
+async def handle_session_join(websocket, session_id, image_delivery: str = "inline"):
+    """Sends the session history, then the latest target model image.
 
-    current_stage = session_data.get('currentStage', 1)
+    `image_delivery` is "inline" (base64 inside initialHistory), "url" (a
+    signed GCS URL in a following updateTargetImage frame), "binary"
+    (chunked binary frames after initialHistory) or "none"."""
+    if image_delivery not in IMAGE_DELIVERY_MODES:
+        image_delivery = "inline"
+    timer = StageTimer(f"joinSession.{image_delivery}", session_id)
+
+    # Only the most recent window is sent; older messages are paged in
+    # with fetchHistory using historyCursor. The window is read from the
+    # message log unless the history is in memory already, so a join does
+    # not load the whole chat history document.
+    chat_history = await history_cache.logged(session_id)
+    if chat_history is not None:
+        window_start = max(0, len(chat_history.messages) - HISTORY_WINDOW)
+        initial_history = [
+            history_entry(seq, message)
+            for seq, message in enumerate(chat_history.messages[window_start:], start=window_start)
+        ]
+    else:
+        initial_history = await fetch_page(session_id, None, HISTORY_WINDOW)
+        window_start = initial_history[0]["seq"] if initial_history else 0
+
+    session_data = await session_state.get(session_id)
+
+    session = connected_clients.get(session_id)
+    current_stage = session["stage"] if session else session_data.get('currentStage', 1)
     status = session_data.get('status', 'incomplete')
     
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(os.getenv("STORAGE_BUCKET"))
-    
+    latest_image_path = None
     latest_image_base64 = None
     target_image_path = None
     summary = None
@@ -51,17 +295,18 @@ async def handle_session_join(chat_history, websocket, session_id):
     if status == 'completed':
         target_image_path = session_data.get('targetImagePath')
         summary = session_data.get('summary')
-        details = session_data.get('detailsList', {})
-    else:
-        blobs = list(bucket.list_blobs(prefix=f'sessions/{session_id}/targetModels'))
-        if blobs:
-            latest_blob = max(blobs, key=lambda x: x.time_created)
-            image_bytes = latest_blob.download_as_bytes()
+        details = recorded_details(session_data)
+    elif image_delivery == "inline":
+        latest_image_path = await run_blocking(find_latest_model_image, session_id, session_data)
+        if latest_image_path:
+            image_bytes = await run_blocking(lambda: clients.bucket().blob(latest_image_path).download_as_bytes())
             latest_image_base64 = base64.b64encode(image_bytes).decode('utf-8')
 
-    await websocket.send_text(json.dumps({
+    codec = codec_for(websocket)
+    payload = codec.encode({
         "type": "initialHistory",
         "history": initial_history,
+        "historyCursor": window_start if window_start > 0 else None,
         "currentStage": current_stage,
         "status": status,
         "detailsList": details,
@@ -71,4 +316,76 @@ async def handle_session_join(chat_history, websocket, session_id):
             "summary": summary,
             "details": details
         } if status == 'completed' else None
-    }))
+    })
+    await codec.send(websocket, payload)
+    timer.mark("firstFrame")
+    join_payload_bytes[image_delivery].observe(len(payload))
+
+    # The history is on screen by now; locating and delivering the image
+    # no longer holds it up
+    if status != 'completed' and image_delivery in ("url", "binary"):
+        latest_image_path = await run_blocking(find_latest_model_image, session_id, session_data)
+
+    if latest_image_path and image_delivery == "url":
+        try:
+            image_url = await run_blocking(clients.signed_url, latest_image_path)
+        except Exception as e:
+            # User ADC has no key to sign with, and a service account may
+            # lack iam.serviceAccounts.signBlob
+            print(f"Could not sign a URL for {latest_image_path}, sending the image inline: {e}")
+            image_bytes = await run_blocking(lambda: clients.bucket().blob(latest_image_path).download_as_bytes())
+            await send_message(websocket, {
+                "type": "updateTargetImage",
+                "imageBase64": base64.b64encode(image_bytes).decode('utf-8'),
+                "restored": True,
+                "stageNumber": current_stage
+            })
+        else:
+            await send_message(websocket, {
+                "type": "updateTargetImage",
+                "imageUrl": image_url,
+                "stageNumber": current_stage
+            })
+        timer.mark("imageDelivered")
+    elif latest_image_path and image_delivery == "binary":
+        await send_image_frames(websocket, latest_image_path, "latestTargetImage")
+        timer.mark("imageDelivered")
+
+async def handle_fetch_history(websocket: WebSocket, session_id: str, before, limit):
+    """Pages backwards through the message log from a historyCursor."""
+    try:
+        before = int(before)
+        limit = max(1, min(int(limit or HISTORY_WINDOW), HISTORY_PAGE_MAX))
+    except (TypeError, ValueError):
+        await send_message(websocket, {"type": "error", "message": "fetchHistory needs a numeric historyCursor"})
+        return
+    if before > 0:
+        # Older pages are only complete once the log has been backfilled
+        await history_cache.logged(session_id)
+        messages = await fetch_page(session_id, before, limit)
+    else:
+        messages = []
+    cursor = messages[0]["seq"] if messages else None
+
+    await send_message(websocket, {
+        "type": "historyPage",
+        "before": before,
+        "messages": messages,
+        "historyCursor": cursor if cursor else None
+    })
+
+async def share_sketch(sketch):
+    """Lets clients on other nodes fetch a sketch that is broadcast as a sketchRef."""
+    await session_bus.share(f"sketch:{sketch.hash}", sketch.data_url, SKETCH_SHARE_SECONDS)
+
+async def handle_fetch_sketch(websocket: WebSocket, sketch_hash: str):
+    """Sends a sketch that was broadcast as a sketchRef, if still cached here or shared."""
+    sketch = sketch_store.get(sketch_hash)
+    data_url = sketch.data_url if sketch else await session_bus.lookup(f"sketch:{sketch_hash}")
+    if data_url:
+        sketch_store.record_peer_fetch(len(data_url))
+    await send_message(websocket, {
+        "type": "sketch",
+        "hash": sketch_hash,
+        "sketch": data_url
+    })
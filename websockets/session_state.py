@@ -0,0 +1,144 @@
+import os
+import asyncio
+
+from clients import clients
+from metrics import Histogram
+
+SESSION_WRITE_DELAY_SECONDS = float(os.getenv("SESSION_WRITE_DELAY_SECONDS", "2"))
+
+
+class SessionState:
+    """In-memory copy of a session document with its unwritten fields."""
+
+    def __init__(self, session_id: str, data: dict):
+        self.session_id = session_id
+        self.data = data
+        self.pending = {}
+        self.updates = 0
+        self.writes = 0
+        self._writer = None
+        self._wake = asyncio.Event()
+
+    @property
+    def dirty(self) -> bool:
+        return bool(self.pending) or (self._writer is not None and not self._writer.done())
+
+
+class SessionStateStore:
+    """Write-behind cache of the `sessions` documents of active sessions.
+
+    Updates apply to the cached document at once and are merged into a single
+    Firestore write per session every `delay` seconds. `release` writes out
+    and forgets a session once its last client leaves, and `flush_all` runs
+    at shutdown. Other nodes serving the session drop their copy through
+    `invalidate` once a write lands, as with the history cache."""
+
+    def __init__(self, delay: float = SESSION_WRITE_DELAY_SECONDS):
+        self.delay = delay
+        self._states = {}
+        self._loading = {}
+        self.updates = 0
+        self.writes = 0
+        self.write_errors = 0
+        self.writes_per_session = Histogram()
+        # Awaited with the session id after each write reaches Firestore
+        self.on_written = None
+
+    async def get(self, session_id: str) -> dict:
+        state = self._states.get(session_id)
+        if state is None:
+            loading = self._loading.get(session_id)
+            if loading is None:
+                loading = asyncio.ensure_future(self._load(session_id))
+                self._loading[session_id] = loading
+            state = await asyncio.shield(loading)
+        return state.data
+
+    async def _load(self, session_id: str) -> SessionState:
+        try:
+            snapshot = await clients.firestore_async.collection('sessions').document(session_id).get()
+            state = SessionState(session_id, snapshot.to_dict() or {})
+            self._states[session_id] = state
+            return state
+        finally:
+            del self._loading[session_id]
+
+    def remember(self, session_id: str, fields: dict):
+        """Updates the cached document for fields already written elsewhere."""
+        state = self._states.get(session_id)
+        if state is not None:
+            state.data.update(fields)
+
+    def invalidate(self, session_id: str):
+        """Drops a session whose document was written by another node."""
+        state = self._states.get(session_id)
+        if state is not None and not state.dirty:
+            del self._states[session_id]
+
+    async def update(self, session_id: str, fields: dict):
+        await self.get(session_id)
+        state = self._states[session_id]
+        state.data.update(fields)
+        state.pending.update(fields)
+        state.updates += 1
+        self.updates += 1
+        if state._writer is None or state._writer.done():
+            state._wake = asyncio.Event()
+            state._writer = asyncio.create_task(self._write_later(state))
+
+    async def _write_later(self, state: SessionState):
+        # flush sets _wake to write without waiting out the delay
+        try:
+            await asyncio.wait_for(state._wake.wait(), self.delay)
+        except asyncio.TimeoutError:
+            pass
+        await self._write(state)
+
+    async def _write(self, state: SessionState):
+        while state.pending:
+            fields, state.pending = state.pending, {}
+            try:
+                await clients.firestore_async.collection('sessions').document(state.session_id).set(fields, merge=True)
+            except Exception as e:
+                print(f"Failed to write session state for session {state.session_id}: {e}")
+                self.write_errors += 1
+                # Newer values for the same fields win over the failed batch
+                state.pending = {**fields, **state.pending}
+                return
+            state.writes += 1
+            self.writes += 1
+            if self.on_written is not None:
+                await self.on_written(state.session_id)
+
+    async def flush(self, session_id: str):
+        state = self._states.get(session_id)
+        if state is None:
+            return
+        state._wake.set()
+        while state._writer is not None and not state._writer.done():
+            await state._writer
+        if state.pending:
+            await self._write(state)
+
+    async def release(self, session_id: str):
+        """Writes out a session nobody on this node is connected to and drops it."""
+        await self.flush(session_id)
+        state = self._states.get(session_id)
+        if state is not None and not state.dirty:
+            del self._states[session_id]
+            self.writes_per_session.observe(state.writes)
+
+    async def flush_all(self):
+        await asyncio.gather(*(self.flush(session_id) for session_id in list(self._states)))
+
+    def stats(self) -> dict:
+        return {
+            "sessions": len(self._states),
+            "updates": self.updates,
+            "writes": self.writes,
+            "writeErrors": self.write_errors,
+            "writesPerSession": self.writes_per_session.summary(),
+        }
+
+
+session_state = SessionStateStore()
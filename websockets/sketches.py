@@ -0,0 +1,137 @@
+import os
+import io
+import base64
+import hashlib
+from collections import OrderedDict
+from PIL import Image
+
+from llm_async import run_blocking
+from metrics import Histogram
+
+SKETCH_MAX_SIDE = int(os.getenv("SKETCH_MAX_SIDE", "768"))
+SKETCH_JPEG_QUALITY = int(os.getenv("SKETCH_JPEG_QUALITY", "80"))
+SKETCH_CACHE_SIZE = int(os.getenv("SKETCH_CACHE_SIZE", "256"))
+SKETCH_PNG_COLOURS = int(os.getenv("SKETCH_PNG_COLOURS", "64"))
+
+
+class Sketch:
+    """A decoded sketch, normalized to what the model is sent."""
+
+    def __init__(self, digest: str, image_bytes: bytes, media_type: str, original_size: int):
+        self.hash = digest
+        self.image_bytes = image_bytes
+        self.media_type = media_type
+        self.original_size = original_size
+        self.data_url = f"data:{media_type};base64," + base64.b64encode(image_bytes).decode("ascii")
+
+
+def _encode(image: Image.Image, image_format: str) -> bytes:
+    output = io.BytesIO()
+    if image_format == "JPEG":
+        image.save(output, format="JPEG", quality=SKETCH_JPEG_QUALITY, optimize=True)
+    else:
+        # Sketches use few colours, and a palette keeps antialiased edges cheap
+        image.quantize(colors=SKETCH_PNG_COLOURS).save(output, format="PNG", optimize=True)
+    return output.getvalue()
+
+
+def normalize_sketch(data_url: str) -> Sketch:
+    """Decodes a sketch data URL to a flattened image no larger than SKETCH_MAX_SIDE.
+
+    Line drawings are often smaller as PNG than JPEG, so both are tried, and
+    an upload that is already small enough is kept if neither beats it."""
+    encoded = data_url.split(",", 1)[1] if data_url.startswith("data:") else data_url
+    raw = base64.b64decode(encoded)
+
+    image = Image.open(io.BytesIO(raw))
+    candidates = []
+    if image.format in ("JPEG", "PNG") and max(image.size) <= SKETCH_MAX_SIDE and image.mode == "RGB":
+        candidates.append((raw, image.format))
+    if image.mode in ("RGBA", "LA", "P"):
+        # Transparent canvas areas would otherwise turn black
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, "white")
+        background.paste(image, mask=image.getchannel("A"))
+        image = background
+    elif image.mode != "RGB":
+        image = image.convert("RGB")
+    image.thumbnail((SKETCH_MAX_SIDE, SKETCH_MAX_SIDE))
+    candidates += [(_encode(image, image_format), image_format) for image_format in ("JPEG", "PNG")]
+
+    image_bytes, image_format = min(candidates, key=lambda candidate: len(candidate[0]))
+    return Sketch(hashlib.sha256(image_bytes).hexdigest(), image_bytes, f"image/{image_format.lower()}", len(data_url))
+
+
+class SketchStore:
+    """Recently seen sketches by content hash.
+
+    A sketch is decoded and normalized once; peers are sent its hash and
+    fetch the image from here only if they want to show it.
+
+    The counters compare what is sent against sending the upload as it
+    came, as before: modelBytes/peerBytes are sketch bytes actually sent to
+    the model and to peers (fetchSketch), and the *Saved counters the
+    difference from sending the upload each time. Peers are counted on the
+    node that receives the sketch."""
+
+    def __init__(self, max_sketches: int = SKETCH_CACHE_SIZE):
+        self.max_sketches = max_sketches
+        self._sketches = OrderedDict()
+        self._by_upload = OrderedDict()
+        self.counters = {"sketches": 0, "reused": 0, "originalBytes": 0,
+                         "modelBytes": 0, "modelBytesSaved": 0, "peerBytes": 0, "peerBytesSaved": 0}
+        self.model_bytes = Histogram()
+
+    async def ingest(self, data_url: str) -> Sketch:
+        self.counters["sketches"] += 1
+        self.counters["originalBytes"] += len(data_url)
+        upload_hash = hashlib.sha256(data_url.encode("utf-8")).hexdigest()
+        digest = self._by_upload.get(upload_hash)
+        sketch = self._sketches.get(digest) if digest else None
+        if sketch is not None:
+            self.counters["reused"] += 1
+        else:
+            sketch = await run_blocking(normalize_sketch, data_url)
+        self._remember(upload_hash, sketch)
+        return sketch
+
+    def _remember(self, upload_hash: str, sketch: Sketch):
+        self._by_upload[upload_hash] = sketch.hash
+        self._by_upload.move_to_end(upload_hash)
+        self._sketches[sketch.hash] = sketch
+        self._sketches.move_to_end(sketch.hash)
+        while len(self._sketches) > self.max_sketches:
+            self._sketches.popitem(last=False)
+        while len(self._by_upload) > self.max_sketches:
+            self._by_upload.popitem(last=False)
+
+    def get(self, digest: str):
+        return self._sketches.get(digest)
+
+    def record_model_send(self, sketch: Sketch):
+        sent = len(sketch.data_url)
+        self.counters["modelBytes"] += sent
+        self.counters["modelBytesSaved"] += sketch.original_size - sent
+        self.model_bytes.observe(sent)
+
+    def record_model_skip(self, sketch: Sketch):
+        """A model call that would have carried the sketch was answered from cache."""
+        self.counters["modelBytesSaved"] += sketch.original_size
+
+    def record_peer_refs(self, sketch: Sketch, peers: int):
+        """Peers were sent the hash in place of the upload."""
+        self.counters["peerBytesSaved"] += peers * (sketch.original_size - len(sketch.hash))
+
+    def record_peer_fetch(self, sent: int):
+        self.counters["peerBytes"] += sent
+        self.counters["peerBytesSaved"] -= sent
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "cached": len(self._sketches),
+            "modelBytesPerSketch": self.model_bytes.summary(),
+        }
+
+
+sketch_store = SketchStore()
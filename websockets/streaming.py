@@ -0,0 +1,85 @@
+from session_management import broadcast_to_session
+from codec import send_message
+
+# session_id -> {message_id: ResponseStream} for replies still being streamed,
+# so clients joining mid-reply can be resynced with the text so far
+active_streams = {}
+
+
+def delta_frame(message_id: str, seq: int, delta: str, user: str = "Monitor") -> dict:
+    return {
+        "type": "geminiStreamResponse",
+        "id": message_id,
+        "seq": seq,
+        "delta": delta,
+        "user": user,
+        "isComplete": False
+    }
+
+
+def complete_frame(message_id: str, seq: int, user: str = "Monitor") -> dict:
+    return {
+        "type": "geminiStreamResponse",
+        "id": message_id,
+        "seq": seq,
+        "user": user,
+        "isComplete": True
+    }
+
+
+def resync_frame(message_id: str, seq: int, text: str, user: str = "Monitor", is_complete: bool = False) -> dict:
+    return {
+        "type": "geminiStreamResync",
+        "id": message_id,
+        "seq": seq,
+        "text": text,
+        "user": user,
+        "isComplete": is_complete
+    }
+
+
+class ResponseStream:
+    """Broadcasts a streamed reply as numbered deltas.
+
+    `seq` starts at 1 for the first delta; the completion frame carries the
+    seq of the last delta so clients can detect gaps."""
+
+    def __init__(self, session_id: str, message_id: str, user: str = "Monitor"):
+        self.session_id = session_id
+        self.message_id = message_id
+        self.user = user
+        self.seq = 0
+        self._parts = []
+
+    @property
+    def text(self) -> str:
+        return "".join(self._parts)
+
+    async def __aenter__(self):
+        active_streams.setdefault(self.session_id, {})[self.message_id] = self
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        streams = active_streams.get(self.session_id)
+        if streams is not None:
+            streams.pop(self.message_id, None)
+            if not streams:
+                del active_streams[self.session_id]
+
+    async def send(self, delta: str):
+        if not delta:
+            return
+        self.seq += 1
+        self._parts.append(delta)
+        await broadcast_to_session(self.session_id, delta_frame(self.message_id, self.seq, delta, self.user))
+
+    async def complete(self):
+        await broadcast_to_session(self.session_id, complete_frame(self.message_id, self.seq, self.user))
+
+    def resync(self) -> dict:
+        return resync_frame(self.message_id, self.seq, self.text, self.user)
+
+
+async def resync_client(session_id: str, websocket):
+    for stream in list(active_streams.get(session_id, {}).values()):
+        await send_message(websocket, stream.resync())
@@ -0,0 +1,91 @@
+import os
+import time
+import random
+import asyncio
+from collections import namedtuple
+
+from llm_async import run_blocking
+from clients import clients
+
+TARGET_PREFIX = "targets/"
+TARGET_POOL_REFRESH_SECONDS = float(os.getenv("TARGET_POOL_REFRESH_SECONDS", "600"))
+
+TargetEntry = namedtuple("TargetEntry", ["name", "size", "generation"])
+
+
+class TargetPool:
+    """In-memory index of the target library for O(1) random selection.
+
+    Listing the whole prefix is paid once per refresh interval rather than
+    on every session completion."""
+
+    def __init__(self, bucket_factory, prefix: str = TARGET_PREFIX, refresh_seconds: float = TARGET_POOL_REFRESH_SECONDS):
+        self.bucket_factory = bucket_factory
+        self.prefix = prefix
+        self.refresh_seconds = refresh_seconds
+        self.entries = []
+        self.refreshed_at = None
+        self._refreshing = None
+        self._refresher = None
+
+    def _list_entries(self):
+        blobs = self.bucket_factory().list_blobs(
+            prefix=self.prefix, fields="items(name,size,generation),nextPageToken"
+        )
+        return [
+            TargetEntry(blob.name, blob.size, blob.generation)
+            for blob in blobs
+            if not blob.name.endswith("/")
+        ]
+
+    async def refresh(self):
+        # Concurrent callers share one listing
+        if self._refreshing is None:
+            self._refreshing = asyncio.ensure_future(run_blocking(self._list_entries))
+        try:
+            entries = await asyncio.shield(self._refreshing)
+        finally:
+            self._refreshing = None
+        self.entries = entries
+        self.refreshed_at = time.monotonic()
+        print(f"Indexed {len(entries)} targets under {self.prefix}")
+
+    async def _refresh_periodically(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                print(f"Failed to refresh target pool: {e}")
+            await asyncio.sleep(self.refresh_seconds)
+
+    def start(self):
+        self._refresher = asyncio.create_task(self._refresh_periodically())
+
+    async def stop(self):
+        if self._refresher is not None:
+            self._refresher.cancel()
+            await asyncio.gather(self._refresher, return_exceptions=True)
+            self._refresher = None
+
+    async def choose(self) -> TargetEntry:
+        if self.refreshed_at is None:
+            await self.refresh()
+        if not self.entries:
+            raise ValueError("No target images found")
+        return random.choice(self.entries)
+
+    def discard(self, entry: TargetEntry):
+        """Drops an entry whose object has gone since the last refresh."""
+        try:
+            self.entries.remove(entry)
+        except ValueError:
+            pass
+
+    def stats(self) -> dict:
+        return {
+            "targets": len(self.entries),
+            "ageSeconds": time.monotonic() - self.refreshed_at if self.refreshed_at is not None else None,
+        }
+
+
+target_pool = TargetPool(clients.bucket)
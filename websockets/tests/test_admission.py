@@ -0,0 +1,144 @@
+import asyncio
+
+from admission import ModelScheduler
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+class Recorder:
+    def __init__(self):
+        self.started = []
+        self.rejected = []
+        self.gates = {}
+
+    def job(self, name):
+        async def run():
+            self.started.append(name)
+            gate = self.gates.setdefault(name, asyncio.Event())
+            await gate.wait()
+        return run
+
+    def reject(self, name):
+        async def reject(reason):
+            self.rejected.append((name, reason))
+        return reject
+
+    def finish(self, name):
+        self.gates.setdefault(name, asyncio.Event()).set()
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_latest_request_replaces_a_queued_one():
+    async def scenario():
+        scheduler = ModelScheduler(max_concurrent=4, policy="latest")
+        recorder = Recorder()
+        for name in ("first", "second", "third"):
+            scheduler.submit("s1", "sketchAndChat", recorder.job(name), recorder.reject(name))
+        await settle()
+        recorder.finish("first")
+        await settle()
+        recorder.finish("third")
+        await settle()
+        await scheduler.stop()
+        return scheduler, recorder
+
+    scheduler, recorder = run(scenario())
+    assert recorder.started == ["first", "third"]
+    assert recorder.rejected == [("second", "superseded")]
+    assert scheduler.counters["superseded"] == 1
+
+
+def test_a_different_kind_is_refused_while_one_waits():
+    async def scenario():
+        scheduler = ModelScheduler(max_concurrent=4, policy="latest")
+        recorder = Recorder()
+        scheduler.submit("s1", "chatOnly", recorder.job("running"), recorder.reject("running"))
+        scheduler.submit("s1", "chatOnly", recorder.job("queued"), recorder.reject("queued"))
+        accepted = scheduler.submit("s1", "completeSession", recorder.job("other"), recorder.reject("other"))
+        await settle()
+        await scheduler.stop()
+        return accepted, recorder
+
+    accepted, recorder = run(scenario())
+    assert not accepted
+    assert recorder.rejected == [("other", "sessionBusy")]
+
+
+def test_busy_policy_refuses_while_the_session_has_a_request():
+    async def scenario():
+        scheduler = ModelScheduler(max_concurrent=4, policy="busy")
+        recorder = Recorder()
+        scheduler.submit("s1", "chatOnly", recorder.job("first"), recorder.reject("first"))
+        scheduler.submit("s1", "chatOnly", recorder.job("second"), recorder.reject("second"))
+        await settle()
+        await scheduler.stop()
+        return recorder
+
+    recorder = run(scenario())
+    assert recorder.started == ["first"]
+    assert recorder.rejected == [("second", "sessionBusy")]
+
+
+def test_concurrency_is_capped_and_sessions_start_in_queue_order():
+    async def scenario():
+        scheduler = ModelScheduler(max_concurrent=2, policy="latest")
+        recorder = Recorder()
+        for session in ("a", "b", "c", "d"):
+            scheduler.submit(session, "chatOnly", recorder.job(session), recorder.reject(session))
+        await settle()
+        started = list(recorder.started)
+        recorder.finish("b")
+        await settle()
+        after = list(recorder.started)
+        await scheduler.stop()
+        return started, after
+
+    started, after = run(scenario())
+    assert started == ["a", "b"]
+    assert after == ["a", "b", "c"]
+
+
+def test_background_calls_hold_back_new_requests():
+    async def scenario():
+        scheduler = ModelScheduler(max_concurrent=1, policy="latest")
+        recorder = Recorder()
+        with scheduler.background("summary"):
+            scheduler.submit("s1", "chatOnly", recorder.job("chat"), recorder.reject("chat"))
+            await settle()
+            during = list(recorder.started)
+        await settle()
+        stats = scheduler.stats()
+        await scheduler.stop()
+        return during, recorder, stats
+
+    during, recorder, stats = run(scenario())
+    assert during == []
+    assert recorder.started == ["chat"]
+    assert stats["backgroundCalls"] == {"summary": 1}
+
+
+def test_a_failing_request_frees_its_session():
+    async def scenario():
+        scheduler = ModelScheduler(max_concurrent=1, policy="busy")
+        recorder = Recorder()
+
+        async def fail():
+            raise RuntimeError("model unavailable")
+
+        scheduler.submit("s1", "chatOnly", fail, recorder.reject("fail"))
+        await settle()
+        accepted = scheduler.submit("s1", "chatOnly", recorder.job("next"), recorder.reject("next"))
+        await settle()
+        await scheduler.stop()
+        return accepted, recorder, scheduler
+
+    accepted, recorder, scheduler = run(scenario())
+    assert accepted
+    assert recorder.started == ["next"]
+    assert scheduler.counters["failed"] == 1
@@ -0,0 +1,82 @@
+import asyncio
+
+from details import DetailExtractor, parse_details, merge_details
+from sketches import Sketch
+
+
+def test_parse_details_accepts_fenced_bare_and_list_answers():
+    assert parse_details('```json\n{"details": ["red", "doorway"]}\n```') == ["red", "doorway"]
+    assert parse_details('Here you go: {"details": ["tall"]} hope that helps') == ["tall"]
+    assert parse_details('["wet", "cold"]') == ["wet", "cold"]
+
+
+def test_parse_details_drops_blank_and_non_string_entries():
+    assert parse_details('{"details": ["  stone ", "", null, {"a": 1}, 3]}') == ["stone", "3"]
+
+
+def test_parse_details_returns_none_without_json():
+    assert parse_details("I could not find any details.") is None
+    assert parse_details('{"details": "red"}') is None
+
+
+def test_merge_details_ignores_case_duplicates():
+    assert merge_details(["Red", "door"], ["red", "window", "Door"]) == ["Red", "door", "window"]
+
+
+class FakeLLM:
+    def __init__(self, *answers):
+        self.answers = list(answers)
+        self.calls = 0
+
+    def invoke(self, messages):
+        self.calls += 1
+        return type("Response", (), {"content": self.answers.pop(0), "usage_metadata": None})()
+
+
+def test_extract_without_a_sketch_caches_by_conversation():
+    extractor = DetailExtractor()
+    llm = FakeLLM('{"details": ["red"]}', '{"details": ["blue"]}')
+
+    async def run():
+        first = await extractor.extract(llm, None, "text", ["a message"], [])
+        repeat = await extractor.extract(llm, None, "text", ["A message!"], ["known"])
+        changed = await extractor.extract(llm, None, "text", ["another message"], ["red"])
+        return first, repeat, changed
+
+    first, repeat, changed = asyncio.run(run())
+    assert first == ["red"]
+    assert repeat == ["known", "red"]
+    assert changed == ["red", "blue"]
+    assert llm.calls == 2
+    assert extractor.counters["hits"] == 1
+
+
+def test_extract_reuses_an_unchanged_sketch_sent_with_a_new_message():
+    extractor = DetailExtractor()
+    llm = FakeLLM('{"details": ["red"]}', '{"details": ["tall"]}')
+    sketch = Sketch("abc", b"sketch", "image/png", 100)
+    other = Sketch("def", b"other sketch", "image/png", 100)
+
+    async def run():
+        first = await extractor.extract(llm, sketch, "text", ["a door"], [])
+        resent = await extractor.extract(llm, sketch, "text", ["a door", "it is red"], first)
+        changed = await extractor.extract(llm, other, "text", ["a door", "it is red"], first)
+        return first, resent, changed
+
+    first, resent, changed = asyncio.run(run())
+    assert first == ["red"]
+    assert resent == ["red"]
+    assert changed == ["red", "tall"]
+    assert llm.calls == 2
+    assert extractor.counters["hits"] == 1
+
+
+def test_extract_asks_for_a_reformat_once_before_giving_up():
+    extractor = DetailExtractor()
+    llm = FakeLLM("red and a doorway", '{"details": ["red", "doorway"]}')
+    assert asyncio.run(extractor.extract(llm, None, "text", ["m"], [])) == ["red", "doorway"]
+    assert extractor.counters["retries"] == 1
+
+    llm = FakeLLM("no idea", "still no idea")
+    assert asyncio.run(extractor.extract(llm, None, "text", ["other"], ["kept"])) == ["kept"]
+    assert extractor.counters["parseFailures"] == 1
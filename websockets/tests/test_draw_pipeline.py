@@ -0,0 +1,43 @@
+from draw_pipeline import decimate
+
+
+def stroke(points, color="#000000"):
+    return [
+        {"prevX": x0, "prevY": y0, "x": x1, "y": y1, "color": color}
+        for (x0, y0), (x1, y1) in zip(points, points[1:])
+    ]
+
+
+def test_short_batches_are_kept_as_they_are():
+    segments = stroke([(i, i) for i in range(10)])
+    assert decimate(segments, 200) is segments
+
+
+def test_a_long_stroke_keeps_its_ends_and_stays_joined():
+    segments = stroke([(i, i * 2) for i in range(1001)])
+    decimated = decimate(segments, 100)
+
+    assert len(decimated) <= 100
+    assert (decimated[0]["prevX"], decimated[0]["prevY"]) == (0, 0)
+    assert (decimated[-1]["x"], decimated[-1]["y"]) == (1000, 2000)
+    for previous, segment in zip(decimated, decimated[1:]):
+        assert (segment["prevX"], segment["prevY"]) == (previous["x"], previous["y"])
+
+
+def test_separate_strokes_are_not_joined_and_keep_their_order():
+    first = stroke([(i, 0) for i in range(300)], color="#ff0000")
+    second = stroke([(0, i) for i in range(300)], color="#00ff00")
+    decimated = decimate(first + second, 50)
+
+    colors = [segment["color"] for segment in decimated]
+    assert colors == sorted(colors, key=["#ff0000", "#00ff00"].index)
+    split = colors.index("#00ff00")
+    assert (decimated[split - 1]["x"], decimated[split - 1]["y"]) == (299, 0)
+    assert (decimated[split]["prevX"], decimated[split]["prevY"]) == (0, 0)
+    assert (decimated[-1]["x"], decimated[-1]["y"]) == (0, 299)
+
+
+def test_every_run_keeps_a_segment_even_past_the_budget():
+    dots = [{"prevX": i, "prevY": 0, "x": i, "y": 0, "color": "#000000"} for i in range(0, 40, 2)]
+    decimated = decimate(dots, 5)
+    assert decimated == dots
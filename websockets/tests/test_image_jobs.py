@@ -0,0 +1,130 @@
+import asyncio
+import threading
+
+from image_jobs import ImageJob, ImageJobQueue
+
+
+class GatedBackend:
+    """Generates once `release` is set, recording each prompt."""
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.prompts = []
+        self.stored = []
+
+    def generate(self, prompt: str) -> bytes:
+        self.release.wait(5)
+        self.prompts.append(prompt)
+        return prompt.encode("utf-8")
+
+    def store(self, session_id: str, image_bytes: bytes) -> str:
+        self.stored.append(session_id)
+        return f"sessions/{session_id}/targetModels/{len(self.prompts)}.jpg"
+
+
+async def wait_for(condition, timeout=5):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not condition():
+        assert loop.time() < deadline
+        await asyncio.sleep(0.01)
+
+
+def test_submissions_while_a_job_runs_coalesce_into_the_latest():
+    async def scenario():
+        backend = GatedBackend()
+        completed = []
+
+        async def on_complete(session_id, image_bytes, image_path):
+            completed.append(image_bytes.decode("utf-8"))
+
+        queue = ImageJobQueue(backend, on_complete, workers=2)
+        queue.start()
+        queue.submit(ImageJob("s1", ["first"], []))
+        await wait_for(lambda: queue.stats()["running"] == 1)
+        for detail in ("second", "third", "fourth"):
+            queue.submit(ImageJob("s1", [detail], []))
+        backend.release.set()
+        await wait_for(lambda: len(completed) == 2)
+        await queue.stop()
+        return queue, completed
+
+    queue, completed = asyncio.run(scenario())
+    assert ["first" in prompt for prompt in completed] == [True, False]
+    assert "fourth" in completed[1]
+    assert queue.counters["coalesced"] == 2
+    assert queue.counters["completed"] == 2
+
+
+def test_sessions_do_not_wait_on_each_other():
+    async def scenario():
+        backend = GatedBackend()
+        backend.release.set()
+        completed = []
+
+        async def on_complete(session_id, image_bytes, image_path):
+            completed.append(session_id)
+
+        queue = ImageJobQueue(backend, on_complete, workers=2)
+        queue.start()
+        queue.submit(ImageJob("s1", ["a"], []))
+        queue.submit(ImageJob("s2", ["b"], []))
+        await wait_for(lambda: len(completed) == 2)
+        await queue.stop()
+        return completed
+
+    assert sorted(asyncio.run(scenario())) == ["s1", "s2"]
+
+
+def test_cancel_drops_the_pending_job():
+    async def scenario():
+        backend = GatedBackend()
+        completed = []
+
+        async def on_complete(session_id, image_bytes, image_path):
+            completed.append(session_id)
+
+        queue = ImageJobQueue(backend, on_complete, workers=1)
+        queue.start()
+        queue.submit(ImageJob("s1", ["running"], []))
+        await wait_for(lambda: queue.stats()["running"] == 1)
+        queue.submit(ImageJob("s1", ["pending"], []))
+        queue.cancel("s1")
+        backend.release.set()
+        await wait_for(lambda: queue.stats()["running"] == 0)
+        await asyncio.sleep(0.05)
+        await queue.stop()
+        return queue, completed
+
+    queue, completed = asyncio.run(scenario())
+    assert completed == []
+    assert queue.counters["cancelled"] == 2
+    assert queue.stats()["pending"] == 0
+
+
+def test_a_job_cancelled_while_generating_is_not_stored():
+    async def scenario():
+        backend = GatedBackend()
+        completed = []
+
+        async def on_complete(session_id, image_bytes, image_path):
+            completed.append(session_id)
+
+        queue = ImageJobQueue(backend, on_complete, workers=1)
+        queue.start()
+        job = ImageJob("s1", ["running"], [])
+        queue.submit(job)
+        await wait_for(lambda: queue.stats()["running"] == 1)
+        queue.cancel("s1")
+        backend.release.set()
+        await wait_for(lambda: backend.prompts)
+        # The generation thread still finishes; the upload must not follow
+        assert job.cancelled
+        assert queue._store(job, b"image") is None
+        await asyncio.sleep(0.05)
+        await queue.stop()
+        return backend, completed
+
+    backend, completed = asyncio.run(scenario())
+    assert backend.stored == []
+    assert completed == []
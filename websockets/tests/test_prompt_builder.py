@@ -0,0 +1,50 @@
+import types
+
+from langchain_core.messages import HumanMessage
+
+from prompt_builder import select_history, estimate_tokens, PROMPT_RECENT_MESSAGES
+
+
+def history(count, chars=400, summary=None, summarized=0):
+    messages = [HumanMessage(content=f"{i:04d}" + "x" * (chars - 4)) for i in range(count)]
+    return types.SimpleNamespace(messages=messages, summary=summary, summarized=summarized, summarizer=None)
+
+
+def test_everything_fits_a_large_budget():
+    chat_history = history(20)
+    summary, messages, omitted = select_history(chat_history, 0, budget=100000)
+    assert summary is None
+    assert messages == chat_history.messages
+    assert omitted == 0
+
+
+def test_oldest_messages_are_left_out_first():
+    chat_history = history(40)
+    per_message = estimate_tokens(chat_history.messages[0].content)
+    summary, messages, omitted = select_history(chat_history, 0, budget=per_message * 15)
+    assert messages == chat_history.messages[-15:]
+    assert omitted == 25
+
+
+def test_recent_messages_are_kept_even_over_budget():
+    chat_history = history(30)
+    summary, messages, omitted = select_history(chat_history, 10000, budget=100)
+    assert messages == chat_history.messages[-PROMPT_RECENT_MESSAGES:]
+    assert omitted == 30 - PROMPT_RECENT_MESSAGES
+
+
+def test_summarized_messages_are_replaced_by_the_summary():
+    chat_history = history(30, summary="Earlier the viewer saw water.", summarized=12)
+    summary, messages, omitted = select_history(chat_history, 0, budget=100000)
+    assert summary == "Earlier the viewer saw water."
+    assert messages == chat_history.messages[12:]
+    assert omitted == 0
+
+
+def test_the_summary_and_reserved_text_count_against_the_budget():
+    chat_history = history(30, summary="s" * 4000, summarized=10)
+    per_message = estimate_tokens(chat_history.messages[0].content)
+    budget = estimate_tokens("s" * 4000) + 500 + per_message * 12
+    summary, messages, omitted = select_history(chat_history, 500, budget=budget)
+    assert len(messages) == 12
+    assert omitted == 20 - 12